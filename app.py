@@ -1,29 +1,84 @@
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash
+import time
+_INICIO_ARRANQUE = time.perf_counter()
+
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash, g, session, make_response
+from flask import has_app_context, has_request_context, before_render_template, template_rendered, stream_with_context, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as SesionFlask
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
+from werkzeug.datastructures import Headers
+from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin, user_logged_in
+from flask.sessions import SessionInterface, SessionMixin
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
 from flask import abort
 from flask_login import current_user
-from flask_migrate import Migrate
+from markupsafe import Markup, escape
+import bisect
+import click
+import csv
+import hashlib
+import io
+import itertools
+import json
+import marshal
 import os
-import smtplib
-from email.message import EmailMessage
-from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
-from sqlalchemy.exc import OperationalError
+import random
+import re
+import secrets
+import stat
+import threading
+import unicodedata
+from datetime import date, datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DisconnectionError, IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.pool import QueuePool
 
 app = Flask(__name__)
-# Secret key: require it in non-development environments to avoid weak defaults
-FLASK_SECRET_KEY = os.environ.get("FLASK_SECRET_KEY")
-if not FLASK_SECRET_KEY:
-    # If running in development, allow a default for convenience. In any other
-    # environment we must fail early to avoid predictable secrets.
-    if os.environ.get("FLASK_ENV", "production") == "development":
-        app.secret_key = "dev-secret-key"
+
+
+class SesionEnrutada(SesionFlask):
+    """Sesión que manda las lecturas de las vistas @lectura_replica a una réplica.
+
+    Las escrituras (flush, INSERT/UPDATE/DELETE, SELECT ... FOR UPDATE) y todo
+    lo que no venga de esas vistas va a la primaria (ver ReplicasLectura).
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and _puede_leer_replica(clause):
+            replica = replicas.elegir()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# Extensiones sin app: configurar_app() las inicializa. Los modelos, vistas y
+# eventos se registran al importar (es barato); la configuración que depende del
+# entorno y la conexión a la base se hacen en configurar_app().
+db = SQLAlchemy(session_options={'class_': SesionEnrutada})
+login_manager = LoginManager()
+login_manager.login_view = 'login'
+
+# Duración de cada fase del arranque (ver reporte_arranque y /metrics)
+tiempos_arranque = {}
+
+
+def _configurar_secreto(app):
+    # Secret key: require it in non-development environments to avoid weak defaults
+    FLASK_SECRET_KEY = os.environ.get("FLASK_SECRET_KEY")
+    if not FLASK_SECRET_KEY:
+        # If running in development, allow a default for convenience. In any other
+        # environment we must fail early to avoid predictable secrets.
+        if os.environ.get("FLASK_ENV", "production") == "development":
+            app.secret_key = "dev-secret-key"
+        else:
+            raise RuntimeError("FLASK_SECRET_KEY is not set. Set it in the environment before starting the app.")
     else:
-        raise RuntimeError("FLASK_SECRET_KEY is not set. Set it in the environment before starting the app.")
-else:
-    app.secret_key = FLASK_SECRET_KEY
+        app.secret_key = FLASK_SECRET_KEY
 
 
 # Configuración de la base de datos
@@ -44,6 +99,11 @@ def _discover_db_uri() -> str | None:
             # Normalizar esquema postgres:// a postgresql:// si es necesario
             if v.startswith("postgres://"):
                 v = "postgresql://" + v[len("postgres://"):]
+            # Otros motores (p. ej. sqlite:/// en desarrollo o pruebas de carga)
+            # se usan tal cual: urlunparse colapsaría las barras de la ruta.
+            if not v.startswith("postgresql"):
+                print(f"Usando '{k}' para DB")
+                return v
 
             # Parsear y reconstruir la URL de forma segura. Evita
             # concatenaciones manuales que pueden generar cadenas
@@ -74,59 +134,498 @@ def _discover_db_uri() -> str | None:
                 return v
     return None
 
-DATABASE_URL = _discover_db_uri()
-if DATABASE_URL:
-    # Establecer la URI de SQLAlchemy correctamente
-    app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
-    # Evitar imprimir credenciales completas en logs
+def _configurar_base_de_datos(app):
+    DATABASE_URL = _discover_db_uri()
+    if DATABASE_URL:
+        # Establecer la URI de SQLAlchemy correctamente
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
+        # Evitar imprimir credenciales completas en logs
+        try:
+            from urllib.parse import urlparse
+            _p = urlparse(DATABASE_URL)
+            redacted = f"{_p.scheme}://{_p.hostname}:{_p.port or ''}{_p.path}"
+            print("DB URI:", redacted)
+            # Diagnostics (no secrets): indicar si la URI incluye credenciales y puerto
+            try:
+                has_user = bool(_p.username)
+                has_port = _p.port is not None
+                print(f"DB INFO: host={_p.hostname} has_user={has_user} has_port={has_port}")
+            except Exception:
+                pass
+        except Exception:
+            print("DB URI establecida desde entorno")
+    else:
+        POSTGRES_USER = os.environ.get("POSTGRES_USER", "postgres")
+        POSTGRES_PW = os.environ.get("POSTGRES_PW", "12345")
+        POSTGRES_DB = os.environ.get("POSTGRES_DB", "reservasdb")
+        POSTGRES_HOST = os.environ.get("POSTGRES_HOST", "localhost")
+        POSTGRES_PORT = os.environ.get("POSTGRES_PORT", "5432")
+        app.config["SQLALCHEMY_DATABASE_URI"] = (
+            f"postgresql://{POSTGRES_USER}:{POSTGRES_PW}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+        )
+        print("DB URI (por defecto local):", app.config["SQLALCHEMY_DATABASE_URI"])
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Engine options: pool sizing plus PoolVigilado (métricas y cortacircuitos).
+    # Las conexiones muertas ('SSL connection closed unexpectedly') se detectan
+    # con el sondeo en segundo plano y un ping sólo a las que estuvieron ociosas
+    # más de DB_PING_INACTIVA segundos, no con pool_pre_ping en cada checkout.
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    engine_opts = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    # Don't overwrite if already set by environment or other code; merge sensible defaults.
+    engine_opts.setdefault('pool_pre_ping', DB_PRE_PING)
+    engine_opts.setdefault('poolclass', PoolVigilado)
+    engine_opts.setdefault('pool_logging_name', 'primaria')
+    engine_opts.setdefault('pool_size', int(os.environ.get('SQLALCHEMY_POOL_SIZE', 5)))
+    engine_opts.setdefault('max_overflow', int(os.environ.get('SQLALCHEMY_MAX_OVERFLOW', 10)))
+    engine_opts.setdefault('pool_recycle', int(os.environ.get('SQLALCHEMY_POOL_RECYCLE', 1800)))
+    engine_opts.setdefault('pool_timeout', int(os.environ.get('SQLALCHEMY_POOL_TIMEOUT', 30)))
+    # If the DATABASE_URL didn't include sslmode, ensure psycopg2 uses require as a fallback
+    # (connect_args is accepted by SQLAlchemy create_engine and passed to psycopg2).
+    connect_args = engine_opts.get('connect_args', {})
+    if 'sslmode' not in connect_args and app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgresql"):
+        # If DATABASE_URL already contains sslmode via query string, psycopg2 will use it; this just ensures a fallback.
+        connect_args.setdefault('sslmode', 'require')
+    if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgresql"):
+        # Que una base caída falle en segundos y abra el circuito, no en minutos
+        connect_args.setdefault('connect_timeout', DB_CONNECT_TIMEOUT)
+        if _usa_pgbouncer(app.config["SQLALCHEMY_DATABASE_URI"]):
+            _ajustar_para_pgbouncer(app.config["SQLALCHEMY_DATABASE_URI"], connect_args)
+    engine_opts['connect_args'] = connect_args
+    # Réplicas de lectura: un bind de Flask-SQLAlchemy por URL; ningún modelo
+    # las usa directamente, las elige SesionEnrutada.get_bind.
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    for i, url in enumerate(_discover_replica_uris()):
+        args_replica = {}
+        if url.startswith("postgresql"):
+            args_replica = {'sslmode': 'require', 'connect_timeout': REPLICA_CONNECT_TIMEOUT}
+            if _usa_pgbouncer(url):
+                _ajustar_para_pgbouncer(url, args_replica)
+        binds[f'replica{i}'] = {'url': url, 'connect_args': args_replica, 'pool_logging_name': f'replica{i}'}
+
+
+# --- Réplicas de lectura ------------------------------------------------------
+# DATABASE_REPLICA_URL admite varias URLs separadas por coma. Sólo las vistas
+# marcadas con @lectura_replica (catálogo, búsqueda, reportes, exportaciones)
+# leen de ellas, y no si el usuario escribió hace menos de REPLICA_PEGAJOSA
+# segundos (lee lo que acaba de escribir desde la primaria). Cada worker
+# verifica sus réplicas cada REPLICA_CHEQUEO segundos y descarta las que no
+# responden o tienen más de REPLICA_LAG_MAX segundos de retraso.
+REPLICA_LAG_MAX = float(os.environ.get("REPLICA_LAG_MAX", "5"))
+REPLICA_CHEQUEO = float(os.environ.get("REPLICA_CHEQUEO", "5"))
+REPLICA_PEGAJOSA = float(os.environ.get("REPLICA_PEGAJOSA", "10"))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get("REPLICA_CONNECT_TIMEOUT", "3"))
+
+_METODOS_SEGUROS = ('GET', 'HEAD', 'OPTIONS')
+
+# Retraso de una réplica Postgres en segundos. Si ya reprodujo todo lo que
+# recibió el retraso es 0 aunque la última transacción sea vieja (primaria
+# ociosa); en la primaria (sin recovery) también es 0.
+_SQL_LAG_REPLICA = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+
+def _discover_replica_uris():
+    """URLs de DATABASE_REPLICA_URL (separadas por coma), normalizadas como la primaria."""
+    urls = []
+    for url in os.environ.get("DATABASE_REPLICA_URL", "").split(","):
+        url = url.strip()
+        if url.startswith("postgres://"):
+            url = "postgresql://" + url[len("postgres://"):]
+        if url:
+            urls.append(url)
+    return urls
+
+
+class Replica:
+    __slots__ = ('nombre', 'engine', 'sana', 'lag', 'catalogo_version', 'error')
+
+    def __init__(self, nombre, engine):
+        self.nombre = nombre
+        self.engine = engine
+        self.sana = False
+        self.lag = None
+        self.catalogo_version = None
+        self.error = None
+
+
+class ReplicasLectura:
+    """Réplicas configuradas en este worker y su salud.
+
+    La verificación corre dentro de un request (el primero que la encuentra
+    vencida, sin bloquear a los demás) y también lee catalogo_version: una
+    réplica que todavía no vio el último cambio del catálogo no se usa, así las
+    páginas cacheadas con la versión nueva no se arman con datos viejos.
+    """
+
+    def __init__(self, lag_max, intervalo):
+        self.lag_max = lag_max
+        self.intervalo = intervalo
+        self._replicas = []
+        self._lock = threading.Lock()
+        self._verificado_en = 0.0
+
+    @property
+    def configuradas(self):
+        return bool(self._replicas)
+
+    def configurar(self, engines):
+        self._replicas = [Replica(nombre, engine) for nombre, engine in sorted(engines.items())]
+        self._verificado_en = 0.0
+        for replica in self._replicas:
+            event.listen(replica.engine, 'handle_error', self._al_error(replica))
+
+    def _al_error(self, replica):
+        def manejar(contexto):
+            # Una desconexión saca a la réplica de la rotación hasta el próximo chequeo
+            if contexto.is_disconnect:
+                self.marcar_caida(replica, contexto.original_exception)
+        return manejar
+
+    def marcar_caida(self, replica, error):
+        if replica.sana:
+            app.logger.warning("Réplica %s fuera de rotación: %s", replica.nombre, error)
+        replica.sana = False
+        replica.error = str(error).splitlines()[0]
+
+    def _chequear(self, replica):
+        try:
+            with replica.engine.connect() as conexion:
+                if conexion.dialect.name == 'postgresql':
+                    lag = float(conexion.execute(db.text(_SQL_LAG_REPLICA)).scalar() or 0)
+                else:
+                    conexion.execute(db.text("SELECT 1"))
+                    lag = 0.0
+                try:
+                    replica.catalogo_version = conexion.execute(
+                        db.select(CatalogoVersion.version).where(CatalogoVersion.id == 1)).scalar() or 0
+                except ProgrammingError:
+                    replica.catalogo_version = None
+        except Exception as e:
+            self.marcar_caida(replica, e)
+            return
+        replica.lag = lag
+        replica.error = None if lag <= self.lag_max else f"retraso de {lag:.1f}s"
+        if replica.sana != (lag <= self.lag_max):
+            app.logger.warning("Réplica %s %s (retraso %.1fs)", replica.nombre,
+                               "en rotación" if lag <= self.lag_max else "fuera de rotación", lag)
+        replica.sana = lag <= self.lag_max
+
+    def verificar(self, forzar=False):
+        if not forzar and time.monotonic() - self._verificado_en < self.intervalo:
+            return
+        if not self._lock.acquire(blocking=forzar):
+            return
+        try:
+            for replica in self._replicas:
+                self._chequear(replica)
+            self._verificado_en = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def elegir(self):
+        """Engine de una réplica sana y al día con el catálogo, o None (usar la primaria)."""
+        if not self._replicas:
+            return None
+        self.verificar()
+        version = catalogo._version
+        candidatas = [r for r in self._replicas if r.sana and (
+            version is None or r.catalogo_version is None or r.catalogo_version >= version)]
+        if not candidatas:
+            return None
+        return random.choice(candidatas).engine
+
+    def estado(self):
+        return [{"nombre": r.nombre, "sana": r.sana, "lag": r.lag, "error": r.error} for r in self._replicas]
+
+
+replicas = ReplicasLectura(REPLICA_LAG_MAX, REPLICA_CHEQUEO)
+
+
+def _puede_leer_replica(clause):
+    if not replicas.configuradas or not has_request_context():
+        return False
+    if not g.get('_lectura_replica') or g.get('_forzar_primaria'):
+        return False
+    # session.connection() sin sentencia: probablemente para escribir
+    if clause is None or getattr(clause, 'is_dml', False):
+        return False
+    if getattr(clause, '_for_update_arg', None) is not None:
+        return False
+    texto = getattr(clause, 'text', None)
+    if isinstance(texto, str) and not texto.lstrip()[:6].upper().startswith(('SELECT', 'WITH')):
+        return False
+    return True
+
+
+def lectura_replica(vista):
+    """Marca una vista de sólo lectura: sus consultas pueden ir a una réplica."""
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        if (replicas.configuradas and request.method in _METODOS_SEGUROS
+                and session.get('_primaria_hasta', 0) < time.time()):
+            g._lectura_replica = True
+        return vista(*args, **kwargs)
+    return envoltura
+
+
+@contextmanager
+def en_primaria():
+    """Fuerza la primaria dentro del bloque (cachés que deben ver lo último escrito)."""
+    if not has_request_context():
+        yield
+        return
+    anterior = g.get('_forzar_primaria')
+    g._forzar_primaria = True
     try:
+        yield
+    finally:
+        g._forzar_primaria = anterior
+
+
+# --- Pool de conexiones: métricas, sondeo y cortacircuitos -------------------
+# En lugar de pool_pre_ping (un SELECT 1 extra por checkout) un hilo por worker
+# sondea la primaria cada DB_SONDEO segundos, y sólo se hace ping al sacar del
+# pool una conexión que estuvo ociosa más de DB_PING_INACTIVA segundos (Neon
+# corta las conexiones inactivas). Tras DB_CIRCUITO_FALLOS fallas de conexión
+# seguidas el circuito se abre: durante DB_CIRCUITO_ESPERA segundos pedir una
+# conexión falla al instante con 503 en vez de ocupar el worker esperando el
+# connect_timeout. Pasada la espera se deja probar; otra falla lo reabre.
+DB_PRE_PING = os.environ.get("DB_PRE_PING", "0") == "1"
+DB_PING_INACTIVA = float(os.environ.get("DB_PING_INACTIVA", "60"))
+DB_SONDEO = float(os.environ.get("DB_SONDEO", "10"))
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", "5"))
+DB_CIRCUITO_FALLOS = int(os.environ.get("DB_CIRCUITO_FALLOS", "3"))
+DB_CIRCUITO_ESPERA = float(os.environ.get("DB_CIRCUITO_ESPERA", "15"))
+# PgBouncer en modo transacción (p. ej. el endpoint '-pooler' de Neon): auto/1/0
+DB_PGBOUNCER = os.environ.get("DB_PGBOUNCER", "auto")
+
+
+def _usa_pgbouncer(url):
+    if DB_PGBOUNCER == "auto":
         from urllib.parse import urlparse
-        _p = urlparse(DATABASE_URL)
-        redacted = f"{_p.scheme}://{_p.hostname}:{_p.port or ''}{_p.path}"
-        print("DB URI:", redacted)
-        # Diagnostics (no secrets): indicar si la URI incluye credenciales y puerto
+        return "-pooler" in (urlparse(url).hostname or "")
+    return DB_PGBOUNCER == "1"
+
+
+def _ajustar_para_pgbouncer(url, connect_args):
+    """Opciones de conexión compatibles con PgBouncer en modo transacción.
+
+    psycopg2 nunca prepara sentencias en el servidor; psycopg (3) sí a partir
+    de la quinta ejecución, y una sentencia preparada en una conexión del
+    servidor no existe en la siguiente transacción. PgBouncer además rechaza
+    parámetros de arranque desconocidos como 'options'.
+    """
+    if url.startswith("postgresql+psycopg:"):
+        connect_args['prepare_threshold'] = None
+    connect_args.pop('options', None)
+
+
+class BaseDeDatosNoDisponible(Exception):
+    """El circuito de la base está abierto: no se intenta conectar."""
+
+    def __init__(self, reintentar_en):
+        super().__init__(f"Base de datos no disponible; reintentar en {reintentar_en:.0f}s")
+        self.reintentar_en = reintentar_en
+
+
+class Cortacircuitos:
+    def __init__(self, umbral, espera):
+        self.umbral = umbral
+        self.espera = espera
+        self._lock = threading.Lock()
+        self._fallos = 0
+        self._abierto_hasta = 0.0
+
+    def restante(self):
+        """Segundos que le quedan abierto (0 si deja pasar)."""
+        return max(0.0, self._abierto_hasta - time.monotonic())
+
+    def fallo(self):
+        with self._lock:
+            self._fallos += 1
+            if self._fallos < self.umbral:
+                return
+            if not self.restante():
+                metricas.contar('db_circuit_opens_total', 'primaria')
+                app.logger.error("Circuito de la base abierto tras %s fallas; reintento en %ss",
+                                 self._fallos, self.espera)
+            self._abierto_hasta = time.monotonic() + self.espera
+
+    def exito(self):
+        with self._lock:
+            if self._fallos >= self.umbral:
+                app.logger.warning("Circuito de la base cerrado: la base volvió a responder")
+            self._fallos = 0
+            self._abierto_hasta = 0.0
+
+
+circuito_db = Cortacircuitos(DB_CIRCUITO_FALLOS, DB_CIRCUITO_ESPERA)
+# El sondeo (hilo vigilante, espera del arranque) debe poder probar la base con el circuito abierto
+_sondeo = threading.local()
+
+
+def _nombre_pool(pool):
+    return pool.logging_name or 'primaria'
+
+
+class PoolVigilado(QueuePool):
+    """QueuePool que mide la espera por conexión y respeta el circuito de la primaria."""
+
+    def _do_get(self):
+        nombre = _nombre_pool(self)
+        if nombre == 'primaria' and not getattr(_sondeo, 'activo', False):
+            restante = circuito_db.restante()
+            if restante:
+                metricas.contar('db_circuit_rejections_total', nombre)
+                raise BaseDeDatosNoDisponible(restante)
+        inicio = time.perf_counter()
         try:
-            has_user = bool(_p.username)
-            has_port = _p.port is not None
-            print(f"DB INFO: host={_p.hostname} has_user={has_user} has_port={has_port}")
-        except Exception:
-            pass
-    except Exception:
-        print("DB URI establecida desde entorno")
-else:
-    POSTGRES_USER = os.environ.get("POSTGRES_USER", "postgres")
-    POSTGRES_PW = os.environ.get("POSTGRES_PW", "12345")
-    POSTGRES_DB = os.environ.get("POSTGRES_DB", "reservasdb")
-    POSTGRES_HOST = os.environ.get("POSTGRES_HOST", "localhost")
-    POSTGRES_PORT = os.environ.get("POSTGRES_PORT", "5432")
-    app.config["SQLALCHEMY_DATABASE_URI"] = (
-        f"postgresql://{POSTGRES_USER}:{POSTGRES_PW}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-    )
-    print("DB URI (por defecto local):", app.config["SQLALCHEMY_DATABASE_URI"])
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-# Engine options: enable pool_pre_ping to detect/reconnect dead connections
-# and set reasonable pool sizing. This helps avoid 'psycopg2.OperationalError: SSL connection closed unexpectedly'
-# which commonly happens when a pooled connection was closed by the server/network.
-app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
-engine_opts = app.config['SQLALCHEMY_ENGINE_OPTIONS']
-# Don't overwrite if already set by environment or other code; merge sensible defaults.
-engine_opts.setdefault('pool_pre_ping', True)
-engine_opts.setdefault('pool_size', int(os.environ.get('SQLALCHEMY_POOL_SIZE', 5)))
-engine_opts.setdefault('max_overflow', int(os.environ.get('SQLALCHEMY_MAX_OVERFLOW', 10)))
-engine_opts.setdefault('pool_recycle', int(os.environ.get('SQLALCHEMY_POOL_RECYCLE', 1800)))
-# If the DATABASE_URL didn't include sslmode, ensure psycopg2 uses require as a fallback
-# (connect_args is accepted by SQLAlchemy create_engine and passed to psycopg2).
-connect_args = engine_opts.get('connect_args', {})
-if 'sslmode' not in connect_args:
-    # If DATABASE_URL already contains sslmode via query string, psycopg2 will use it; this just ensures a fallback.
-    connect_args.setdefault('sslmode', 'require')
-engine_opts['connect_args'] = connect_args
-
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
+            return super()._do_get()
+        except PoolTimeoutError:
+            metricas.contar('db_pool_timeouts_total', nombre)
+            raise
+        finally:
+            metricas.observar('db_pool_wait_seconds', nombre, time.perf_counter() - inicio)
+
+
+@event.listens_for(PoolVigilado, "checkin")
+def _al_devolver_conexion(dbapi_connection, registro):
+    if registro is not None:
+        registro.info['devuelta_en'] = time.monotonic()
+
+
+@event.listens_for(PoolVigilado, "checkout")
+def _al_sacar_conexion(dbapi_connection, registro, proxy):
+    devuelta_en = registro.info.get('devuelta_en')
+    if devuelta_en is None or time.monotonic() - devuelta_en < DB_PING_INACTIVA:
+        return
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+    except Exception as e:
+        # El pool descarta esta conexión y reintenta con otra
+        raise DisconnectionError(f"Conexión ociosa muerta: {e}") from e
+
+
+def vigilar_engine(engine):
+    """Registra las métricas de invalidación y, en la primaria, el cierre del circuito al conectar."""
+    nombre = _nombre_pool(engine.pool)
+
+    def al_invalidar(dbapi_connection, registro, excepcion):
+        metricas.contar('db_pool_invalidations_total', nombre)
+
+    event.listen(engine.pool, 'invalidate', al_invalidar)
+    event.listen(engine.pool, 'soft_invalidate', al_invalidar)
+    if nombre == 'primaria':
+        event.listen(engine.pool, 'connect', lambda dbapi_connection, registro: circuito_db.exito())
+
+
+@event.listens_for(Engine, "handle_error")
+def _al_error_de_base(contexto):
+    # Sólo las fallas de conectividad de la primaria cuentan para el circuito
+    # (no un error de SQL ni un timeout de sentencia)
+    if contexto.engine is None or _nombre_pool(contexto.engine.pool) != 'primaria':
+        return
+    if contexto.is_disconnect or contexto.connection is None:
+        circuito_db.fallo()
+
+
+# Último sondeo de la primaria (lo lee /health sin tocar la base)
+estado_sondeo = {'ok': None, 'en': None, 'latencia_ms': None, 'error': None}
+
+
+def sondear_base():
+    """SELECT 1 contra la primaria aunque el circuito esté abierto; None o la excepción."""
+    inicio = time.perf_counter()
+    _sondeo.activo = True
+    try:
+        with db.engine.connect() as conexion:
+            conexion.execute(db.text("SELECT 1"))
+    except OperationalError as e:
+        estado_sondeo.update(ok=False, en=time.time(), latencia_ms=None, error=str(e.orig).strip())
+        return e
+    finally:
+        _sondeo.activo = False
+    circuito_db.exito()
+    estado_sondeo.update(ok=True, en=time.time(), latencia_ms=round((time.perf_counter() - inicio) * 1000, 1),
+                         error=None)
+    return None
+
+
+_vigilante_pid = None
+
+
+def _bucle_vigilante():
+    with app.app_context():
+        while True:
+            try:
+                sondear_base()
+                replicas.verificar()
+            except Exception:
+                app.logger.exception("Error en el sondeo de la base")
+            time.sleep(DB_SONDEO)
+
+
+def iniciar_vigilante_db():
+    """Arranca el hilo de sondeo en este proceso (uno por worker de gunicorn)."""
+    global _vigilante_pid
+    if _vigilante_pid == os.getpid() or DB_SONDEO <= 0:
+        return
+    _vigilante_pid = os.getpid()
+    threading.Thread(target=_bucle_vigilante, name="vigilante-db", daemon=True).start()
+
+
+@app.before_request
+def _asegurar_vigilante_db():
+    iniciar_vigilante_db()
+
+
+def estado_pools():
+    """{nombre: {...}} con el estado de cada pool, sin consultar la base."""
+    estado = {}
+    for clave, engine in db.engines.items():
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        estado[_nombre_pool(pool)] = {
+            "tamano": pool.size(),
+            "prestadas": pool.checkedout(),
+            "libres": pool.checkedin(),
+            "overflow": max(0, pool.overflow()),
+        }
+    return estado
+
+
+def _medidores_pool():
+    if not has_app_context() or 'sqlalchemy' not in app.extensions:
+        return {}
+    medidores = {}
+    for nombre, estado in estado_pools().items():
+        medidores[('db_pool_checked_out', nombre)] = estado["prestadas"]
+        medidores[('db_pool_idle', nombre)] = estado["libres"]
+        medidores[('db_pool_overflow', nombre)] = estado["overflow"]
+    medidores[('db_circuit_open', 'primaria')] = 1 if circuito_db.restante() else 0
+    return medidores
+
+
+@app.errorhandler(BaseDeDatosNoDisponible)
+def handle_db_no_disponible(e):
+    return ("Servicio temporalmente no disponible por problemas con la base de datos. Por favor intenta más tarde.",
+            503, {'Retry-After': str(max(1, int(e.reintentar_en + 0.5)))})
+
+
+@app.after_request
+def _recordar_escritura(respuesta):
+    # Read-after-write: tras un POST/PUT/DELETE el usuario lee de la primaria un rato
+    if replicas.configuradas and request.method not in _METODOS_SEGUROS:
+        session['_primaria_hasta'] = time.time() + REPLICA_PEGAJOSA
+    return respuesta
 
 
 @app.errorhandler(OperationalError)
@@ -144,33 +643,733 @@ app.config.update(
     REMEMBER_COOKIE_HTTPONLY=True
 )
 
+# --- Sesiones del lado del servidor -------------------------------------------
+# Con SESIONES_BACKEND distinto de 'cookie' la cookie de sesión lleva sólo un id
+# aleatorio y el contenido (Flask-Login, mensajes flash, _primaria_hasta) vive
+# en un almacén, codificado en binario compacto:
+#   memoria  - por worker, con TTL; sólo sirve con un único worker
+#   archivos - un archivo por sesión en SESIONES_DIR, compartido por los workers
+#   db       - tabla sesion (UNLOGGED en Postgres), compartida entre instancias
+# La sesión se lee del almacén recién cuando alguien la usa (estáticos, /health
+# y /metrics no lo tocan) y se escribe sólo si cambió o pasó la mitad del TTL.
+# Las vencidas se borran por lotes (ver purgar_sesiones).
+SESIONES_BACKEND = os.environ.get("SESIONES_BACKEND", "cookie")  # cookie/memoria/archivos/db
+SESIONES_TTL = int(os.environ.get("SESIONES_TTL", "86400"))  # segundos de inactividad
+SESIONES_DIR = os.environ.get("SESIONES_DIR", "/tmp/viajes-sesiones")
+SESIONES_LOTE_PURGA = int(os.environ.get("SESIONES_LOTE_PURGA", "500"))
+SESIONES_PURGA_CADA = float(os.environ.get("SESIONES_PURGA_CADA", "60"))
+
+_SESION_MARSHAL = b'm'
+_OMITIR = object()
+
+def directorio_privado(ruta):
+    """Crea (o revisa) un directorio sólo para el usuario del proceso.
+
+    Los almacenes en archivos viven por defecto bajo /tmp: si otro usuario
+    local lo hubiera creado antes podría plantar o leer archivos, así que se
+    exige que sea nuestro (y no un symlink) y se le quitan los permisos de
+    grupo y otros.
+    """
+    os.makedirs(ruta, mode=0o700, exist_ok=True)
+    info = os.lstat(ruta)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise RuntimeError(f"{ruta} no es un directorio propio de este usuario; elige otra ruta")
+    if info.st_mode & 0o077:
+        os.chmod(ruta, 0o700)
+    return ruta
+
+def _a_tipos_basicos(valor):
+    """Lo que marshal sabe guardar; subclases de str (Markup) como str, _OMITIR si no se puede."""
+    if valor is None or type(valor) in (bool, int, float, str, bytes):
+        return valor
+    if isinstance(valor, str):
+        # Un Markup en un flash vuelve como texto y se escapa al mostrarse
+        return str(valor)
+    if isinstance(valor, (list, tuple)):
+        elementos = [_a_tipos_basicos(v) for v in valor]
+        if any(e is _OMITIR for e in elementos):
+            return _OMITIR
+        return elementos if isinstance(valor, list) else tuple(elementos)
+    if isinstance(valor, dict):
+        return {k: v for k, v in ((k, _a_tipos_basicos(v)) for k, v in valor.items()) if v is not _OMITIR}
+    return _OMITIR
+
+def codificar_sesion(datos):
+    """marshal de los tipos básicos. Nunca pickle: un almacén compartido (archivos,
+    tabla) no debe poder ejecutar código al leerse. Las claves con otros tipos se
+    descartan."""
+    basicos = _a_tipos_basicos(dict(datos))
+    for clave in datos.keys() - basicos.keys():
+        app.logger.warning("Sesión: se descarta %r (%s no se puede guardar)", clave, type(datos[clave]).__name__)
+    return _SESION_MARSHAL + marshal.dumps(basicos, 4)
+
+def decodificar_sesion(binario):
+    """None si no se reconocen (p. ej. sesiones escritas con pickle por versiones anteriores)."""
+    if binario[:1] != _SESION_MARSHAL:
+        return None
+    try:
+        datos = marshal.loads(binario[1:])
+    except (ValueError, EOFError, TypeError):
+        return None
+    return datos if isinstance(datos, dict) else None
+
+
+class AlmacenSesionesMemoria:
+    """Sesiones en memoria del worker, en orden de última escritura."""
+
+    def __init__(self):
+        self._sesiones = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cargar(self, clave):
+        with self._lock:
+            entrada = self._sesiones.get(clave)
+        return entrada if entrada is not None and entrada[0] > time.time() else None
+
+    def guardar(self, clave, datos, expira):
+        with self._lock:
+            self._sesiones[clave] = (expira, datos)
+            self._sesiones.move_to_end(clave)
+
+    def borrar(self, clave):
+        with self._lock:
+            self._sesiones.pop(clave, None)
+
+    def purgar(self, ahora, lote):
+        # El TTL es fijo: las vencidas están todas al principio
+        borradas = 0
+        with self._lock:
+            while borradas < lote and self._sesiones:
+                clave, (expira, _) = next(iter(self._sesiones.items()))
+                if expira > ahora:
+                    break
+                del self._sesiones[clave]
+                borradas += 1
+        return borradas
+
+
+class AlmacenSesionesArchivos:
+    """Un archivo por sesión; el vencimiento es su mtime."""
+
+    def __init__(self, directorio):
+        self.directorio = directorio_privado(directorio)
+
+    def cargar(self, clave):
+        try:
+            with open(os.path.join(self.directorio, clave), 'rb') as f:
+                expira = os.fstat(f.fileno()).st_mtime
+                datos = f.read()
+        except OSError:
+            return None
+        return (expira, datos) if expira > time.time() else None
+
+    def guardar(self, clave, datos, expira):
+        ruta = os.path.join(self.directorio, clave)
+        tmp = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(datos)
+        os.utime(tmp, (expira, expira))
+        os.replace(tmp, ruta)
+
+    def borrar(self, clave):
+        try:
+            os.remove(os.path.join(self.directorio, clave))
+        except OSError:
+            pass
+
+    def purgar(self, ahora, lote):
+        borradas = 0
+        with os.scandir(self.directorio) as entradas:
+            for entrada in entradas:
+                if borradas >= lote:
+                    break
+                try:
+                    # Un .tmp huérfano (worker muerto a mitad de escritura) también vence
+                    if entrada.stat().st_mtime < ahora:
+                        os.remove(entrada.path)
+                        borradas += 1
+                except OSError:
+                    pass
+        return borradas
+
+
+class Sesion(db.Model):
+    # En Postgres la tabla es UNLOGGED (ver la migración): no pasa por el WAL y
+    # se vacía tras una caída, lo que para sesiones es aceptable
+    __tablename__ = 'sesion'
+    id = db.Column(db.String(32), primary_key=True)  # hash del id de la cookie
+    datos = db.Column(db.LargeBinary, nullable=False)
+    expira = db.Column(db.Float, nullable=False)  # epoch en segundos
+    __table_args__ = (
+        db.Index('ix_sesion_expira', 'expira'),
+    )
+
+
+class AlmacenSesionesBaseDatos:
+    """Sesiones en la tabla sesion, con conexiones propias de la primaria (como LimitadorBaseDatos)."""
+
+    def cargar(self, clave):
+        with db.engine.connect() as conexion:
+            fila = conexion.execute(
+                db.select(Sesion.expira, Sesion.datos).where(Sesion.id == clave, Sesion.expira > time.time())
+            ).first()
+        return tuple(fila) if fila else None
+
+    def guardar(self, clave, datos, expira):
+        with db.engine.begin() as conexion:
+            conexion.execute(db.text(
+                "INSERT INTO sesion (id, datos, expira) VALUES (:id, :datos, :expira) "
+                "ON CONFLICT (id) DO UPDATE SET datos = excluded.datos, expira = excluded.expira"
+            ), {"id": clave, "datos": datos, "expira": expira})
+
+    def borrar(self, clave):
+        with db.engine.begin() as conexion:
+            conexion.execute(db.delete(Sesion).where(Sesion.id == clave))
+
+    def purgar(self, ahora, lote):
+        with db.engine.begin() as conexion:
+            return conexion.execute(db.delete(Sesion).where(Sesion.id.in_(
+                db.select(Sesion.id).where(Sesion.expira < ahora).limit(lote)
+            ))).rowcount
+
+
+class SesionServidor(SessionMixin):
+    """Sesión cuyo contenido está en un almacén; se carga en el primer acceso."""
+
+    def __init__(self, interfaz, sid):
+        self._interfaz = interfaz
+        self.sid = sid
+        self.sid_anterior = None  # a borrar del almacén al guardar (id rechazado o regenerado)
+        self.expira = None
+        self.modified = False
+        self.accessed = False
+        self._datos = None
+
+    @property
+    def cargada(self):
+        return self._datos is not None
+
+    def _cargar(self):
+        if self._datos is None:
+            self.accessed = True
+            self._datos, self.expira = self._interfaz.leer(self.sid)
+            if self.expira is None and self.sid:
+                # Id vencido o desconocido: nunca reutilizar un id que eligió el cliente
+                self.sid_anterior, self.sid = self.sid, None
+        return self._datos
+
+    def __getitem__(self, clave):
+        return self._cargar()[clave]
+
+    def __setitem__(self, clave, valor):
+        self._cargar()[clave] = valor
+        self.modified = True
+
+    def __delitem__(self, clave):
+        del self._cargar()[clave]
+        self.modified = True
+
+    def __contains__(self, clave):
+        # Flask-Login pregunta por '_remember' en cada respuesta; esa clave sólo
+        # existe dentro del request que la puso, así que no hace falta cargar
+        if self._datos is None and clave == '_remember':
+            return False
+        return clave in self._cargar()
+
+    def __iter__(self):
+        return iter(self._cargar())
+
+    def __len__(self):
+        return len(self._cargar())
+
+    def regenerar(self):
+        """Cambia el id conservando el contenido (tras iniciar sesión, contra la fijación de sesión)."""
+        self._cargar()
+        if self.sid:
+            self.sid_anterior, self.sid = self.sid, None
+        self.modified = True
+
+
+class InterfazSesionesServidor(SessionInterface):
+    LARGO_ID = 43  # secrets.token_urlsafe(32)
+
+    def __init__(self, almacen, ttl):
+        self.almacen = almacen
+        self.ttl = ttl
+        self._proxima_purga = 0.0
+
+    @staticmethod
+    def _clave(sid):
+        # El almacén guarda un hash: leerlo no permite suplantar sesiones
+        return hashlib.blake2b(sid.encode('ascii'), digest_size=16).hexdigest()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid is not None and (len(sid) != self.LARGO_ID or not sid.isascii()):
+            sid = None
+        return SesionServidor(self, sid)
+
+    def leer(self, sid):
+        """(datos, vencimiento) de la sesión; ({}, None) si no existe o el almacén falla."""
+        if not sid:
+            return {}, None
+        try:
+            entrada = self.almacen.cargar(self._clave(sid))
+        except (BaseDeDatosNoDisponible, OperationalError, OSError) as e:
+            app.logger.warning("No se pudo leer la sesión: %s", e)
+            return {}, None
+        datos = decodificar_sesion(entrada[1]) if entrada else None
+        return (datos, entrada[0]) if isinstance(datos, dict) else ({}, None)
+
+    def save_session(self, app, session, response):
+        if not session.cargada:
+            return
+        response.vary.add("Cookie")
+        nombre = self.get_cookie_name(app)
+        opciones = dict(domain=self.get_cookie_domain(app), path=self.get_cookie_path(app),
+                        secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app),
+                        httponly=self.get_cookie_httponly(app), partitioned=self.get_cookie_partitioned(app))
+        ahora = time.time()
+        try:
+            if session.sid_anterior:
+                self.almacen.borrar(self._clave(session.sid_anterior))
+            if not session:
+                if session.sid or session.sid_anterior:
+                    if session.sid:
+                        self.almacen.borrar(self._clave(session.sid))
+                    response.delete_cookie(nombre, **opciones)
+                return
+            if session.modified or session.sid is None or session.expira - ahora < self.ttl / 2:
+                nueva = session.sid is None
+                if nueva:
+                    session.sid = secrets.token_urlsafe(32)
+                self.almacen.guardar(self._clave(session.sid), codificar_sesion(session._datos), ahora + self.ttl)
+                if nueva or (session.permanent and app.config["SESSION_REFRESH_EACH_REQUEST"]):
+                    response.set_cookie(nombre, session.sid, expires=self.get_expiration_time(app, session),
+                                        **opciones)
+            if ahora >= self._proxima_purga:
+                self._proxima_purga = ahora + SESIONES_PURGA_CADA
+                self.almacen.purgar(ahora, SESIONES_LOTE_PURGA)
+        except (BaseDeDatosNoDisponible, OperationalError, OSError) as e:
+            app.logger.warning("No se pudo guardar la sesión: %s", e)
+
+
+def crear_almacen_sesiones(backend):
+    if backend == "memoria":
+        return AlmacenSesionesMemoria()
+    if backend == "archivos":
+        return AlmacenSesionesArchivos(SESIONES_DIR)
+    if backend == "db":
+        return AlmacenSesionesBaseDatos()
+    raise ValueError(f"SESIONES_BACKEND desconocido: {backend!r} (cookie/memoria/archivos/db)")
+
+if SESIONES_BACKEND != "cookie":
+    app.session_interface = InterfazSesionesServidor(crear_almacen_sesiones(SESIONES_BACKEND), SESIONES_TTL)
+
+
+@user_logged_in.connect_via(app)
+def _regenerar_sesion(sender, user, **extra):
+    if isinstance(session._get_current_object(), SesionServidor):
+        session.regenerar()
+
+
+def purgar_sesiones():
+    """Borra todas las sesiones vencidas, por lotes. Devuelve cuántas borró."""
+    interfaz = app.session_interface
+    if not isinstance(interfaz, InterfazSesionesServidor):
+        return 0
+    total = 0
+    while True:
+        borradas = interfaz.almacen.purgar(time.time(), SESIONES_LOTE_PURGA)
+        total += borradas
+        if borradas < SESIONES_LOTE_PURGA:
+            return total
+
+@app.cli.command("purgar-sesiones")
+def purgar_sesiones_command():
+    """Borra las sesiones vencidas del almacén configurado (SESIONES_BACKEND)."""
+    click.echo(f"Sesiones vencidas borradas: {purgar_sesiones()}.")
+
+# Detrás de un proxy (Koyeb, nginx) la IP real del cliente llega en
+# X-Forwarded-For; sólo se confía en tantos saltos como proxies haya.
+PROXIES_CONFIABLES = int(os.environ.get("PROXIES_CONFIABLES", "0"))
+if PROXIES_CONFIABLES > 0:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXIES_CONFIABLES, x_proto=PROXIES_CONFIABLES)
+
 # Healthcheck simple para proveedores de despliegue
 @app.get("/health")
 def health():
-    return {"status": "ok"}, 200
+    # Sin consultas: el estado de la base sale del último sondeo y del pool
+    sondeo = dict(estado_sondeo)
+    if sondeo['en'] is not None:
+        sondeo['hace_s'] = round(time.time() - sondeo.pop('en'), 1)
+    else:
+        sondeo.pop('en')
+    base = {
+        "circuito": "abierto" if circuito_db.restante() else "cerrado",
+        "sondeo": sondeo,
+        "pools": estado_pools(),
+    }
+    if replicas.configuradas:
+        base["replicas"] = replicas.estado()
+    return {"status": "ok", "db": base}, 200
+
+# Instrumentación por request: consultas SQL, tiempo en DB, tiempo de render y
+# latencia total por endpoint, expuestos como histogramas Prometheus en /metrics.
+# Con METRICAS_DIR cada worker vuelca su snapshot allí y /metrics suma todos.
+METRICAS_ACTIVAS = os.environ.get("METRICAS", "1") == "1"
+METRICAS_TOKEN = os.environ.get("METRICAS_TOKEN", "")
+METRICAS_DIR = os.environ.get("METRICAS_DIR", "")
+METRICAS_SERVER_TIMING = os.environ.get("METRICAS_SERVER_TIMING", "0") == "1"
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", "200"))
+
+HISTOGRAMAS = {
+    'http_request_duration_seconds': ('Latencia total por request',
+                                      (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+    'db_queries_per_request': ('Consultas SQL por request', (0, 1, 2, 3, 5, 8, 13, 21, 50)),
+    'db_time_seconds': ('Tiempo en la base de datos por request',
+                        (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)),
+    'template_render_seconds': ('Tiempo de render de plantillas por request',
+                                (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)),
+    'db_pool_wait_seconds': ('Espera por una conexión del pool',
+                             (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)),
+}
+# Etiqueta de cada serie cuando no es la de por defecto (endpoint en los
+# histogramas, pool en contadores y medidores)
+ETIQUETAS_METRICAS = {
+    'db_pool_wait_seconds': 'pool',
+    'http_compressed_responses_total': 'encoding',
+    'http_compression_saved_bytes_total': 'encoding',
+}
+
+# Contadores y medidores (gauges) del pool, etiquetados por pool (primaria, replica0...)
+CONTADORES = {
+    'db_pool_timeouts_total': 'Esperas por conexión que agotaron pool_timeout',
+    'db_pool_invalidations_total': 'Conexiones invalidadas (caídas, ping fallido)',
+    'db_circuit_opens_total': 'Veces que se abrió el circuito de la base',
+    'db_circuit_rejections_total': 'Pedidos de conexión rechazados con el circuito abierto',
+    'http_compressed_responses_total': 'Respuestas comprimidas, por codificación',
+    'http_compression_saved_bytes_total': 'Bytes ahorrados al comprimir respuestas, por codificación',
+}
+MEDIDORES = {
+    'db_pool_checked_out': 'Conexiones prestadas',
+    'db_pool_idle': 'Conexiones libres en el pool',
+    'db_pool_overflow': 'Conexiones por encima de pool_size',
+    'db_circuit_open': 'Workers con el circuito de la base abierto',
+}
+
+
+class RegistroMetricas:
+    """Histogramas y contadores acumulados por (métrica, endpoint) en este proceso."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._datos = {}  # (metrica, endpoint) -> [conteos por bucket..., suma, total] o [n]
+        self._volcado_en = 0.0
+
+    def contar(self, metrica, etiqueta, delta=1):
+        with self._lock:
+            serie = self._datos.setdefault((metrica, etiqueta), [0])
+            serie[0] += delta
+
+    def observar(self, metrica, endpoint, valor):
+        buckets = HISTOGRAMAS[metrica][1]
+        with self._lock:
+            serie = self._datos.get((metrica, endpoint))
+            if serie is None:
+                serie = self._datos[(metrica, endpoint)] = [0] * (len(buckets) + 2)
+            for i, limite in enumerate(buckets):
+                if valor <= limite:
+                    serie[i] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            datos = {f"{m}|{e}": list(v) for (m, e), v in self._datos.items()}
+        # Los medidores se toman al momento; sumados entre workers dan el total
+        for (m, e), valor in _medidores_pool().items():
+            datos[f"{m}|{e}"] = [valor]
+        return datos
+
+    def volcar(self, forzar=False):
+        """Escribe el snapshot de este worker en METRICAS_DIR (como mucho 1 vez/s)."""
+        ahora = time.monotonic()
+        if not METRICAS_DIR or (not forzar and ahora - self._volcado_en < 1.0):
+            return
+        primero = self._volcado_en == 0.0
+        self._volcado_en = ahora
+        os.makedirs(METRICAS_DIR, exist_ok=True)
+        ruta = os.path.join(METRICAS_DIR, f"worker-{os.getpid()}.json")
+        if primero and os.path.exists(ruta):
+            # PID reciclado: el archivo es de un worker anterior ya muerto
+            self._plegar_muertos(incluir=os.getpid())
+        with open(ruta + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(ruta + '.tmp', ruta)
+
+    @staticmethod
+    def _pid_vivo(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _plegar_muertos(self, incluir=None):
+        """Pasa a acumulado.json los contadores e histogramas de los workers que
+        ya no existen (reciclados por max_requests, caídos) y borra sus archivos.
+
+        Sus medidores se descartan: una conexión prestada o un circuito abierto
+        de un proceso muerto ya no existen. Así los contadores no bajan al
+        reciclar workers y los medidores sólo suman workers vivos.
+        """
+        import fcntl
+        muertos = []
+        for nombre in os.listdir(METRICAS_DIR):
+            if not (nombre.startswith('worker-') and nombre.endswith('.json')):
+                continue
+            try:
+                pid = int(nombre[len('worker-'):-len('.json')])
+            except ValueError:
+                continue
+            if pid == incluir or (pid != os.getpid() and not self._pid_vivo(pid)):
+                muertos.append(os.path.join(METRICAS_DIR, nombre))
+        if not muertos:
+            return
+        ruta_acumulado = os.path.join(METRICAS_DIR, 'acumulado.json')
+        with open(os.path.join(METRICAS_DIR, '.lock'), 'w') as candado:
+            fcntl.flock(candado, fcntl.LOCK_EX)
+            try:
+                with open(ruta_acumulado) as f:
+                    acumulado = json.load(f)
+            except (OSError, ValueError):
+                acumulado = {}
+            plegados = []
+            for ruta in muertos:
+                try:
+                    with open(ruta) as f:
+                        datos = json.load(f)
+                except FileNotFoundError:
+                    continue  # otro worker ya lo plegó
+                except (OSError, ValueError):
+                    datos = {}
+                for clave, serie in datos.items():
+                    if clave.split('|', 1)[0] in MEDIDORES:
+                        continue
+                    suma = acumulado.setdefault(clave, [0] * len(serie))
+                    for i, v in enumerate(serie):
+                        suma[i] += v
+                plegados.append(ruta)
+            with open(ruta_acumulado + '.tmp', 'w') as f:
+                json.dump(acumulado, f)
+            os.replace(ruta_acumulado + '.tmp', ruta_acumulado)
+            for ruta in plegados:
+                os.remove(ruta)
+
+    def combinado(self):
+        """Suma los snapshots de los workers vivos más lo acumulado de los que ya
+        terminaron (o sólo este proceso si no hay METRICAS_DIR)."""
+        if not METRICAS_DIR:
+            return self.snapshot()
+        self.volcar(forzar=True)
+        self._plegar_muertos()
+        total = {}
+        for nombre in os.listdir(METRICAS_DIR):
+            if not nombre.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(METRICAS_DIR, nombre)) as f:
+                    datos = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for clave, serie in datos.items():
+                acumulada = total.setdefault(clave, [0] * len(serie))
+                for i, v in enumerate(serie):
+                    acumulada[i] += v
+        return total
+
+    def exportar(self):
+        """Formato de exposición de texto de Prometheus."""
+        datos = self.combinado()
+        lineas = []
+        for metrica, (ayuda, buckets) in HISTOGRAMAS.items():
+            lineas.append(f"# HELP {metrica} {ayuda}")
+            lineas.append(f"# TYPE {metrica} histogram")
+            etiqueta = ETIQUETAS_METRICAS.get(metrica, 'endpoint')
+            for clave in sorted(k for k in datos if k.split('|', 1)[0] == metrica):
+                endpoint = clave.split('|', 1)[1].replace('\\', '\\\\').replace('"', '\\"')
+                serie = datos[clave]
+                for i, limite in enumerate(buckets):
+                    lineas.append(f'{metrica}_bucket{{{etiqueta}="{endpoint}",le="{limite}"}} {serie[i]}')
+                lineas.append(f'{metrica}_bucket{{{etiqueta}="{endpoint}",le="+Inf"}} {serie[-1]}')
+                lineas.append(f'{metrica}_sum{{{etiqueta}="{endpoint}"}} {serie[-2]}')
+                lineas.append(f'{metrica}_count{{{etiqueta}="{endpoint}"}} {serie[-1]}')
+        for tipo, definiciones in (('counter', CONTADORES), ('gauge', MEDIDORES)):
+            for metrica, ayuda in definiciones.items():
+                lineas.append(f"# HELP {metrica} {ayuda}")
+                lineas.append(f"# TYPE {metrica} {tipo}")
+                etiqueta = ETIQUETAS_METRICAS.get(metrica, 'pool')
+                for clave in sorted(k for k in datos if k.split('|', 1)[0] == metrica):
+                    lineas.append(f'{metrica}{{{etiqueta}="{clave.split("|", 1)[1]}"}} {datos[clave][0]}')
+        if replicas.configuradas:
+            estado = replicas.estado()
+            lineas.append("# HELP db_replica_up Réplica de lectura en rotación (1) o descartada (0)")
+            lineas.append("# TYPE db_replica_up gauge")
+            for r in estado:
+                lineas.append(f'db_replica_up{{replica="{r["nombre"]}"}} {int(r["sana"])}')
+            lineas.append("# HELP db_replica_lag_seconds Retraso de la réplica en el último chequeo")
+            lineas.append("# TYPE db_replica_lag_seconds gauge")
+            for r in estado:
+                if r["lag"] is not None:
+                    lineas.append(f'db_replica_lag_seconds{{replica="{r["nombre"]}"}} {r["lag"]:.3f}')
+        if tiempos_arranque:
+            lineas.append("# HELP app_startup_phase_seconds Duración de cada fase del último arranque")
+            lineas.append("# TYPE app_startup_phase_seconds gauge")
+            for fase, segundos in tiempos_arranque.items():
+                lineas.append(f'app_startup_phase_seconds{{phase="{fase}"}} {segundos:.6f}')
+        return '\n'.join(lineas) + '\n'
+
+
+metricas = RegistroMetricas()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _antes_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_inicio_consulta', []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _despues_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    inicios = conn.info.get('_inicio_consulta')
+    if not inicios:
+        return
+    duracion = time.perf_counter() - inicios.pop()
+    if has_request_context() and 'db_consultas' in g:
+        g.db_consultas += 1
+        g.db_tiempo += duracion
+    if duracion * 1000 >= DB_SLOW_QUERY_MS:
+        app.logger.warning("Consulta lenta (%.1f ms) en %s: %s", duracion * 1000,
+                           request.endpoint if has_request_context() else '-',
+                           ' '.join(statement.split())[:500])
+
+@before_render_template.connect_via(app)
+def _antes_de_render(sender, template, context, **extra):
+    g.render_inicio = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _despues_de_render(sender, template, context, **extra):
+    inicio = g.pop('render_inicio', None)
+    if inicio is not None:
+        g.plantilla_tiempo = g.get('plantilla_tiempo', 0.0) + time.perf_counter() - inicio
+
+@app.before_request
+def _iniciar_medicion():
+    g.request_inicio = time.perf_counter()
+    g.db_consultas = 0
+    g.db_tiempo = 0.0
+    g.plantilla_tiempo = 0.0
+
+@app.after_request
+def _registrar_medicion(response):
+    inicio = g.get('request_inicio')
+    if inicio is None or not METRICAS_ACTIVAS:
+        return response
+    total = time.perf_counter() - inicio
+    endpoint = request.endpoint or 'desconocido'
+    metricas.observar('http_request_duration_seconds', endpoint, total)
+    metricas.observar('db_queries_per_request', endpoint, g.db_consultas)
+    metricas.observar('db_time_seconds', endpoint, g.db_tiempo)
+    metricas.observar('template_render_seconds', endpoint, g.plantilla_tiempo)
+    metricas.volcar()
+    if METRICAS_SERVER_TIMING:
+        response.headers['Server-Timing'] = (
+            f'db;dur={g.db_tiempo * 1000:.1f};desc="{g.db_consultas} consultas", '
+            f'tpl;dur={g.plantilla_tiempo * 1000:.1f}, total;dur={total * 1000:.1f}'
+        )
+    return response
+
+@app.get("/metrics")
+def metrics():
+    if not METRICAS_ACTIVAS:
+        abort(404)
+    if METRICAS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICAS_TOKEN}":
+        abort(401)
+    return metricas.exportar(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 # Configuración de correo (Gmail)
 SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
 SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
 SMTP_USER = os.environ.get("SMTP_USER", "")  # tu correo gmail
 SMTP_PASS = os.environ.get("SMTP_PASS", "")  # App Password de Gmail
+# SMTP_TLS=false y SMTP_FROM permiten usar un servidor local de pruebas
+# (p. ej. `python -m aiosmtpd -n -l localhost:8025`) sin credenciales.
+SMTP_TLS = os.environ.get("SMTP_TLS", "true").lower() not in ("0", "false", "no")
+SMTP_FROM = os.environ.get("SMTP_FROM", SMTP_USER)
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", "20"))
+
+# Cola de correos salientes (outbox). Las vistas sólo insertan filas; un hilo
+# por worker (CORREO_HILO=1) o el comando `flask enviar-correos` los despacha.
+CORREO_HILO = os.environ.get("CORREO_HILO", "1") == "1"
+CORREO_LOTE = int(os.environ.get("CORREO_LOTE", "20"))
+CORREO_INTERVALO = float(os.environ.get("CORREO_INTERVALO", "15"))
+# Límite global. Cada proceso que despacha espacia sus envíos por separado, así
+# que el hilo de cada worker usa CORREO_MAX_POR_MINUTO / CORREO_PROCESOS
+# (gunicorn.conf.py exporta CORREO_PROCESOS con la cantidad de workers);
+# `flask enviar-correos` es un solo proceso y usa el límite entero.
+CORREO_MAX_POR_MINUTO = int(os.environ.get("CORREO_MAX_POR_MINUTO", "30"))
+CORREO_PROCESOS = max(1, int(os.environ.get("CORREO_PROCESOS", "1")))
+# Un lote tomado queda 'enviando' hasta este plazo; si el proceso muere a mitad,
+# los que no llegó a marcar vuelven a la cola al vencer (se pueden enviar dos veces)
+CORREO_PLAZO_LOTE = int(os.environ.get("CORREO_PLAZO_LOTE", "300"))  # segundos
+CORREO_MAX_INTENTOS = int(os.environ.get("CORREO_MAX_INTENTOS", "5"))
+CORREO_BACKOFF_BASE = int(os.environ.get("CORREO_BACKOFF_BASE", "30"))  # segundos
+SMTP_INACTIVIDAD_MAX = 60  # cerrar la conexión reutilizada tras este tiempo sin uso
 
 # Serializer para tokens de recuperación
 RESET_TOKEN_SALT = os.environ.get("RESET_TOKEN_SALT", "reset-password-salt")
 
 def _get_serializer():
+    # itsdangerous, smtplib y email se importan al usarse: no hacen falta para
+    # servir la mayoría de los requests y así no pesan en el arranque
+    from itsdangerous import URLSafeTimedSerializer
     return URLSafeTimedSerializer(app.secret_key)
 
-def send_reset_email(usuario, reset_url):
-    if not SMTP_USER or not SMTP_PASS:
-        # Si no hay credenciales configuradas, no intentamos enviar
-        print("SMTP_USER/SMTP_PASS no configurados; omitiendo envío de correo.")
+
+class CorreoSaliente(db.Model):
+    __tablename__ = 'correo_saliente'
+    id = db.Column(db.Integer, primary_key=True)
+    destinatario = db.Column(db.String(120), nullable=False)
+    asunto = db.Column(db.String(200), nullable=False)
+    texto = db.Column(db.Text, nullable=False)
+    html = db.Column(db.Text, nullable=True)
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente/enviando/enviado/fallido
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    # Pendiente: desde cuándo se puede enviar. Enviando: vencimiento del lote tomado.
+    proximo_intento = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    ultimo_error = db.Column(db.Text, nullable=True)
+    creado_en = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    enviado_en = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (
+        db.Index('ix_correo_saliente_pendientes', 'estado', 'proximo_intento'),
+    )
+
+
+def encolar_correo(destinatario, asunto, texto, html=None):
+    """Agrega un correo a la cola dentro de la transacción actual.
+
+    El correo sale sólo si la vista hace commit. Devuelve False si no hay
+    remitente configurado.
+    """
+    if not SMTP_FROM:
+        print("SMTP_USER/SMTP_FROM no configurados; omitiendo envío de correo.")
         return False
-    msg = EmailMessage()
-    msg["Subject"] = "Restablecer tu contraseña"
-    msg["From"] = SMTP_USER
-    # Usamos username como email registrado
-    msg["To"] = usuario.username
+    db.session.add(CorreoSaliente(destinatario=destinatario, asunto=asunto, texto=texto, html=html))
+    g.correos_encolados = True
+    return True
+
+def send_reset_email(usuario, reset_url):
     texto = (
         f"Hola,\n\nPara restablecer tu contraseña, haz clic en el siguiente enlace:\n{reset_url}\n\n"
         "Si no solicitaste este cambio, ignora este correo.\n"
@@ -181,54 +1380,450 @@ def send_reset_email(usuario, reset_url):
     <p><a href="{reset_url}">Restablecer contraseña</a></p>
     <p>Si no solicitaste este cambio, ignora este correo.</p>
     """
-    msg.set_content(texto)
-    msg.add_alternative(html, subtype="html")
-    try:
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as smtp:
+    # Usamos username como email registrado
+    return encolar_correo(usuario.username, "Restablecer tu contraseña", texto, html)
+
+def send_booking_email(reserva, viaje_nombre):
+    texto = (
+        f"Hola {reserva.nombre},\n\nTu reserva para \"{viaje_nombre}\" el {reserva.fecha:%d/%m/%Y} "
+        "quedó registrada.\n\nGracias por viajar con nosotros.\n"
+    )
+    html = f"""
+    <p>Hola {escape(reserva.nombre)},</p>
+    <p>Tu reserva para <strong>{escape(viaje_nombre)}</strong> el {reserva.fecha:%d/%m/%Y} quedó registrada.</p>
+    <p>Gracias por viajar con nosotros.</p>
+    """
+    return encolar_correo(reserva.email, "Confirmación de reserva", texto, html)
+
+def send_group_email(grupo, viaje_nombre, pasajeros):
+    texto = (
+        f"Hola,\n\nLa reserva del grupo \"{grupo.nombre}\" para \"{viaje_nombre}\" el "
+        f"{grupo.fecha:%d/%m/%Y} quedó registrada con {pasajeros} pasajeros.\n\n"
+        "Gracias por viajar con nosotros.\n"
+    )
+    html = f"""
+    <p>Hola,</p>
+    <p>La reserva del grupo <strong>{escape(grupo.nombre)}</strong> para <strong>{escape(viaje_nombre)}</strong>
+    el {grupo.fecha:%d/%m/%Y} quedó registrada con {pasajeros} pasajeros.</p>
+    <p>Gracias por viajar con nosotros.</p>
+    """
+    return encolar_correo(grupo.email, "Confirmación de reserva grupal", texto, html)
+
+
+class RemitenteSMTP:
+    """Conexión SMTP autenticada que se reutiliza entre mensajes y lotes."""
+
+    def __init__(self):
+        self._smtp = None
+        self._usado_en = 0.0
+
+    def _conectar(self):
+        import smtplib
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_TLS:
             smtp.starttls()
+        if SMTP_USER and SMTP_PASS:
             smtp.login(SMTP_USER, SMTP_PASS)
-            smtp.send_message(msg)
-        return True
-    except Exception as e:
-        print("Error enviando correo:", e)
-        return False
+        return smtp
+
+    def enviar(self, msg):
+        import smtplib
+        if self._smtp is not None and time.monotonic() - self._usado_en > SMTP_INACTIVIDAD_MAX:
+            self.cerrar()
+        # Un reintento si el servidor cerró la conexión reutilizada
+        for reintento in (False, True):
+            if self._smtp is None:
+                self._smtp = self._conectar()
+            try:
+                self._smtp.send_message(msg)
+                self._usado_en = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._smtp = None
+                if reintento:
+                    raise
+
+    def cerrar(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+
+class LimitadorEnvio:
+    """Espacia los envíos de este proceso a 'por_minuto' por minuto."""
+
+    def __init__(self, por_minuto):
+        self.intervalo = 60.0 / por_minuto if por_minuto > 0 else 0.0
+        self._siguiente = 0.0
+
+    def esperar(self):
+        ahora = time.monotonic()
+        if self._siguiente > ahora:
+            time.sleep(self._siguiente - ahora)
+        self._siguiente = max(ahora, self._siguiente) + self.intervalo
+
+
+def _construir_mensaje(correo):
+    from email.message import EmailMessage
+    msg = EmailMessage()
+    msg["Subject"] = correo.asunto
+    msg["From"] = SMTP_FROM
+    msg["To"] = correo.destinatario
+    msg.set_content(correo.texto)
+    if correo.html:
+        msg.add_alternative(correo.html, subtype="html")
+    return msg
+
+def _tomar_lote_correos():
+    """Marca como 'enviando' un lote de correos listos y hace commit.
+
+    Las filas se toman con FOR UPDATE SKIP LOCKED, así varios workers pueden
+    despachar la cola a la vez sin tomar el mismo correo. También se retoman
+    los lotes 'enviando' vencidos (su proceso murió a mitad). Devuelve los
+    mensajes ya armados, para enviarlos sin transacción abierta, y el plazo
+    con que quedaron marcados.
+    """
+    ahora = datetime.utcnow()
+    plazo = ahora + timedelta(seconds=CORREO_PLAZO_LOTE)
+    lote = (CorreoSaliente.query
+            .filter(CorreoSaliente.estado.in_(('pendiente', 'enviando')),
+                    CorreoSaliente.proximo_intento <= ahora)
+            .order_by(CorreoSaliente.id)
+            .limit(CORREO_LOTE)
+            .with_for_update(skip_locked=True)
+            .all())
+    tomados = []
+    for correo in lote:
+        correo.estado = 'enviando'
+        correo.proximo_intento = plazo
+        tomados.append((correo.id, correo.intentos, _construir_mensaje(correo)))
+    db.session.commit()
+    return tomados, plazo
+
+def _registrar_envio(correo_id, plazo, **valores):
+    """Guarda el resultado de un envío en su propio commit corto.
+
+    Sólo si el correo sigue tomado por este lote: si el plazo venció y otro
+    proceso lo retomó, el resultado es de ése.
+    """
+    db.session.execute(
+        db.update(CorreoSaliente)
+        .where(CorreoSaliente.id == correo_id,
+               CorreoSaliente.estado == 'enviando',
+               CorreoSaliente.proximo_intento == plazo)
+        .values(**valores)
+    )
+    db.session.commit()
+
+def procesar_correos(remitente, limitador):
+    """Envía un lote de correos pendientes. Devuelve cuántos se procesaron.
+
+    Ninguna transacción ni conexión del pool queda abierta durante el SMTP o
+    las esperas del limitador: el lote se toma y confirma antes de enviar, y
+    cada resultado se confirma apenas se conoce, así un fallo a mitad de lote
+    no reenvía los que ya salieron.
+    """
+    tomados, plazo = _tomar_lote_correos()
+    for correo_id, intentos, msg in tomados:
+        limitador.esperar()
+        try:
+            remitente.enviar(msg)
+        except Exception as e:
+            remitente.cerrar()
+            intentos += 1
+            app.logger.warning("Error enviando correo %s: %s", correo_id, e)
+            if intentos >= CORREO_MAX_INTENTOS:
+                _registrar_envio(correo_id, plazo, estado='fallido', intentos=intentos,
+                                 ultimo_error=str(e)[:500])
+            else:
+                espera = CORREO_BACKOFF_BASE * 2 ** (intentos - 1)
+                _registrar_envio(correo_id, plazo, estado='pendiente', intentos=intentos,
+                                 ultimo_error=str(e)[:500],
+                                 proximo_intento=datetime.utcnow() + timedelta(seconds=espera))
+        else:
+            _registrar_envio(correo_id, plazo, estado='enviado', enviado_en=datetime.utcnow())
+    return len(tomados)
+
+def _vaciar_cola(remitente, limitador):
+    with app.app_context():
+        try:
+            while procesar_correos(remitente, limitador) >= CORREO_LOTE:
+                pass
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception("Error procesando la cola de correos: %s", e)
+
+
+_despertar_correos = threading.Event()
+_hilo_correos_pid = None
+
+def _bucle_correos():
+    remitente = RemitenteSMTP()
+    limitador = LimitadorEnvio(CORREO_MAX_POR_MINUTO / CORREO_PROCESOS)
+    while True:
+        _despertar_correos.wait(CORREO_INTERVALO)
+        _despertar_correos.clear()
+        _vaciar_cola(remitente, limitador)
+
+def iniciar_hilo_correos():
+    """Arranca el despachador en este proceso (uno por worker de gunicorn)."""
+    global _hilo_correos_pid
+    if _hilo_correos_pid == os.getpid():
+        return
+    _hilo_correos_pid = os.getpid()
+    threading.Thread(target=_bucle_correos, name="despachador-correos", daemon=True).start()
+
+@app.before_request
+def _asegurar_hilo_correos():
+    if CORREO_HILO and SMTP_FROM:
+        iniciar_hilo_correos()
+
+@app.after_request
+def _avisar_correos_encolados(response):
+    # La vista ya hizo commit: despertar al despachador sin esperar el intervalo
+    if g.get('correos_encolados'):
+        _despertar_correos.set()
+    return response
+
+@app.cli.command("enviar-correos")
+@click.option("--una-vez", is_flag=True, help="Vaciar la cola y salir en lugar de quedar escuchando.")
+def enviar_correos_command(una_vez):
+    """Despacha la cola de correos salientes (alternativa a CORREO_HILO)."""
+    remitente = RemitenteSMTP()
+    limitador = LimitadorEnvio(CORREO_MAX_POR_MINUTO)
+    try:
+        while True:
+            _vaciar_cola(remitente, limitador)
+            if una_vez:
+                break
+            time.sleep(CORREO_INTERVALO)
+    finally:
+        remitente.cerrar()
 
 class Reserva(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), nullable=False)
-    fecha = db.Column(db.String(20), nullable=False)
+    fecha = db.Column(db.Date, nullable=False)
     mensaje = db.Column(db.Text, nullable=True)
     viaje_id = db.Column(db.Integer, db.ForeignKey('viaje.id'), nullable=False)
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'))
+    # Pasajero de una reserva grupal (ver GrupoReserva); None = reserva individual
+    grupo_id = db.Column(db.Integer, db.ForeignKey('grupo_reserva.id', ondelete='CASCADE'), nullable=True)
     viaje = db.relationship('Viaje', backref=db.backref('reservas', lazy=True))
     usuario = db.relationship('Usuario', backref='reservas')
+    grupo = db.relationship('GrupoReserva', backref=db.backref('pasajeros', lazy=True, passive_deletes=True))
+    __table_args__ = (
+        # Una reserva individual por usuario y fecha (ver crear_reserva; las
+        # reservas sin usuario y los pasajeros de grupos quedan fuera),
+        # inventario por salida, pasajeros por grupo y listados por id
+        db.Index('ux_reserva_usuario_fecha', 'usuario_id', 'fecha', unique=True,
+                 postgresql_where=db.text('usuario_id IS NOT NULL AND grupo_id IS NULL'),
+                 sqlite_where=db.text('usuario_id IS NOT NULL AND grupo_id IS NULL')),
+        db.Index('ix_reserva_viaje_fecha', 'viaje_id', 'fecha'),
+        db.Index('ix_reserva_grupo', 'grupo_id'),
+        db.Index('ix_reserva_id_desc', db.text('id DESC')),
+    )
+
+# Reserva grupal: la hace un agente (o un admin) para N pasajeros de una misma
+# salida. Cada pasajero es una fila de reserva con grupo_id; el grupo guarda el
+# contacto y se edita o cancela entero en una transacción (ver crear_grupo).
+class GrupoReserva(db.Model):
+    __tablename__ = 'grupo_reserva'
+    id = db.Column(db.Integer, primary_key=True)
+    nombre = db.Column(db.String(100), nullable=False)
+    email = db.Column(db.String(120), nullable=False)  # contacto del grupo
+    fecha = db.Column(db.Date, nullable=False)
+    mensaje = db.Column(db.Text, nullable=True)
+    viaje_id = db.Column(db.Integer, db.ForeignKey('viaje.id'), nullable=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    creado_en = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    viaje = db.relationship('Viaje')
+    usuario = db.relationship('Usuario')
+    __table_args__ = (
+        db.Index('ix_grupo_reserva_usuario', 'usuario_id', 'id'),
+    )
 
 # Modelo para viajes
 class Viaje(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(100), nullable=False)
     descripcion = db.Column(db.Text, nullable=False)
-    fecha = db.Column(db.String(20), nullable=True)
+    fecha = db.Column(db.Date, nullable=True)
     precio = db.Column(db.Numeric(10,2), nullable=True)
     imagen = db.Column(db.String(200), nullable=True)  # nombre de archivo de la imagen
+    cupos = db.Column(db.Integer, nullable=True)  # cupos por fecha; None = sin límite
+    # En Postgres existe además 'busqueda' (tsvector generado, ver buscar_viajes);
+    # no se mapea para que create_all siga funcionando en SQLite.
+    __table_args__ = (
+        db.Index('ix_viaje_precio', 'precio'),
+        db.Index('ix_viaje_fecha', 'fecha'),
+    )
+
+# Inventario de cupos por viaje y fecha. Las filas se crean la primera vez que
+# alguien reserva esa salida y el contador 'reservados' sólo se modifica con
+# UPDATE condicionales (ver reservar_cupo/liberar_cupo).
+class Disponibilidad(db.Model):
+    viaje_id = db.Column(db.Integer, db.ForeignKey('viaje.id', ondelete='CASCADE'), primary_key=True)
+    fecha = db.Column(db.Date, primary_key=True)
+    capacidad = db.Column(db.Integer, nullable=False)
+    reservados = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.CheckConstraint('reservados >= 0 AND reservados <= capacidad', name='ck_disponibilidad_cupos'),
+    )
+
+# Parámetros del hash de contraseñas (formato de Werkzeug, p. ej.
+# 'scrypt:32768:8:1' o 'pbkdf2:sha256:600000'). Los hashes guardados con otros
+# parámetros se regeneran en el siguiente login correcto.
+PASSWORD_HASH_METODO = os.environ.get("PASSWORD_HASH_METODO", "scrypt:32768:8:1")
+
+class PoliticaHash:
+    """Genera y verifica hashes con los parámetros configurados."""
+
+    def __init__(self, metodo):
+        self.metodo = metodo
+        self._ficticio = None
+
+    def generar(self, password):
+        return generate_password_hash(password, method=self.metodo)
+
+    def _hash_ficticio(self):
+        # Se calcula una vez por worker; su prefijo es además la forma canónica
+        # del método (Werkzeug completa los parámetros por defecto)
+        if self._ficticio is None:
+            self._ficticio = self.generar(os.urandom(16).hex())
+        return self._ficticio
+
+    def necesita_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self._hash_ficticio().split('$', 1)[0]
+
+    def verificar_ficticio(self, password):
+        """Mismo costo que verificar un usuario real, para usernames inexistentes."""
+        check_password_hash(self._hash_ficticio(), password)
+        return False
+
+
+politica_hash = PoliticaHash(PASSWORD_HASH_METODO)
 
 # models.py o en tu app.py si tienes todo junto
 class Usuario(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
-    rol = db.Column(db.String(20), nullable=False, default='usuario')  # 'usuario' o 'admin'
+    rol = db.Column(db.String(20), nullable=False, default='usuario')  # 'usuario', 'agente' o 'admin'
+    # Cuota de reservas (pasajeros incluidos); None = LIMITE_RESERVAS_POR_USUARIO
+    limite_reservas = db.Column(db.Integer, nullable=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = politica_hash.generar(password)
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
+    def hash_desactualizado(self):
+        return politica_hash.necesita_rehash(self.password_hash)
+
+# Caché de usuarios autenticados. load_user corre en cada request con sesión,
+# así que se guarda por worker una copia con lo que usan vistas y plantillas
+# (id, username, rol). Un cambio de contraseña o de rol incrementa la versión
+# global de usuario_version y los demás workers vacían su caché en la próxima
+# verificación (cada USUARIOS_VERSION_CHECK segundos).
+USUARIOS_CACHE_TTL = float(os.environ.get("USUARIOS_CACHE_TTL", "300"))
+USUARIOS_CACHE_MAX = int(os.environ.get("USUARIOS_CACHE_MAX", "2048"))
+USUARIOS_VERSION_CHECK = float(os.environ.get("USUARIOS_VERSION_CHECK", "5"))
+
+class UsuarioVersion(db.Model):
+    __tablename__ = 'usuario_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class UsuarioSesion(UserMixin):
+    """Copia de sólo lectura del usuario autenticado (current_user), sin sesión de SQLAlchemy."""
+
+    def __init__(self, usuario):
+        self.id = usuario.id
+        self.username = usuario.username
+        self.rol = usuario.rol
+
+    def __repr__(self):
+        return f"<UsuarioSesion {self.id} {self.username!r}>"
+
+
+class CacheUsuarios:
+    """LRU con TTL de UsuarioSesion por id, invalidada con usuario_version."""
+
+    def __init__(self, ttl, max_entradas, version_check):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.version_check = version_check
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._verificado_en = 0.0
+
+    def _leer_version(self):
+        try:
+            with en_primaria():
+                fila = db.session.get(UsuarioVersion, 1)
+            return fila.version if fila else 0
+        except ProgrammingError as e:
+            # Tabla aún sin migrar: confiamos sólo en el TTL
+            db.session.rollback()
+            app.logger.warning("No se pudo leer usuario_version: %s", e)
+            return None
+
+    def _verificar_version(self):
+        ahora = time.monotonic()
+        if ahora - self._verificado_en < self.version_check:
+            return
+        version = self._leer_version()
+        with self._lock:
+            if version is None or version != self._version:
+                self._datos.clear()
+            self._version = version
+            self._verificado_en = ahora
+
+    def obtener(self, usuario_id):
+        self._verificar_version()
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._datos.get(usuario_id)
+            if entrada is not None and entrada[1] > ahora:
+                self._datos.move_to_end(usuario_id)
+                return entrada[0]
+        # Un cambio de rol recién hecho todavía puede no estar en la réplica
+        with en_primaria():
+            usuario = db.session.get(Usuario, usuario_id)
+        if usuario is None:
+            return None
+        copia = UsuarioSesion(usuario)
+        with self._lock:
+            self._datos[usuario_id] = (copia, ahora + self.ttl)
+            self._datos.move_to_end(usuario_id)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+        return copia
+
+    def invalidar(self, usuario_id):
+        """Llamar antes del commit que cambia la contraseña o el rol del usuario."""
+        actualizado = (UsuarioVersion.query
+                       .filter_by(id=1)
+                       .update({UsuarioVersion.version: UsuarioVersion.version + 1},
+                               synchronize_session=False))
+        if not actualizado:
+            db.session.add(UsuarioVersion(id=1, version=1))
+        with self._lock:
+            self._datos.pop(usuario_id, None)
+
+
+usuarios_cache = CacheUsuarios(USUARIOS_CACHE_TTL, USUARIOS_CACHE_MAX, USUARIOS_VERSION_CHECK)
 
 @login_manager.user_loader
 def load_user(user_id):
     try:
-        return Usuario.query.get(int(user_id))
+        return usuarios_cache.obtener(int(user_id))
     except OperationalError as e:
         # DB temporarily unavailable (SSL/network); return None so Flask-Login treats user as anonymous
         # and avoid raising a 500 on page loads. The error is logged for diagnostics.
@@ -238,8 +1833,788 @@ def load_user(user_id):
         app.logger.exception("Unexpected error in load_user: %s", e)
         return None
 
+# Estadísticas precalculadas para el dashboard. Se mantienen con eventos de los
+# modelos dentro del mismo flush que crea/borra la fila, así que siempre
+# coinciden con lo confirmado. Los contadores globales se reparten en
+# fragmentos para que reservas concurrentes no compitan por una sola fila.
+ESTADISTICA_FRAGMENTOS = 8
+
+class EstadisticaContador(db.Model):
+    __tablename__ = 'estadistica_contador'
+    clave = db.Column(db.String(40), primary_key=True)  # viajes/reservas/usuarios
+    fragmento = db.Column(db.SmallInteger, primary_key=True)
+    valor = db.Column(db.BigInteger, nullable=False, default=0)
+
+class EstadisticaViajeDia(db.Model):
+    __tablename__ = 'estadistica_viaje_dia'
+    viaje_id = db.Column(db.Integer, db.ForeignKey('viaje.id', ondelete='CASCADE'), primary_key=True)
+    fecha = db.Column(db.Date, primary_key=True)
+    reservas = db.Column(db.Integer, nullable=False, default=0)
+
+
+def _sumar_contador(conexion, clave, delta):
+    conexion.execute(db.text(
+        "INSERT INTO estadistica_contador (clave, fragmento, valor) VALUES (:clave, :fragmento, :delta) "
+        "ON CONFLICT (clave, fragmento) DO UPDATE SET valor = estadistica_contador.valor + excluded.valor"
+    ), {"clave": clave, "fragmento": random.randrange(ESTADISTICA_FRAGMENTOS), "delta": delta})
+
+def _sumar_viaje_dia(conexion, viaje_id, fecha, delta):
+    conexion.execute(db.text(
+        "INSERT INTO estadistica_viaje_dia (viaje_id, fecha, reservas) VALUES (:viaje_id, :fecha, :delta) "
+        "ON CONFLICT (viaje_id, fecha) DO UPDATE SET reservas = estadistica_viaje_dia.reservas + excluded.reservas"
+    ), {"viaje_id": viaje_id, "fecha": fecha, "delta": delta})
+
+@event.listens_for(Reserva, 'after_insert')
+def _estadisticas_reserva_creada(mapper, conexion, reserva):
+    _sumar_contador(conexion, 'reservas', 1)
+    _sumar_viaje_dia(conexion, reserva.viaje_id, reserva.fecha, 1)
+
+@event.listens_for(Reserva, 'after_delete')
+def _estadisticas_reserva_eliminada(mapper, conexion, reserva):
+    _sumar_contador(conexion, 'reservas', -1)
+    _sumar_viaje_dia(conexion, reserva.viaje_id, reserva.fecha, -1)
+
+@event.listens_for(Reserva, 'after_update')
+def _estadisticas_reserva_movida(mapper, conexion, reserva):
+    estado = db.inspect(reserva)
+    viaje_hist = estado.attrs.viaje_id.history
+    fecha_hist = estado.attrs.fecha.history
+    if not viaje_hist.has_changes() and not fecha_hist.has_changes():
+        return
+    viaje_anterior = viaje_hist.deleted[0] if viaje_hist.deleted else reserva.viaje_id
+    fecha_anterior = fecha_hist.deleted[0] if fecha_hist.deleted else reserva.fecha
+    _sumar_viaje_dia(conexion, viaje_anterior, fecha_anterior, -1)
+    _sumar_viaje_dia(conexion, reserva.viaje_id, reserva.fecha, 1)
+
+@event.listens_for(Viaje, 'after_insert')
+def _estadisticas_viaje_creado(mapper, conexion, viaje):
+    _sumar_contador(conexion, 'viajes', 1)
+
+@event.listens_for(Viaje, 'after_delete')
+def _estadisticas_viaje_eliminado(mapper, conexion, viaje):
+    _sumar_contador(conexion, 'viajes', -1)
+    conexion.execute(db.delete(EstadisticaViajeDia).where(EstadisticaViajeDia.viaje_id == viaje.id))
+
+@event.listens_for(Usuario, 'after_insert')
+def _estadisticas_usuario_creado(mapper, conexion, usuario):
+    _sumar_contador(conexion, 'usuarios', 1)
+
+@event.listens_for(Usuario, 'after_delete')
+def _estadisticas_usuario_eliminado(mapper, conexion, usuario):
+    _sumar_contador(conexion, 'usuarios', -1)
+
+
+# Fechas reservadas por cada usuario: una fila por (usuario, mes) con un bit por
+# día (bit 0 = día 1). La mantienen los eventos de Reserva en la misma
+# transacción que la escritura; con ella la regla "una reserva por fecha" y el
+# calendario del formulario son una lectura por clave primaria. Los pasajeros de
+# grupos no cuentan: el agente no viaja. Los cupos restantes por salida salen
+# de Disponibilidad.
+class CalendarioUsuario(db.Model):
+    __tablename__ = 'calendario_usuario'
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id', ondelete='CASCADE'), primary_key=True)
+    mes = db.Column(db.Date, primary_key=True)  # primer día del mes
+    dias = db.Column(db.Integer, nullable=False, default=0)
+
+
+def _bit_dia(fecha):
+    return 1 << (fecha.day - 1)
+
+def _marcar_dias_usuario(conexion, usuario_id, mes, bits):
+    conexion.execute(db.text(
+        "INSERT INTO calendario_usuario (usuario_id, mes, dias) VALUES (:usuario_id, :mes, :bits) "
+        "ON CONFLICT (usuario_id, mes) DO UPDATE SET dias = calendario_usuario.dias | excluded.dias"
+    ), {"usuario_id": usuario_id, "mes": mes, "bits": bits})
+
+def _desmarcar_dia_usuario(conexion, usuario_id, fecha):
+    """Apaga el bit del día si al usuario ya no le queda ninguna reserva esa fecha."""
+    conexion.execute(db.text(
+        "UPDATE calendario_usuario SET dias = dias & ~:bit "
+        "WHERE usuario_id = :usuario_id AND mes = :mes AND NOT EXISTS ("
+        "SELECT 1 FROM reserva WHERE usuario_id = :usuario_id AND fecha = :fecha AND grupo_id IS NULL)"
+    ), {"usuario_id": usuario_id, "mes": fecha.replace(day=1), "fecha": fecha, "bit": _bit_dia(fecha)})
+
+@event.listens_for(Reserva, 'after_insert')
+def _calendario_reserva_creada(mapper, conexion, reserva):
+    if reserva.usuario_id is not None and reserva.grupo_id is None:
+        _marcar_dias_usuario(conexion, reserva.usuario_id, reserva.fecha.replace(day=1), _bit_dia(reserva.fecha))
+
+@event.listens_for(Reserva, 'after_delete')
+def _calendario_reserva_eliminada(mapper, conexion, reserva):
+    if reserva.usuario_id is not None and reserva.grupo_id is None:
+        _desmarcar_dia_usuario(conexion, reserva.usuario_id, reserva.fecha)
+
+@event.listens_for(Reserva, 'after_update')
+def _calendario_reserva_movida(mapper, conexion, reserva):
+    estado = db.inspect(reserva)
+    usuario_hist = estado.attrs.usuario_id.history
+    fecha_hist = estado.attrs.fecha.history
+    if not usuario_hist.has_changes() and not fecha_hist.has_changes():
+        return
+    usuario_anterior = usuario_hist.deleted[0] if usuario_hist.deleted else reserva.usuario_id
+    fecha_anterior = fecha_hist.deleted[0] if fecha_hist.deleted else reserva.fecha
+    if usuario_anterior is not None and reserva.grupo_id is None:
+        _desmarcar_dia_usuario(conexion, usuario_anterior, fecha_anterior)
+    _calendario_reserva_creada(mapper, conexion, reserva)
+
+
+def recalcular_calendarios():
+    """Reconstruye calendario_usuario desde las reservas."""
+    bits = {}
+    for usuario_id, fecha in db.session.execute(
+        db.select(Reserva.usuario_id, Reserva.fecha)
+        .where(Reserva.usuario_id.is_not(None), Reserva.grupo_id.is_(None)).distinct()
+    ):
+        clave = (usuario_id, fecha.replace(day=1))
+        bits[clave] = bits.get(clave, 0) | _bit_dia(fecha)
+    db.session.execute(db.delete(CalendarioUsuario))
+    if bits:
+        db.session.execute(db.insert(CalendarioUsuario), [
+            {"usuario_id": usuario_id, "mes": mes, "dias": dias} for (usuario_id, mes), dias in bits.items()
+        ])
+    db.session.commit()
+    return len(bits)
+
+@app.cli.command("recalcular-calendarios")
+def recalcular_calendarios_command():
+    """Reconstruye los calendarios de fechas reservadas por usuario."""
+    click.echo(f"Calendarios recalculados: {recalcular_calendarios()} meses.")
+
+
+def dias_reservados(usuario_id, mes):
+    """Máscara de bits de los días de 'mes' en que el usuario tiene reserva."""
+    return db.session.execute(
+        db.select(CalendarioUsuario.dias)
+        .where(CalendarioUsuario.usuario_id == usuario_id, CalendarioUsuario.mes == mes)
+    ).scalar() or 0
+
+
+def recalcular_estadisticas():
+    """Reconstruye las tablas de estadísticas desde cero (tras cargas masivas o para reparar)."""
+    db.session.execute(db.delete(EstadisticaContador))
+    db.session.execute(db.delete(EstadisticaViajeDia))
+    for clave, tabla in (('viajes', 'viaje'), ('reservas', 'reserva'), ('usuarios', 'usuario')):
+        db.session.execute(db.text(
+            f"INSERT INTO estadistica_contador (clave, fragmento, valor) SELECT '{clave}', 0, COUNT(*) FROM {tabla}"
+        ))
+    db.session.execute(db.text(
+        "INSERT INTO estadistica_viaje_dia (viaje_id, fecha, reservas) "
+        "SELECT viaje_id, fecha, COUNT(*) FROM reserva GROUP BY viaje_id, fecha"
+    ))
+    db.session.commit()
+
+@app.cli.command("recalcular-estadisticas")
+def recalcular_estadisticas_command():
+    """Reconstruye los contadores y agregados del dashboard."""
+    recalcular_estadisticas()
+    click.echo("Estadísticas recalculadas.")
+
+
+def estadisticas_dashboard(dias=30, meses=12, top_viajes=10):
+    """Agregados del dashboard leídos sólo de las tablas de resumen."""
+    totales = dict(db.session.execute(
+        db.select(EstadisticaContador.clave, db.func.sum(EstadisticaContador.valor))
+        .group_by(EstadisticaContador.clave)
+    ).all())
+
+    # Por viaje: reservas, ingresos (precio actual x reservas) y ocupación de
+    # las salidas que tienen cupos configurados
+    por_viaje = []
+    filas = db.session.execute(
+        db.select(Viaje.id, Viaje.nombre, Viaje.precio, Viaje.cupos,
+                  db.func.sum(EstadisticaViajeDia.reservas),
+                  db.func.count(EstadisticaViajeDia.fecha))
+        .join(EstadisticaViajeDia, EstadisticaViajeDia.viaje_id == Viaje.id)
+        .where(EstadisticaViajeDia.reservas > 0)
+        .group_by(Viaje.id, Viaje.nombre, Viaje.precio, Viaje.cupos)
+        .order_by(db.func.sum(EstadisticaViajeDia.reservas).desc())
+        .limit(top_viajes)
+    ).all()
+    for viaje_id, nombre, precio, cupos, reservas, salidas in filas:
+        por_viaje.append({
+            "id": viaje_id,
+            "nombre": nombre,
+            "reservas": int(reservas),
+            "ingresos": (precio or 0) * int(reservas),
+            "ocupacion": (int(reservas) / (cupos * salidas)) if cupos else None,
+        })
+    ingresos_totales = db.session.execute(
+        db.select(db.func.sum(EstadisticaViajeDia.reservas * Viaje.precio))
+        .join(Viaje, Viaje.id == EstadisticaViajeDia.viaje_id)
+    ).scalar() or 0
+
+    hoy = date.today()
+    por_dia = db.session.execute(
+        db.select(EstadisticaViajeDia.fecha, db.func.sum(EstadisticaViajeDia.reservas))
+        .where(EstadisticaViajeDia.fecha >= hoy, EstadisticaViajeDia.fecha < hoy + timedelta(days=dias))
+        .group_by(EstadisticaViajeDia.fecha)
+        .order_by(EstadisticaViajeDia.fecha)
+    ).all()
+
+    # Por mes: se agrupa en Python para no depender de funciones de fecha del motor
+    indice_mes = hoy.year * 12 + hoy.month - 1 - (meses - 1)
+    desde = date(indice_mes // 12, indice_mes % 12 + 1, 1)
+    por_mes = {}
+    for fecha, reservas in db.session.execute(
+        db.select(EstadisticaViajeDia.fecha, db.func.sum(EstadisticaViajeDia.reservas))
+        .where(EstadisticaViajeDia.fecha >= desde)
+        .group_by(EstadisticaViajeDia.fecha)
+    ):
+        mes = fecha.strftime('%Y-%m')
+        por_mes[mes] = por_mes.get(mes, 0) + int(reservas)
+
+    return {
+        "total_viajes": int(totales.get('viajes') or 0),
+        "total_reservas": int(totales.get('reservas') or 0),
+        "total_usuarios": int(totales.get('usuarios') or 0),
+        "ingresos_totales": ingresos_totales,
+        "por_viaje": por_viaje,
+        "por_dia": [(f, int(n)) for f, n in por_dia if n],
+        "por_mes": sorted((m, n) for m, n in por_mes.items() if n),
+    }
+
+
+# Versión global del catálogo: una sola fila que se incrementa en cada escritura
+# de Viaje. Cada worker de gunicorn la compara con la versión de su copia local
+# para enterarse de cambios hechos por otros workers.
+class CatalogoVersion(db.Model):
+    __tablename__ = 'catalogo_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class ViajeSnapshot:
+    """Copia inmutable de un Viaje para renderizar sin tocar la sesión de SQLAlchemy."""
+    __slots__ = ('id', 'nombre', 'descripcion', 'fecha', 'precio', 'imagen', 'cupos')
+
+    def __init__(self, viaje):
+        for campo in self.__slots__:
+            object.__setattr__(self, campo, getattr(viaje, campo))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ViajeSnapshot es de solo lectura")
+
+    def __repr__(self):
+        return f"<ViajeSnapshot {self.id} {self.nombre!r}>"
+
+
+# TTL de la copia local y cada cuánto se consulta la versión compartida
+CATALOGO_TTL = float(os.environ.get("CATALOGO_TTL", "300"))
+CATALOGO_VERSION_CHECK = float(os.environ.get("CATALOGO_VERSION_CHECK", "5"))
+
+
+class CatalogoCache:
+    """Caché en proceso del catálogo de viajes.
+
+    Las lecturas se sirven desde memoria. Cada CATALOGO_VERSION_CHECK segundos
+    se lee la fila de catalogo_version (una consulta trivial) y, si otro worker
+    cambió el catálogo, se recarga. CATALOGO_TTL fuerza una recarga completa
+    aunque la versión no haya cambiado.
+    """
+
+    def __init__(self, ttl, version_check):
+        self.ttl = ttl
+        self.version_check = version_check
+        self._lock = threading.Lock()
+        self._viajes = ()
+        self._por_id = {}
+        self._version = None
+        self._cargado_en = 0.0
+        self._verificado_en = 0.0
+        self._valido = False
+
+    def _leer_version(self):
+        try:
+            fila = db.session.get(CatalogoVersion, 1)
+            return fila.version if fila else 0
+        except ProgrammingError as e:
+            # Tabla aún sin migrar: confiamos sólo en el TTL
+            db.session.rollback()
+            app.logger.warning("No se pudo leer catalogo_version: %s", e)
+            return None
+
+    def _cargar(self, version):
+        viajes = tuple(ViajeSnapshot(v) for v in Viaje.query.order_by(Viaje.id).all())
+        ahora = time.monotonic()
+        self._viajes = viajes
+        self._por_id = {v.id: v for v in viajes}
+        self._version = version
+        self._cargado_en = ahora
+        self._verificado_en = ahora
+        self._valido = True
+
+    def _asegurar_fresco(self):
+        ahora = time.monotonic()
+        if self._valido and ahora - self._cargado_en < self.ttl and ahora - self._verificado_en < self.version_check:
+            return
+        with self._lock, en_primaria():
+            ahora = time.monotonic()
+            if not self._valido or ahora - self._cargado_en >= self.ttl:
+                self._cargar(self._leer_version())
+            elif ahora - self._verificado_en >= self.version_check:
+                version = self._leer_version()
+                if version is None or version != self._version:
+                    self._cargar(version)
+                else:
+                    self._verificado_en = ahora
+
+    def todos(self):
+        self._asegurar_fresco()
+        return self._viajes
+
+    def obtener(self, viaje_id):
+        self._asegurar_fresco()
+        return self._por_id.get(viaje_id)
+
+    def version(self):
+        """Versión global del catálogo vigente en esta copia (None si no hay tabla)."""
+        self._asegurar_fresco()
+        return self._version
+
+    def obtener_or_404(self, viaje_id):
+        viaje = self.obtener(viaje_id)
+        if viaje is None:
+            abort(404)
+        return viaje
+
+    def invalidar(self):
+        """Marca el catálogo como modificado.
+
+        Debe llamarse antes del commit de la escritura: el incremento de la
+        versión viaja en la misma transacción y los demás workers lo verán en
+        su próxima verificación.
+        """
+        actualizado = (CatalogoVersion.query
+                       .filter_by(id=1)
+                       .update({CatalogoVersion.version: CatalogoVersion.version + 1},
+                               synchronize_session=False))
+        if not actualizado:
+            db.session.add(CatalogoVersion(id=1, version=1))
+        self._valido = False
+
+
+catalogo = CatalogoCache(CATALOGO_TTL, CATALOGO_VERSION_CHECK)
+
+
+# Caché de páginas públicas renderizadas. La clave incluye ruta, query string,
+# estado de autenticación y versión del catálogo, así un cambio hecho en otro
+# worker deja obsoletas las entradas sin necesidad de avisarle.
+PAGINAS_CACHE_BACKEND = os.environ.get("PAGINAS_CACHE_BACKEND", "memoria")  # memoria/archivos/off
+PAGINAS_CACHE_MAX = int(os.environ.get("PAGINAS_CACHE_MAX", "512"))
+PAGINAS_CACHE_DIR = os.environ.get("PAGINAS_CACHE_DIR", "/tmp/viajes-paginas")
+
+
+class CacheMemoriaLRU:
+    """LRU en memoria del worker."""
+
+    def __init__(self, max_entradas):
+        self.max_entradas = max_entradas
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave):
+        with self._lock:
+            valor = self._datos.get(clave)
+            if valor is not None:
+                self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = valor
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def purgar(self):
+        with self._lock:
+            self._datos.clear()
+
+
+class CacheArchivos:
+    """Caché en un directorio local, compartida por los workers del contenedor.
+
+    Guarda las entradas (cuerpo, etag, content_type) de pagina_cacheada: el
+    cuerpo tal cual y al lado un .json con la clave, el ETag, el tipo y el hash
+    del cuerpo. Nada se deserializa con pickle.
+    """
+
+    def __init__(self, directorio):
+        self.directorio = directorio_privado(directorio)
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, hashlib.sha256(clave.encode('utf-8')).hexdigest())
+
+    def get(self, clave):
+        ruta = self._ruta(clave)
+        try:
+            with open(ruta + '.json', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(ruta, 'rb') as f:
+                cuerpo = f.read()
+        except (OSError, ValueError):
+            return None
+        # Otro worker pudo reemplazar el cuerpo entre las dos lecturas
+        if (not isinstance(meta, dict) or meta.get('clave') != clave
+                or meta.get('sha256') != hashlib.sha256(cuerpo).hexdigest()):
+            return None
+        return cuerpo, meta['etag'], meta['content_type']
+
+    def set(self, clave, valor):
+        cuerpo, etag, content_type = valor
+        ruta = self._ruta(clave)
+        tmp = f"{ruta}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(cuerpo)
+        os.replace(tmp, ruta)
+        meta = {'clave': clave, 'etag': etag, 'content_type': content_type,
+                'sha256': hashlib.sha256(cuerpo).hexdigest()}
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp, ruta + '.json')
+
+    def purgar(self):
+        for nombre in os.listdir(self.directorio):
+            try:
+                os.remove(os.path.join(self.directorio, nombre))
+            except OSError:
+                pass
+
+
+if PAGINAS_CACHE_BACKEND == "archivos":
+    cache_paginas = CacheArchivos(PAGINAS_CACHE_DIR)
+elif PAGINAS_CACHE_BACKEND == "off":
+    cache_paginas = None
+else:
+    cache_paginas = CacheMemoriaLRU(PAGINAS_CACHE_MAX)
+
+
+def _estado_autenticacion():
+    # Sin _user_id en la sesión no hace falta cargar al usuario (ni tocar la DB)
+    if not session.get('_user_id'):
+        return 'anonimo'
+    return current_user.rol if current_user.is_authenticated else 'anonimo'
+
+def pagina_cacheada(vista):
+    """Cachea el HTML de una vista GET pública y responde 304 con If-None-Match."""
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        # Con mensajes flash pendientes la página es única para este usuario
+        if cache_paginas is None or request.method != 'GET' or session.get('_flashes'):
+            return vista(*args, **kwargs)
+        clave = '|'.join((
+            request.path,
+            request.query_string.decode('latin-1'),
+            _estado_autenticacion(),
+            str(catalogo.version()),
+            _assets_manifest.get('base.css', ''),
+        ))
+        entrada = cache_paginas.get(clave)
+        if entrada is None:
+            respuesta = make_response(vista(*args, **kwargs))
+            if respuesta.status_code != 200 or respuesta.mimetype != 'text/html':
+                return respuesta
+            cuerpo = respuesta.get_data()
+            entrada = (cuerpo, hashlib.sha256(cuerpo).hexdigest()[:32], respuesta.content_type)
+            cache_paginas.set(clave, entrada)
+        cuerpo, etag, content_type = entrada
+        respuesta = app.response_class(cuerpo, content_type=content_type)
+        respuesta.set_etag(etag)
+        # El navegador puede guardarla pero debe revalidar (barato: 304 sin cuerpo)
+        respuesta.headers['Cache-Control'] = 'private, no-cache'
+        respuesta.vary.add('Cookie')
+        return respuesta.make_conditional(request)
+    return envoltura
+
+def invalidar_catalogo():
+    """Llamar antes del commit de cualquier escritura sobre Viaje."""
+    catalogo.invalidar()
+    if cache_paginas is not None:
+        cache_paginas.purgar()
+
+def _fecha_form(valor):
+    """Convierte una fecha 'YYYY-MM-DD' (input type=date) en date; None si no es válida."""
+    try:
+        return date.fromisoformat((valor or "").strip())
+    except ValueError:
+        return None
+
+def _cupos_form(valor):
+    """Convierte el campo 'cupos' del formulario; vacío significa sin límite."""
+    try:
+        cupos = int(valor)
+    except (TypeError, ValueError):
+        return None
+    return cupos if cupos >= 0 else None
+
+def asegurar_disponibilidad(viaje_id, fecha, cupos):
+    """Crea la fila de inventario de la salida si no existe.
+
+    Parte de las reservas que ya hubiera para esa salida. ON CONFLICT evita la
+    carrera entre dos transacciones que la crean a la vez (Postgres y
+    SQLite >= 3.24).
+    """
+    db.session.execute(db.text(
+        "INSERT INTO disponibilidad (viaje_id, fecha, capacidad, reservados) "
+        "SELECT :viaje_id, :fecha, :capacidad, COUNT(*) FROM reserva "
+        "WHERE viaje_id = :viaje_id AND fecha = :fecha "
+        "ON CONFLICT (viaje_id, fecha) DO NOTHING"
+    ), {"viaje_id": viaje_id, "fecha": fecha, "capacidad": cupos})
+
+def reservar_cupo(viaje_id, fecha, cupos, cantidad=1):
+    """Ocupa 'cantidad' cupos de la salida (viaje_id, fecha) dentro de la transacción actual.
+
+    'cupos' es Viaje.cupos. Devuelve False si no caben; sin cupos configurados
+    no hay inventario que controlar y siempre devuelve True. Un solo
+    statement: crea la fila de inventario con las reservas existentes más las
+    nuevas o, si ya existe, la incrementa sólo mientras quede capacidad (el
+    bloqueo de fila de ON CONFLICT serializa a los concurrentes).
+    """
+    if cupos is None:
+        return True
+    resultado = db.session.execute(db.text(
+        "INSERT INTO disponibilidad (viaje_id, fecha, capacidad, reservados) "
+        "SELECT :viaje_id, :fecha, :capacidad, actuales.n + :cantidad FROM ("
+        "    SELECT COUNT(*) AS n FROM reserva WHERE viaje_id = :viaje_id AND fecha = :fecha"
+        ") AS actuales WHERE actuales.n + :cantidad <= :capacidad "
+        "ON CONFLICT (viaje_id, fecha) DO UPDATE SET reservados = disponibilidad.reservados + :cantidad "
+        "WHERE disponibilidad.reservados + :cantidad <= disponibilidad.capacidad"
+    ), {"viaje_id": viaje_id, "fecha": fecha, "capacidad": cupos, "cantidad": cantidad})
+    return resultado.rowcount == 1
+
+def liberar_cupo(viaje_id, fecha, cantidad=1):
+    """Devuelve 'cantidad' cupos de la salida (viaje_id, fecha) si existe inventario."""
+    db.session.execute(
+        db.update(Disponibilidad)
+        .where(Disponibilidad.viaje_id == viaje_id,
+               Disponibilidad.fecha == fecha,
+               Disponibilidad.reservados > 0)
+        .values(reservados=db.case((Disponibilidad.reservados > cantidad, Disponibilidad.reservados - cantidad),
+                                   else_=0))
+    )
+
+# --- Servicio de reservas -----------------------------------------------------
+# Validar una reserva cuesta una sola consulta (Neon está lejos): bloquea al
+# usuario y trae de una vez todo lo que hay que revisar. Después van el UPSERT
+# condicional del cupo y el INSERT/UPDATE, y éste dispara los UPSERT de los
+# eventos de Reserva (estadistica_contador, estadistica_viaje_dia y
+# calendario_usuario): seis statements en total al crear una reserva. El índice
+# único ux_reserva_usuario_fecha respalda la regla "una reserva por fecha" si
+# algo se saltara la validación; su violación se informa con el mismo mensaje.
+
+# Cuota por defecto de reservas activas por usuario (formulario, grupos e
+# importación masiva); Usuario.limite_reservas la reemplaza para cada usuario
+LIMITE_RESERVAS_POR_USUARIO = 7
+# Pasajeros por reserva grupal
+GRUPO_MAX_PASAJEROS = int(os.environ.get("GRUPO_MAX_PASAJEROS", "60"))
+
+MENSAJES_RESERVA = {
+    'limite': "Has alcanzado el límite de {limite} reservas. Cancela alguna para crear una nueva.",
+    'fecha_ocupada': "Ya tienes una reserva para esa fecha. Elige otra fecha o edita la existente.",
+    'sin_cupos': "No quedan cupos para ese viaje en esa fecha. Elige otra fecha.",
+    'viaje_inexistente': "El viaje elegido no existe.",
+    'cuota_grupo': "El grupo no cabe en tu cuota de {limite} reservas: te quedan {libres}.",
+    'grupo_vacio': "Agrega al menos un pasajero.",
+    'grupo_grande': "Un grupo puede tener como máximo {maximo} pasajeros.",
+}
+
+
+class ReservaRechazada(Exception):
+    """La reserva viola una regla; 'codigo' es una clave de MENSAJES_RESERVA."""
+
+    def __init__(self, codigo, **datos):
+        super().__init__(MENSAJES_RESERVA[codigo].format(**datos))
+        self.codigo = codigo
+
+
+def _limite_usuario():
+    return db.func.coalesce(Usuario.limite_reservas, LIMITE_RESERVAS_POR_USUARIO)
+
+def uso_de_cuota(usuario_id):
+    """(reservas actuales, cuota) del usuario en una consulta."""
+    total = (db.select(db.func.count()).select_from(Reserva)
+             .where(Reserva.usuario_id == usuario_id).scalar_subquery())
+    return db.session.execute(
+        db.select(total, _limite_usuario()).where(Usuario.id == usuario_id)
+    ).one()
+
+
+def _estado_para_reservar(usuario_id, viaje_id, fecha, grupo_id=None):
+    """Bloquea al usuario (FOR UPDATE) y lee, en la misma consulta, cuántas
+    reservas tiene y su cuota, sus días reservados del mes, si el viaje existe
+    y sus cupos y, al editar un grupo, cuántos pasajeros tiene.
+
+    El bloqueo dura hasta el commit/rollback: dos POST simultáneos del mismo
+    usuario no pueden pasar ambos la validación.
+    """
+    total = (db.select(db.func.count()).select_from(Reserva)
+             .where(Reserva.usuario_id == usuario_id).scalar_subquery())
+    dias = (db.select(CalendarioUsuario.dias)
+            .where(CalendarioUsuario.usuario_id == usuario_id,
+                   CalendarioUsuario.mes == fecha.replace(day=1)).scalar_subquery())
+    existe = db.exists().where(Viaje.id == viaje_id)
+    cupos = db.select(Viaje.cupos).where(Viaje.id == viaje_id).scalar_subquery()
+    en_grupo = (db.select(db.func.count()).select_from(Reserva)
+                .where(Reserva.grupo_id == grupo_id).scalar_subquery())
+    return db.session.execute(
+        db.select(total.label('total'), _limite_usuario().label('limite'), dias.label('dias'),
+                  existe.label('existe'), cupos.label('cupos'),
+                  (en_grupo if grupo_id is not None else db.literal(0)).label('en_grupo'))
+        .select_from(Usuario)
+        .where(Usuario.id == usuario_id)
+        .with_for_update(of=Usuario)
+    ).one()
+
+
+def _guardar(reserva):
+    """Flush que traduce la violación del índice único a ReservaRechazada.
+
+    Sin SAVEPOINT (una ida y vuelta más en cada reserva): quien llama hace
+    rollback de toda la transacción al recibir ReservaRechazada.
+    """
+    try:
+        db.session.flush()
+    except IntegrityError:
+        raise ReservaRechazada('fecha_ocupada')
+    return reserva
+
+
+def crear_reserva(usuario_id, viaje_id, fecha, nombre, email, mensaje=None):
+    """Valida y agrega la reserva a la transacción actual (el commit lo hace quien llama)."""
+    estado = _estado_para_reservar(usuario_id, viaje_id, fecha)
+    if estado.total >= estado.limite:
+        raise ReservaRechazada('limite', limite=estado.limite)
+    if (estado.dias or 0) & _bit_dia(fecha):
+        raise ReservaRechazada('fecha_ocupada')
+    if not estado.existe:
+        raise ReservaRechazada('viaje_inexistente')
+    if not reservar_cupo(viaje_id, fecha, estado.cupos):
+        raise ReservaRechazada('sin_cupos')
+    reserva = Reserva(nombre=nombre, email=email, fecha=fecha, mensaje=mensaje,
+                      viaje_id=viaje_id, usuario_id=usuario_id)
+    db.session.add(reserva)
+    return _guardar(reserva)
+
+
+def modificar_reserva(reserva, viaje_id, fecha, nombre, email, mensaje=None):
+    """Valida y aplica los cambios a la reserva en la transacción actual."""
+    cambia_salida = (viaje_id, fecha) != (reserva.viaje_id, reserva.fecha)
+    if reserva.usuario_id is not None:
+        estado = _estado_para_reservar(reserva.usuario_id, viaje_id, fecha)
+        # Si no cambia la fecha, el bit encendido es el de esta misma reserva
+        if fecha != reserva.fecha and (estado.dias or 0) & _bit_dia(fecha):
+            raise ReservaRechazada('fecha_ocupada')
+        existe, cupos = estado.existe, estado.cupos
+    else:
+        existe, cupos = db.session.execute(
+            db.select(db.exists().where(Viaje.id == viaje_id),
+                      db.select(Viaje.cupos).where(Viaje.id == viaje_id).scalar_subquery())
+        ).one()
+    if not existe:
+        raise ReservaRechazada('viaje_inexistente')
+    # Cambio de salida: ocupar el cupo nuevo antes de soltar el anterior
+    if cambia_salida:
+        if not reservar_cupo(viaje_id, fecha, cupos):
+            raise ReservaRechazada('sin_cupos')
+        liberar_cupo(reserva.viaje_id, reserva.fecha)
+    reserva.nombre = nombre
+    reserva.email = email
+    reserva.viaje_id = viaje_id
+    reserva.fecha = fecha
+    reserva.mensaje = mensaje
+    return _guardar(reserva)
+
+
+# Reservas grupales: los pasajeros se insertan con un único INSERT de varias
+# filas y se borran con un único DELETE. Son statements masivos del ORM, sin
+# eventos de mapper por fila, así que las estadísticas se ajustan aquí por el
+# total (los grupos no tocan calendario_usuario). El cupo se reserva una vez
+# para todo el grupo.
+
+def _validar_grupo(estado, pasajeros, actuales=0):
+    if not pasajeros:
+        raise ReservaRechazada('grupo_vacio')
+    if len(pasajeros) > GRUPO_MAX_PASAJEROS:
+        raise ReservaRechazada('grupo_grande', maximo=GRUPO_MAX_PASAJEROS)
+    libres = estado.limite - (estado.total - actuales)
+    if len(pasajeros) > libres:
+        raise ReservaRechazada('cuota_grupo', limite=estado.limite, libres=max(libres, 0))
+    if not estado.existe:
+        raise ReservaRechazada('viaje_inexistente')
+
+def _insertar_pasajeros(grupo, pasajeros):
+    db.session.execute(db.insert(Reserva), [
+        {"nombre": nombre, "email": email, "fecha": grupo.fecha, "viaje_id": grupo.viaje_id,
+         "usuario_id": grupo.usuario_id, "grupo_id": grupo.id}
+        for nombre, email in pasajeros
+    ])
+    conexion = db.session.connection()
+    _sumar_viaje_dia(conexion, grupo.viaje_id, grupo.fecha, len(pasajeros))
+    _sumar_contador(conexion, 'reservas', len(pasajeros))
+
+def _borrar_pasajeros(grupo):
+    """Borra los pasajeros del grupo y devuelve cuántos eran."""
+    borrados = db.session.execute(
+        db.delete(Reserva).where(Reserva.grupo_id == grupo.id),
+        execution_options={"synchronize_session": False},
+    ).rowcount
+    if borrados:
+        conexion = db.session.connection()
+        _sumar_viaje_dia(conexion, grupo.viaje_id, grupo.fecha, -borrados)
+        _sumar_contador(conexion, 'reservas', -borrados)
+    return borrados
+
+
+def crear_grupo(usuario_id, viaje_id, fecha, nombre, email, pasajeros, mensaje=None):
+    """Valida y agrega un grupo con sus pasajeros [(nombre, email), ...] a la transacción actual."""
+    estado = _estado_para_reservar(usuario_id, viaje_id, fecha)
+    _validar_grupo(estado, pasajeros)
+    if not reservar_cupo(viaje_id, fecha, estado.cupos, len(pasajeros)):
+        raise ReservaRechazada('sin_cupos')
+    grupo = GrupoReserva(nombre=nombre, email=email, fecha=fecha, mensaje=mensaje,
+                         viaje_id=viaje_id, usuario_id=usuario_id)
+    db.session.add(grupo)
+    db.session.flush()
+    _insertar_pasajeros(grupo, pasajeros)
+    return grupo
+
+
+def modificar_grupo(grupo, viaje_id, fecha, nombre, email, pasajeros, mensaje=None):
+    """Mueve el grupo de salida y/o reemplaza su lista de pasajeros en la transacción actual."""
+    estado = _estado_para_reservar(grupo.usuario_id, viaje_id, fecha, grupo_id=grupo.id)
+    actuales = estado.en_grupo
+    _validar_grupo(estado, pasajeros, actuales)
+    nuevos = len(pasajeros)
+    if (viaje_id, fecha) != (grupo.viaje_id, grupo.fecha):
+        # Ocupar los cupos nuevos antes de soltar los anteriores
+        if not reservar_cupo(viaje_id, fecha, estado.cupos, nuevos):
+            raise ReservaRechazada('sin_cupos')
+        liberar_cupo(grupo.viaje_id, grupo.fecha, actuales)
+    elif nuevos > actuales:
+        if not reservar_cupo(viaje_id, fecha, estado.cupos, nuevos - actuales):
+            raise ReservaRechazada('sin_cupos')
+    elif nuevos < actuales:
+        liberar_cupo(viaje_id, fecha, actuales - nuevos)
+    _borrar_pasajeros(grupo)
+    grupo.nombre = nombre
+    grupo.email = email
+    grupo.viaje_id = viaje_id
+    grupo.fecha = fecha
+    grupo.mensaje = mensaje
+    db.session.flush()
+    _insertar_pasajeros(grupo, pasajeros)
+    return grupo
+
+
+def cancelar_grupo(grupo):
+    """Borra el grupo y sus pasajeros y devuelve sus cupos, en la transacción actual."""
+    liberar_cupo(grupo.viaje_id, grupo.fecha, _borrar_pasajeros(grupo))
+    db.session.delete(grupo)
+
+
 # Ruta para la página principal
 @app.route("/")
+@pagina_cacheada
 def index():
     return render_template("index.html")
 
@@ -263,6 +2638,360 @@ def img(filename):
     return send_from_directory(img_dir, filename)
 
 
+# Estáticos con huella: `flask construir-estaticos` minifica los CSS, une los
+# que base.html carga siempre, escribe archivos con el hash del contenido en el
+# nombre más su .gz/.br y un manifest.json. Si el manifest existe, url_for los
+# usa y se sirven con Cache-Control immutable desde /assets.
+ASSETS_DIST = os.path.join('static', 'dist')
+ASSETS_BUNDLES = {'base.css': ['style.css', 'crud.css']}
+ASSETS_MAX_AGE = 365 * 24 * 3600
+CACHE_INMUTABLE = f"public, max-age={ASSETS_MAX_AGE}, immutable"
+
+def _minificar_css(css):
+    """Minificador conservador: comentarios, espacios y ';' finales."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+def _hash_corto(datos):
+    return hashlib.sha256(datos).hexdigest()[:12]
+
+def _escribir_comprimidos(ruta, datos):
+    import gzip
+    with open(ruta + '.gz', 'wb') as f:
+        f.write(gzip.compress(datos, compresslevel=9, mtime=0))
+    try:
+        import brotli
+    except ImportError:
+        return
+    with open(ruta + '.br', 'wb') as f:
+        f.write(brotli.compress(datos, quality=11))
+
+def construir_estaticos():
+    """Genera static/dist y su manifest. Devuelve el manifest."""
+    origen = os.path.join(app.root_path, 'static')
+    destino = os.path.join(app.root_path, ASSETS_DIST)
+    os.makedirs(destino, exist_ok=True)
+
+    entradas = {}
+    for nombre in sorted(os.listdir(origen)):
+        if nombre.endswith(('.css', '.js')) and os.path.isfile(os.path.join(origen, nombre)):
+            with open(os.path.join(origen, nombre), encoding='utf-8') as f:
+                entradas[nombre] = f.read()
+    # El JS se publica sin minificar: un minificador por regex no es seguro con él
+    salidas = {n: (_minificar_css(c) if n.endswith('.css') else c) for n, c in entradas.items()}
+    for bundle, partes in ASSETS_BUNDLES.items():
+        salidas[bundle] = '\n'.join(salidas[p] for p in partes if p in salidas)
+
+    manifest = {}
+    for nombre, contenido in salidas.items():
+        datos = contenido.encode('utf-8')
+        base, ext = os.path.splitext(nombre)
+        hasheado = f"{base}.{_hash_corto(datos)}{ext}"
+        ruta = os.path.join(destino, hasheado)
+        if not os.path.exists(ruta):
+            with open(ruta, 'wb') as f:
+                f.write(datos)
+            _escribir_comprimidos(ruta, datos)
+        manifest[nombre] = hasheado
+
+    tmp = os.path.join(destino, 'manifest.json.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, os.path.join(destino, 'manifest.json'))
+    _assets_manifest.clear()
+    _assets_manifest.update(manifest)
+    return manifest
+
+def _cargar_manifest():
+    try:
+        with open(os.path.join(app.root_path, ASSETS_DIST, 'manifest.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+_assets_manifest = _cargar_manifest()
+
+# Huellas de archivos sin manifest (imágenes): {ruta: (mtime, tamaño, hash)}
+_huellas_archivos = {}
+
+def _huella_archivo(ruta):
+    try:
+        st = os.stat(ruta)
+    except OSError:
+        return None
+    previa = _huellas_archivos.get(ruta)
+    if previa and previa[:2] == (st.st_mtime_ns, st.st_size):
+        return previa[2]
+    with open(ruta, 'rb') as f:
+        huella = _hash_corto(f.read())[:8]
+    _huellas_archivos[ruta] = (st.st_mtime_ns, st.st_size, huella)
+    return huella
+
+def url_for_con_huella(endpoint, **values):
+    """url_for para plantillas: versiona los estáticos para poder cachearlos para siempre."""
+    if endpoint == 'static' and 'filename' in values:
+        hasheado = _assets_manifest.get(values['filename'])
+        if hasheado:
+            values['filename'] = hasheado
+            return url_for('assets', **values)
+        ruta = os.path.join(app.root_path, 'static', values['filename'])
+        huella = _huella_archivo(ruta)
+        if huella:
+            values.setdefault('v', huella)
+    elif endpoint == 'img' and 'filename' in values:
+        huella = _huella_archivo(os.path.join(app.root_path, 'img', values['filename']))
+        if huella:
+            values.setdefault('v', huella)
+    return url_for(endpoint, **values)
+
+app.jinja_env.globals['url_for'] = url_for_con_huella
+
+@app.template_global()
+def css_bundle(nombre):
+    """URLs a enlazar para un bundle: el archivo unido si fue construido, o sus partes."""
+    if nombre in _assets_manifest:
+        return [url_for('assets', filename=_assets_manifest[nombre])]
+    return [url_for_con_huella('static', filename=p) for p in ASSETS_BUNDLES[nombre]]
+
+@app.route('/assets/<path:filename>')
+def assets(filename):
+    """Sirve static/dist con la variante precomprimida que acepte el cliente."""
+    carpeta = os.path.join(app.root_path, ASSETS_DIST)
+    aceptadas = request.headers.get('Accept-Encoding', '')
+    codificacion = None
+    for ext, nombre in (('.br', 'br'), ('.gz', 'gzip')):
+        if nombre in aceptadas and os.path.isfile(os.path.join(carpeta, filename + ext)):
+            codificacion = (ext, nombre)
+            break
+    if codificacion:
+        import mimetypes
+        tipo = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(carpeta, filename + codificacion[0], mimetype=tipo, max_age=ASSETS_MAX_AGE)
+        response.headers['Content-Encoding'] = codificacion[1]
+    else:
+        response = send_from_directory(carpeta, filename, max_age=ASSETS_MAX_AGE)
+    response.headers['Cache-Control'] = CACHE_INMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.after_request
+def _cache_estaticos_versionados(response):
+    # URL con ?v=<huella>: el contenido de esa URL nunca cambia
+    if request.endpoint in ('static', 'img') and request.args.get('v') and response.status_code == 200:
+        response.headers['Cache-Control'] = CACHE_INMUTABLE
+    return response
+
+@app.cli.command("construir-estaticos")
+def construir_estaticos_command():
+    """Minifica, une, versiona y precomprime los CSS/JS de static/ en static/dist."""
+    manifest = construir_estaticos()
+    for origen, destino in sorted(manifest.items()):
+        click.echo(f"{origen} -> {destino}")
+
+
+# --- Compresión de respuestas -------------------------------------------------
+# Ni gunicorn ni el proxy de Koyeb comprimen: este middleware WSGI comprime las
+# respuestas de texto (HTML, JSON, CSV, NDJSON, CSS, JS, SVG) con la mejor
+# codificación que acepte el cliente (br, zstd si está instalado el paquete
+# zstandard, gzip). No toca lo que ya viene comprimido: imágenes, /assets con
+# sus variantes precomprimidas, respuestas con Content-Encoding o no-transform.
+#   - Cuerpo de largo conocido: se comprime entero, con un nivel que baja a
+#     medida que crece (COMPRESION_NIVELES).
+#   - Streaming (sin Content-Length, p. ej. /reservas/exportar): se comprime
+#     trozo a trozo con un flush por trozo, sin acumular la respuesta.
+#   - Con ETag fuerte (pagina_cacheada): se comprime una vez a nivel alto y la
+#     variante se guarda por (codificación, ETag, ruta). El ETag de la variante
+#     lleva el sufijo -br/-zstd/-gzip y If-None-Match se traduce de vuelta, así
+#     la app sigue respondiendo 304 con su propio ETag.
+# COMPRESION=0 lo desactiva (p. ej. si otro proxy delante ya comprime).
+COMPRESION = os.environ.get("COMPRESION", "1") == "1"
+COMPRESION_MINIMO = int(os.environ.get("COMPRESION_MINIMO", "512"))  # bytes
+COMPRESION_CACHE_MAX = int(os.environ.get("COMPRESION_CACHE_MAX", "256"))  # variantes por worker
+# (hasta bytes, niveles): cuerpos grandes con niveles bajos para no gastar CPU
+COMPRESION_NIVELES = (
+    (64 * 1024, {'br': 5, 'zstd': 6, 'gzip': 6}),
+    (1024 * 1024, {'br': 4, 'zstd': 3, 'gzip': 5}),
+    (None, {'br': 1, 'zstd': 1, 'gzip': 1}),
+)
+COMPRESION_NIVELES_STREAMING = {'br': 4, 'zstd': 3, 'gzip': 5}
+# Se comprimen una sola vez y se sirven muchas: vale la pena apretar más
+COMPRESION_NIVELES_CACHE = {'br': 9, 'zstd': 12, 'gzip': 9}
+COMPRESION_CACHE_MAX_BYTES = 1024 * 1024  # cuerpos más grandes no se guardan
+TIPOS_COMPRIMIBLES = ('text/', 'application/json', 'application/javascript', 'application/x-ndjson',
+                      'application/xml', 'image/svg+xml')
+RUTAS_SIN_COMPRESION = ('/static/img/', '/img/', '/assets/')
+
+
+def _codecs_compresion():
+    """{codificación: (comprimir(datos, nivel), flujo(nivel))} en orden de preferencia."""
+    import gzip
+    import zlib
+
+    def flujo_gzip(nivel):
+        z = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+        return (lambda datos: z.compress(datos) + z.flush(zlib.Z_SYNC_FLUSH)), z.flush
+
+    codecs = {}
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        def flujo_brotli(nivel):
+            c = brotli.Compressor(quality=nivel)
+            return (lambda datos: c.process(datos) + c.flush()), c.finish
+        codecs['br'] = (lambda datos, nivel: brotli.compress(datos, quality=nivel), flujo_brotli)
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        def flujo_zstd(nivel):
+            z = zstandard.ZstdCompressor(level=nivel).compressobj()
+            return (lambda datos: z.compress(datos) + z.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)), z.flush
+        codecs['zstd'] = (lambda datos, nivel: zstandard.ZstdCompressor(level=nivel).compress(datos), flujo_zstd)
+    codecs['gzip'] = (lambda datos, nivel: gzip.compress(datos, compresslevel=nivel, mtime=0), flujo_gzip)
+    return codecs
+
+
+def _nivel_compresion(codificacion, largo):
+    for hasta, niveles in COMPRESION_NIVELES:
+        if hasta is None or largo <= hasta:
+            return niveles[codificacion]
+
+
+class CompresionRespuestas:
+    """Middleware WSGI que comprime las respuestas de texto según Accept-Encoding."""
+
+    def __init__(self, app_wsgi):
+        self.app_wsgi = app_wsgi
+        self.codecs = _codecs_compresion()
+        self.cache = CacheMemoriaLRU(COMPRESION_CACHE_MAX) if COMPRESION_CACHE_MAX > 0 else None
+
+    def negociar(self, aceptadas):
+        """La codificación con mayor q para el cliente; a igual q, la preferida aquí."""
+        if not aceptadas:
+            return None
+        from werkzeug.http import parse_accept_header
+        accept = parse_accept_header(aceptadas)
+        elegida, calidad = None, 0
+        for nombre in self.codecs:
+            q = accept.quality(nombre)
+            if q > calidad:
+                elegida, calidad = nombre, q
+        return elegida
+
+    @staticmethod
+    def comprimible(codigo, cabeceras):
+        if codigo < 200 or codigo in (204, 206, 304) or 'Content-Encoding' in cabeceras:
+            return False
+        if 'no-transform' in cabeceras.get('Cache-Control', ''):
+            return False
+        tipo = cabeceras.get('Content-Type', '').split(';', 1)[0].strip().lower()
+        return tipo.startswith(TIPOS_COMPRIMIBLES)
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') == 'HEAD' or environ.get('PATH_INFO', '').startswith(RUTAS_SIN_COMPRESION):
+            return self.app_wsgi(environ, start_response)
+        codificacion = self.negociar(environ.get('HTTP_ACCEPT_ENCODING'))
+        sufijo = f'-{codificacion}"' if codificacion else None
+        condicional = environ.get('HTTP_IF_NONE_MATCH')
+        if sufijo and condicional and sufijo in condicional:
+            environ['HTTP_IF_NONE_MATCH'] = condicional.replace(sufijo, '"')
+
+        # Flask llama a start_response antes de devolver el cuerpo: se guarda y la
+        # llamada real se pospone hasta saber si la respuesta se comprime. write()
+        # de WSGI no se admite (Flask siempre devuelve un iterable).
+        capturado = []
+
+        def capturar(status, headers, exc_info=None):
+            capturado[:] = [status, headers, exc_info]
+
+        respuesta = self.app_wsgi(environ, capturar)
+        status, headers, exc_info = capturado
+        cabeceras = Headers(headers)
+        codigo = int(status[:3])
+        if codigo == 304 and sufijo and cabeceras.get('ETag', '').endswith('"'):
+            cabeceras['ETag'] = cabeceras['ETag'][:-1] + sufijo
+        if not self.comprimible(codigo, cabeceras):
+            start_response(status, cabeceras.to_wsgi_list(), exc_info)
+            return respuesta
+        vary = cabeceras.get('Vary', '')
+        if 'accept-encoding' not in vary.lower():
+            cabeceras['Vary'] = f"{vary}, Accept-Encoding" if vary else 'Accept-Encoding'
+        largo = cabeceras.get('Content-Length')
+        if codificacion is None or (largo is not None and int(largo) < COMPRESION_MINIMO):
+            start_response(status, cabeceras.to_wsgi_list(), exc_info)
+            return respuesta
+        if largo is None:
+            self._marcar(cabeceras, codificacion, sufijo)
+            start_response(status, cabeceras.to_wsgi_list(), exc_info)
+            return self._comprimir_flujo(respuesta, codificacion)
+
+        try:
+            datos = b''.join(respuesta)
+        finally:
+            if hasattr(respuesta, 'close'):
+                respuesta.close()
+        etag = cabeceras.get('ETag', '')
+        cacheable = (self.cache is not None and etag.startswith('"') and codigo == 200
+                     and len(datos) <= COMPRESION_CACHE_MAX_BYTES)
+        clave = f"{codificacion}|{etag}|{environ.get('PATH_INFO', '')}"
+        comprimido = self.cache.get(clave) if cacheable else None
+        if comprimido is None:
+            comprimir = self.codecs[codificacion][0]
+            nivel = COMPRESION_NIVELES_CACHE[codificacion] if cacheable else _nivel_compresion(codificacion, len(datos))
+            comprimido = comprimir(datos, nivel)
+            if cacheable:
+                self.cache.set(clave, comprimido)
+        if len(comprimido) >= len(datos):
+            start_response(status, cabeceras.to_wsgi_list(), exc_info)
+            return [datos]
+        self._marcar(cabeceras, codificacion, sufijo)
+        cabeceras['Content-Length'] = str(len(comprimido))
+        metricas.contar('http_compressed_responses_total', codificacion)
+        metricas.contar('http_compression_saved_bytes_total', codificacion, len(datos) - len(comprimido))
+        start_response(status, cabeceras.to_wsgi_list(), exc_info)
+        return [comprimido]
+
+    @staticmethod
+    def _marcar(cabeceras, codificacion, sufijo):
+        cabeceras['Content-Encoding'] = codificacion
+        etag = cabeceras.get('ETag', '')
+        if etag.endswith('"'):
+            cabeceras['ETag'] = etag[:-1] + sufijo
+
+    def _comprimir_flujo(self, respuesta, codificacion):
+        """Comprime un cuerpo en streaming; cada trozo sale en cuanto se genera."""
+        comprimir, terminar = self.codecs[codificacion][1](COMPRESION_NIVELES_STREAMING[codificacion])
+        entrada = salida = 0
+        try:
+            for trozo in respuesta:
+                if not trozo:
+                    continue
+                bloque = comprimir(trozo)
+                entrada += len(trozo)
+                salida += len(bloque)
+                if bloque:
+                    yield bloque
+            final = terminar()
+            salida += len(final)
+            yield final
+        finally:
+            # El cierre del cuerpo original hace el teardown del request de Flask
+            if hasattr(respuesta, 'close'):
+                respuesta.close()
+            metricas.contar('http_compressed_responses_total', codificacion)
+            metricas.contar('http_compression_saved_bytes_total', codificacion, max(0, entrada - salida))
+
+
+if COMPRESION:
+    app.wsgi_app = CompresionRespuestas(app.wsgi_app)
+
+
 # CRUD de viajes
 from werkzeug.utils import secure_filename
 
@@ -273,11 +3002,440 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+
+# Pipeline de imágenes: las subidas se guardan con nombre = hash del contenido
+# (se deduplican y pueden cachearse para siempre), sin EXIF, y con variantes de
+# ancho fijo en formatos modernos dentro de static/img/variantes.
+VARIANTES_FOLDER = os.path.join(UPLOAD_FOLDER, 'variantes')
+IMG_VARIANTES = {'thumb': 320, 'card': 640, 'detail': 1280}
+IMG_ANCHO_MAXIMO = 1600  # ancho del original normalizado que se guarda
+IMG_FORMATOS_RASTER = {'png', 'jpg', 'jpeg', 'webp'}  # gif/svg se guardan tal cual
+IMG_CALIDAD = {'avif': 55, 'webp': 80, 'jpg': 82}
+
+def _formatos_variantes():
+    """Formatos que esta instalación de Pillow puede escribir, en orden de preferencia."""
+    try:
+        from PIL import features
+    except ImportError:
+        return ()
+    formatos = []
+    if features.check('avif') and os.environ.get("IMG_AVIF", "1") == "1":
+        formatos.append('avif')
+    if features.check('webp'):
+        formatos.append('webp')
+    formatos.append('jpg')
+    return tuple(formatos)
+
+def _ruta_variante(stem, ancho, formato):
+    return os.path.join(app.root_path, VARIANTES_FOLDER, f"{stem}-{ancho}.{formato}")
+
+def _guardar_atomico(imagen, ruta, formato):
+    tmp = f"{ruta}.{os.getpid()}.tmp"
+    if formato == 'jpg':
+        imagen.convert('RGB').save(tmp, 'JPEG', quality=IMG_CALIDAD['jpg'], optimize=True, progressive=True)
+    elif formato == 'webp':
+        imagen.save(tmp, 'WEBP', quality=IMG_CALIDAD['webp'], method=4)
+    elif formato == 'avif':
+        imagen.save(tmp, 'AVIF', quality=IMG_CALIDAD['avif'], speed=8)
+    else:
+        imagen.save(tmp, 'PNG', optimize=True)
+    os.replace(tmp, ruta)
+
+def _abrir_normalizada(origen):
+    """Abre la imagen, aplica la orientación EXIF y descarta los metadatos."""
+    from PIL import Image, ImageOps
+    with Image.open(origen) as im:
+        im = ImageOps.exif_transpose(im)
+        con_alfa = im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info
+        # Copiar sólo los píxeles: así no arrastramos EXIF/GPS a las variantes
+        return im.convert('RGBA' if con_alfa else 'RGB'), con_alfa
+
+def generar_variantes(origen, stem, forzar=False):
+    """Genera las variantes de ancho fijo de una imagen. Devuelve cuántas escribió."""
+    from PIL import Image
+    im, _ = _abrir_normalizada(origen)
+    os.makedirs(os.path.join(app.root_path, VARIANTES_FOLDER), exist_ok=True)
+    # No ampliar: los anchos mayores que el original se recortan a su ancho real
+    anchos = sorted({min(a, im.width) for a in IMG_VARIANTES.values()})
+    escritas = 0
+    for ancho in anchos:
+        copia = im.copy()
+        if copia.width > ancho:
+            copia.thumbnail((ancho, ancho * 10), Image.LANCZOS)
+        for formato in _formatos_variantes():
+            ruta = _ruta_variante(stem, ancho, formato)
+            if forzar or not os.path.exists(ruta):
+                _guardar_atomico(copia, ruta, formato)
+                escritas += 1
+    _variantes_cache.pop(stem, None)
+    return escritas
+
+def guardar_imagen_subida(archivo):
+    """Guarda una imagen subida y sus variantes; devuelve el nombre para Viaje.imagen."""
+    datos = archivo.read()
+    ext = secure_filename(archivo.filename).rsplit('.', 1)[1].lower()
+    digest = hashlib.sha256(datos).hexdigest()[:20]
+    carpeta = os.path.join(app.root_path, UPLOAD_FOLDER)
+
+    if ext in IMG_FORMATOS_RASTER and _formatos_variantes():
+        try:
+            im, con_alfa = _abrir_normalizada(io.BytesIO(datos))
+        except Exception as e:
+            app.logger.warning("Imagen subida no válida (%s): %s", archivo.filename, e)
+            return None
+        formato = 'png' if con_alfa else 'jpg'
+        nombre = f"{digest}.{formato}"
+        ruta = os.path.join(carpeta, nombre)
+        if not os.path.exists(ruta):  # mismo contenido ya subido: nada que hacer
+            if im.width > IMG_ANCHO_MAXIMO:
+                from PIL import Image
+                im.thumbnail((IMG_ANCHO_MAXIMO, IMG_ANCHO_MAXIMO * 10), Image.LANCZOS)
+            _guardar_atomico(im, ruta, formato)
+            generar_variantes(ruta, digest)
+        return nombre
+
+    nombre = f"{digest}.{ext}"
+    ruta = os.path.join(carpeta, nombre)
+    if not os.path.exists(ruta):
+        with open(ruta, 'wb') as f:
+            f.write(datos)
+    return nombre
+
+
+# Variantes existentes por imagen: {stem: (momento, {formato: [anchos]})}
+_variantes_cache = {}
+VARIANTES_CACHE_TTL = 60  # sólo aplica a imágenes sin variantes todavía
+
+def _variantes_de(stem):
+    entrada = _variantes_cache.get(stem)
+    if entrada and (entrada[1] or time.monotonic() - entrada[0] < VARIANTES_CACHE_TTL):
+        return entrada[1]
+    import glob
+    encontradas = {}
+    carpeta = os.path.join(app.root_path, VARIANTES_FOLDER)
+    for formato in ('avif', 'webp', 'jpg'):
+        anchos = []
+        for ruta in glob.glob(os.path.join(glob.escape(carpeta), f"{glob.escape(stem)}-*.{formato}")):
+            sufijo = os.path.basename(ruta)[len(stem) + 1:-len(formato) - 1]
+            if sufijo.isdigit():
+                anchos.append(int(sufijo))
+        if anchos:
+            encontradas[formato] = sorted(anchos)
+    _variantes_cache[stem] = (time.monotonic(), encontradas)
+    return encontradas
+
+@app.template_global()
+def srcset(nombre, formato='jpg'):
+    """Valor para el atributo srcset con las variantes de 'nombre' en 'formato'."""
+    if not nombre:
+        return ''
+    stem = os.path.splitext(nombre)[0]
+    anchos = _variantes_de(stem).get(formato, [])
+    return ', '.join(
+        f"{url_for_con_huella('static', filename=f'img/variantes/{stem}-{a}.{formato}')} {a}w" for a in anchos
+    )
+
+@app.template_global()
+def imagen_responsive(nombre, alt, sizes='100vw', clase=None, loading='lazy'):
+    """Etiqueta <picture> con fuentes AVIF/WebP y respaldo JPEG para 'nombre'."""
+    if not nombre:
+        return ''
+    src = url_for_con_huella('static', filename='img/' + nombre)
+    atributos = Markup(' alt="{}" loading="{}"').format(alt, loading)
+    if clase:
+        atributos += Markup(' class="{}"').format(clase)
+    variantes = _variantes_de(os.path.splitext(nombre)[0])
+    if not variantes:
+        return Markup('<img src="{}"{}>').format(src, atributos)
+    partes = [Markup('<picture>')]
+    for formato in ('avif', 'webp'):
+        if formato in variantes:
+            partes.append(Markup('<source type="image/{}" srcset="{}" sizes="{}">').format(
+                formato, srcset(nombre, formato), sizes))
+    if 'jpg' in variantes:
+        partes.append(Markup('<img src="{}" srcset="{}" sizes="{}"{}>').format(
+            src, srcset(nombre, 'jpg'), sizes, atributos))
+    else:
+        partes.append(Markup('<img src="{}"{}>').format(src, atributos))
+    partes.append(Markup('</picture>'))
+    return Markup('').join(partes)
+
+def _generar_variantes_faltantes(forzar=False, informar=None):
+    """Genera las variantes de todas las imágenes de static/img; devuelve cuántos archivos escribió."""
+    if not _formatos_variantes():
+        return 0
+    carpeta = os.path.join(app.root_path, UPLOAD_FOLDER)
+    total = 0
+    for nombre in sorted(os.listdir(carpeta)):
+        ruta = os.path.join(carpeta, nombre)
+        stem, ext = os.path.splitext(nombre)
+        if not os.path.isfile(ruta) or ext.lstrip('.').lower() not in IMG_FORMATOS_RASTER:
+            continue
+        # Decodificar la imagen es lo caro: si ya tiene variantes en todos los
+        # formatos no hace falta abrirla (así el arranque no paga por cada foto)
+        if not forzar and set(_formatos_variantes()) <= set(_variantes_de(stem)):
+            continue
+        try:
+            escritas = generar_variantes(ruta, stem, forzar=forzar)
+        except Exception as e:
+            if informar:
+                informar(f"{nombre}: error {e}")
+            continue
+        total += escritas
+        if informar:
+            informar(f"{nombre}: {escritas} variantes")
+    return total
+
+@app.cli.command("generar-variantes")
+@click.option("--forzar", is_flag=True, help="Regenerar aunque la variante ya exista.")
+def generar_variantes_command(forzar):
+    """Genera variantes (thumb/card/detail) para las imágenes existentes en static/img."""
+    if not _formatos_variantes():
+        raise click.ClickException("Pillow no está instalado.")
+    total = _generar_variantes_faltantes(forzar=forzar, informar=click.echo)
+    click.echo(f"Listo: {total} archivos generados.")
+
 @app.route("/viajes")
+@lectura_replica
+@pagina_cacheada
 def listar_viajes():
-    viajes = Viaje.query.all()
+    viajes = catalogo.todos()
     return render_template("viajes/listar.html", viajes=viajes)
 
+# --- Búsqueda en el catálogo ------------------------------------------------
+# En Postgres se usa la columna viaje.busqueda (tsvector generado con la
+# configuración 'spanish' sobre f_unaccent(nombre/descripcion), índice GIN; ver
+# la migración). En SQLite se usa un índice invertido en memoria construido a
+# partir del catálogo cacheado. Ambos devuelven snapshots del catálogo.
+BUSQUEDA_POR_PAGINA = int(os.environ.get("BUSQUEDA_POR_PAGINA", "24"))
+
+# (clave, etiqueta, mínimo inclusive, máximo exclusivo)
+RANGOS_PRECIO = (
+    ('0-500000', 'Hasta $500.000', None, 500000),
+    ('500000-1000000', '$500.000 a $1.000.000', 500000, 1000000),
+    ('1000000-2000000', '$1.000.000 a $2.000.000', 1000000, 2000000),
+    ('2000000-', 'Más de $2.000.000', 2000000, None),
+)
+_RANGOS_POR_CLAVE = {clave: (minimo, maximo) for clave, _, minimo, maximo in RANGOS_PRECIO}
+
+PALABRAS_VACIAS = frozenset(
+    "a al con de del e el en la las lo los o para por que se su sus un una unos unas y".split()
+)
+
+def terminos_busqueda(texto):
+    """Normaliza un texto en términos: minúsculas, sin tildes, sin palabras vacías y
+    con un recorte simple de plurales (aproxima el stemming de Postgres)."""
+    texto = unicodedata.normalize('NFKD', (texto or '').lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    terminos = []
+    for palabra in re.findall(r'\w+', texto):
+        if palabra in PALABRAS_VACIAS:
+            continue
+        if len(palabra) > 4 and palabra.endswith('es'):
+            palabra = palabra[:-2]
+        elif len(palabra) > 3 and palabra.endswith('s'):
+            palabra = palabra[:-1]
+        terminos.append(palabra)
+    return terminos
+
+class IndiceCatalogo:
+    """Índice invertido en memoria sobre nombre y descripción de los viajes.
+
+    Se reconstruye cuando el catálogo cacheado se recarga. Pesos como los de
+    setweight en Postgres: nombre 'A' (1.0), descripción 'B' (0.4).
+    """
+    PESOS = (('nombre', 1.0), ('descripcion', 0.4))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fuente = None
+        self._postings = {}
+        self._vocabulario = []
+
+    def _asegurar(self):
+        viajes = catalogo.todos()
+        if viajes is self._fuente:
+            return
+        with self._lock:
+            if viajes is self._fuente:
+                return
+            postings = {}
+            for viaje in viajes:
+                for campo, peso in self.PESOS:
+                    for termino in terminos_busqueda(getattr(viaje, campo)):
+                        por_viaje = postings.setdefault(termino, {})
+                        por_viaje[viaje.id] = por_viaje.get(viaje.id, 0.0) + peso
+            self._postings = postings
+            self._vocabulario = sorted(postings)
+            self._fuente = viajes
+
+    def _coincidencias(self, termino):
+        """Postings del término; si no existe tal cual, los de las palabras que empiezan con él."""
+        if termino in self._postings:
+            return self._postings[termino]
+        combinados = {}
+        i = bisect.bisect_left(self._vocabulario, termino)
+        while i < len(self._vocabulario) and self._vocabulario[i].startswith(termino):
+            for viaje_id, puntaje in self._postings[self._vocabulario[i]].items():
+                combinados[viaje_id] = combinados.get(viaje_id, 0.0) + puntaje
+            i += 1
+        return combinados
+
+    def buscar(self, texto):
+        """{viaje_id: puntaje} de los viajes que contienen todos los términos."""
+        self._asegurar()
+        puntajes = None
+        for termino in terminos_busqueda(texto):
+            coincidencias = self._coincidencias(termino)
+            if puntajes is None:
+                puntajes = dict(coincidencias)
+            else:
+                puntajes = {v: p + coincidencias[v] for v, p in puntajes.items() if v in coincidencias}
+            if not puntajes:
+                return {}
+        return puntajes or {}
+
+
+indice_catalogo = IndiceCatalogo()
+
+def _en_rango(precio, clave):
+    minimo, maximo = _RANGOS_POR_CLAVE[clave]
+    if precio is None:
+        return False
+    return (minimo is None or precio >= minimo) and (maximo is None or precio < maximo)
+
+def _buscar_en_memoria(texto, rango, mes):
+    if texto:
+        puntajes = indice_catalogo.buscar(texto)
+        candidatos = [v for v in catalogo.todos() if v.id in puntajes]
+    else:
+        puntajes = {}
+        candidatos = list(catalogo.todos())
+
+    def mes_de(viaje):
+        return viaje.fecha.strftime('%Y-%m') if viaje.fecha else None
+
+    # Cada faceta se cuenta con el filtro de la otra aplicado, no con el propio
+    por_precio = {}
+    por_mes = {}
+    for viaje in candidatos:
+        if not mes or mes_de(viaje) == mes:
+            for clave in _RANGOS_POR_CLAVE:
+                if _en_rango(viaje.precio, clave):
+                    por_precio[clave] = por_precio.get(clave, 0) + 1
+        if (not rango or _en_rango(viaje.precio, rango)) and mes_de(viaje):
+            por_mes[mes_de(viaje)] = por_mes.get(mes_de(viaje), 0) + 1
+
+    resultados = [v for v in candidatos
+                  if (not rango or _en_rango(v.precio, rango)) and (not mes or mes_de(v) == mes)]
+    resultados.sort(key=lambda v: (-puntajes.get(v.id, 0.0), v.fecha or date.max, v.id))
+    return resultados, por_precio, por_mes
+
+def _buscar_en_postgres(texto, rango, mes, limite, desplazamiento):
+    consulta_ts = db.func.websearch_to_tsquery('spanish', db.func.f_unaccent(texto))
+    busqueda = db.literal_column('viaje.busqueda')
+    mes_expr = db.func.to_char(Viaje.fecha, 'YYYY-MM')
+    rango_expr = db.case(*[
+        (db.and_(*([Viaje.precio >= minimo] if minimo is not None else []),
+                 *([Viaje.precio < maximo] if maximo is not None else [])), clave)
+        for clave, _, minimo, maximo in RANGOS_PRECIO
+    ], else_=None)
+
+    filtro_texto = [busqueda.op('@@')(consulta_ts)] if texto else []
+    filtro_rango = [rango_expr == rango] if rango else []
+    filtro_mes = [mes_expr == mes] if mes else []
+
+    por_precio = dict(db.session.execute(
+        db.select(rango_expr, db.func.count())
+        .where(*filtro_texto, *filtro_mes, rango_expr.is_not(None))
+        .group_by(rango_expr)
+    ).all())
+    por_mes = dict(db.session.execute(
+        db.select(mes_expr, db.func.count())
+        .where(*filtro_texto, *filtro_rango, Viaje.fecha.is_not(None))
+        .group_by(mes_expr)
+    ).all())
+
+    orden = [Viaje.fecha.asc().nulls_last(), Viaje.id]
+    if texto:
+        orden.insert(0, db.func.ts_rank_cd(busqueda, consulta_ts).desc())
+    filas = db.session.execute(
+        db.select(Viaje.id, db.func.count().over())
+        .where(*filtro_texto, *filtro_rango, *filtro_mes)
+        .order_by(*orden)
+        .limit(limite)
+        .offset(desplazamiento)
+    ).all()
+    total = filas[0][1] if filas else 0
+    resultados = [v for v in (catalogo.obtener(viaje_id) for viaje_id, _ in filas) if v is not None]
+    return resultados, total, por_precio, por_mes
+
+def buscar_viajes(texto=None, rango=None, mes=None, pagina=1):
+    """Busca en el catálogo con facetas de precio y mes de salida.
+
+    Devuelve un dict con la página de resultados (ViajeSnapshot), el total y
+    las facetas [(clave, etiqueta, cantidad)] y [(mes, cantidad)].
+    """
+    texto = (texto or '').strip()[:200] or None
+    rango = rango if rango in _RANGOS_POR_CLAVE else None
+    pagina = max(1, pagina or 1)
+    desplazamiento = (pagina - 1) * BUSQUEDA_POR_PAGINA
+    if db.engine.dialect.name == 'postgresql':
+        resultados, total, por_precio, por_mes = _buscar_en_postgres(
+            texto, rango, mes, BUSQUEDA_POR_PAGINA, desplazamiento)
+    else:
+        todos, por_precio, por_mes = _buscar_en_memoria(texto, rango, mes)
+        total = len(todos)
+        resultados = todos[desplazamiento:desplazamiento + BUSQUEDA_POR_PAGINA]
+    return {
+        "texto": texto,
+        "rango": rango,
+        "mes": mes,
+        "pagina": pagina,
+        "paginas": max(1, -(-total // BUSQUEDA_POR_PAGINA)),
+        "total": total,
+        "resultados": resultados,
+        "facetas": {
+            "precio": [(clave, etiqueta, por_precio[clave])
+                       for clave, etiqueta, _, _ in RANGOS_PRECIO if por_precio.get(clave)],
+            "mes": sorted(por_mes.items()),
+        },
+    }
+
+def _parametros_busqueda():
+    mes = request.args.get("mes") or None
+    if mes and (len(mes) != 7 or _fecha_form(mes + "-01") is None):
+        mes = None
+    return dict(texto=request.args.get("q"), rango=request.args.get("precio"),
+                mes=mes, pagina=_arg_int("pagina") or 1)
+
+@app.route("/viajes/buscar")
+@lectura_replica
+@pagina_cacheada
+def buscar_viajes_pagina():
+    return render_template("viajes/buscar.html", **buscar_viajes(**_parametros_busqueda()))
+
+@app.route("/api/viajes/buscar")
+@lectura_replica
+def buscar_viajes_api():
+    busqueda = buscar_viajes(**_parametros_busqueda())
+    busqueda["resultados"] = [{
+        "id": v.id,
+        "nombre": v.nombre,
+        "descripcion": v.descripcion,
+        "fecha": v.fecha.isoformat() if v.fecha else None,
+        "precio": float(v.precio) if v.precio is not None else None,
+        "imagen": url_for('img', filename=v.imagen) if v.imagen else None,
+        "url": url_for('detalle_viaje', id=v.id),
+    } for v in busqueda["resultados"]]
+    busqueda["facetas"] = {
+        "precio": [{"clave": c, "etiqueta": e, "total": n} for c, e, n in busqueda["facetas"]["precio"]],
+        "mes": [{"clave": m, "total": n} for m, n in busqueda["facetas"]["mes"]],
+    }
+    respuesta = jsonify(busqueda)
+    respuesta.headers["Cache-Control"] = "public, max-age=30"
+    return respuesta
+
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -286,6 +3444,14 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def agente_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated or current_user.rol not in ('agente', 'admin'):
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
 @app.route('/viajes/nuevo', methods=['GET', 'POST'])
 @admin_required
 def nuevo_viaje():
@@ -293,16 +3459,17 @@ def nuevo_viaje():
     if request.method == "POST":
         nombre = request.form["nombre"]
         descripcion = request.form["descripcion"]
-        fecha = request.form.get("fecha")
+        fecha = _fecha_form(request.form.get("fecha"))
         precio = request.form.get("precio")
+        cupos = _cupos_form(request.form.get("cupos"))
         imagen = request.files.get("imagen")
         imagen_filename = None
         if imagen and allowed_file(imagen.filename):
-            filename = secure_filename(imagen.filename)
-            imagen.save(os.path.join(app.root_path, UPLOAD_FOLDER, filename))
-            imagen_filename = filename
-        viaje = Viaje(nombre=nombre, descripcion=descripcion, fecha=fecha, precio=precio, imagen=imagen_filename)
+            imagen_filename = guardar_imagen_subida(imagen)
+        viaje = Viaje(nombre=nombre, descripcion=descripcion, fecha=fecha, precio=precio,
+                      imagen=imagen_filename, cupos=cupos)
         db.session.add(viaje)
+        invalidar_catalogo()
         db.session.commit()
         flash("Viaje creado exitosamente.")
         return redirect(url_for("listar_viajes"))
@@ -315,13 +3482,23 @@ def editar_viaje(id):
     if request.method == "POST":
         viaje.nombre = request.form["nombre"]
         viaje.descripcion = request.form["descripcion"]
-        viaje.fecha = request.form.get("fecha")
+        viaje.fecha = _fecha_form(request.form.get("fecha"))
         viaje.precio = request.form.get("precio")
+        viaje.cupos = _cupos_form(request.form.get("cupos"))
+        if viaje.cupos is None:
+            Disponibilidad.query.filter_by(viaje_id=viaje.id).delete()
+        else:
+            # Nunca dejar la capacidad por debajo de lo ya reservado
+            Disponibilidad.query.filter_by(viaje_id=viaje.id).update({
+                Disponibilidad.capacidad: db.case(
+                    (Disponibilidad.reservados > viaje.cupos, Disponibilidad.reservados),
+                    else_=viaje.cupos,
+                )
+            }, synchronize_session=False)
         imagen = request.files.get("imagen")
         if imagen and allowed_file(imagen.filename):
-            filename = secure_filename(imagen.filename)
-            imagen.save(os.path.join(app.root_path, UPLOAD_FOLDER, filename))
-            viaje.imagen = filename
+            viaje.imagen = guardar_imagen_subida(imagen) or viaje.imagen
+        invalidar_catalogo()
         db.session.commit()
         flash("Viaje actualizado.")
         return redirect(url_for("listar_viajes"))
@@ -331,80 +3508,202 @@ def editar_viaje(id):
 @admin_required
 def eliminar_viaje(id):
     viaje = Viaje.query.get_or_404(id)
+    Disponibilidad.query.filter_by(viaje_id=viaje.id).delete()
     db.session.delete(viaje)
+    invalidar_catalogo()
     db.session.commit()
     flash("Viaje eliminado.")
     return redirect(url_for("listar_viajes"))
 
 @app.route("/galeria")
+@lectura_replica
+@pagina_cacheada
 def galeria():
     return render_template("galeria.html")
 
 @app.route("/nosotros")
+@pagina_cacheada
 def nosotros():
     return render_template("nosotros.html")
 
+# Paginación del listado de reservas (keyset sobre Reserva.id, sin OFFSET)
+RESERVAS_POR_PAGINA = int(os.environ.get("RESERVAS_POR_PAGINA", "20"))
+RESERVAS_POR_PAGINA_MAX = 100
+
+def _arg_int(nombre):
+    """Lee un parámetro entero de la query string; None si falta o no es válido."""
+    valor = request.args.get(nombre, type=int)
+    return valor if valor is not None and valor > 0 else None
+
 @app.route("/reservas")
+@lectura_replica
 @login_required
 def listar_reservas():
+    por_pagina = _arg_int("por_pagina") or RESERVAS_POR_PAGINA
+    por_pagina = min(por_pagina, RESERVAS_POR_PAGINA_MAX)
+    cursor = _arg_int("antes")  # id de la última reserva de la página anterior
+    viaje_id = _arg_int("viaje_id")
+    usuario_id = _arg_int("usuario_id")
+    desde = _fecha_form(request.args.get("desde"))
+    hasta = _fecha_form(request.args.get("hasta"))
+
+    # Cargar viaje y usuario en la misma consulta para evitar un SELECT por fila
+    query = Reserva.query.options(joinedload(Reserva.viaje), joinedload(Reserva.usuario),
+                                  joinedload(Reserva.grupo))
     if current_user.rol == 'admin':
-        reservas = Reserva.query.all()
+        if usuario_id:
+            query = query.filter(Reserva.usuario_id == usuario_id)
     else:
-        reservas = Reserva.query.filter_by(usuario_id=current_user.id).all()
-    return render_template('reservas/listar.html', reservas=reservas)
+        query = query.filter(Reserva.usuario_id == current_user.id)
+    if viaje_id:
+        query = query.filter(Reserva.viaje_id == viaje_id)
+    if desde:
+        query = query.filter(Reserva.fecha >= desde)
+    if hasta:
+        query = query.filter(Reserva.fecha <= hasta)
+    if cursor:
+        query = query.filter(Reserva.id < cursor)
+
+    # Pedimos una fila extra para saber si existe una página siguiente
+    reservas = query.order_by(Reserva.id.desc()).limit(por_pagina + 1).all()
+    siguiente = None
+    if len(reservas) > por_pagina:
+        reservas = reservas[:por_pagina]
+        siguiente = reservas[-1].id
+
+    filtros = {
+        "viaje_id": viaje_id,
+        "usuario_id": usuario_id if current_user.rol == 'admin' else None,
+        "desde": desde,
+        "hasta": hasta,
+        "por_pagina": por_pagina if por_pagina != RESERVAS_POR_PAGINA else None,
+    }
+    filtros = {k: v for k, v in filtros.items() if v is not None}
+    viajes = sorted(catalogo.todos(), key=lambda v: v.nombre)
+    return render_template('reservas/listar.html', reservas=reservas, viajes=viajes,
+                           filtros=filtros, siguiente=siguiente, es_primera=cursor is None)
+
+# --- Exportación de reservas (CSV / NDJSON) --------------------------------
+# La respuesta se genera mientras se leen las filas: la consulta usa yield_per,
+# que en Postgres/psycopg2 abre un cursor con nombre del lado del servidor, así
+# que la memoria no depende de cuántas reservas se exporten.
+EXPORTACION_LOTE = int(os.environ.get("EXPORTACION_LOTE", "1000"))
+COLUMNAS_EXPORTACION = ('id', 'fecha', 'viaje_id', 'viaje', 'usuario_id', 'usuario',
+                        'nombre', 'email', 'mensaje')
+
+# gunicorn.conf.py registra aquí el latido del worker (pre_request). Un worker
+# sync no avisa al arbiter mientras atiende una request, así que las
+# exportaciones largas lo llaman entre lotes para no superar el timeout.
+latido_worker = None
+
+def registrar_latido_worker(funcion):
+    global latido_worker
+    latido_worker = funcion
+
+def _consulta_exportacion(viaje_id=None, usuario_id=None, desde=None, hasta=None):
+    consulta = (
+        db.select(Reserva.id, Reserva.fecha, Reserva.viaje_id, Viaje.nombre,
+                  Reserva.usuario_id, Usuario.username, Reserva.nombre,
+                  Reserva.email, Reserva.mensaje)
+        .join(Viaje, Viaje.id == Reserva.viaje_id)
+        .outerjoin(Usuario, Usuario.id == Reserva.usuario_id)
+        .order_by(Reserva.id)
+    )
+    if viaje_id:
+        consulta = consulta.where(Reserva.viaje_id == viaje_id)
+    if usuario_id:
+        consulta = consulta.where(Reserva.usuario_id == usuario_id)
+    if desde:
+        consulta = consulta.where(Reserva.fecha >= desde)
+    if hasta:
+        consulta = consulta.where(Reserva.fecha <= hasta)
+    return consulta.execution_options(yield_per=EXPORTACION_LOTE)
+
+def _lotes_exportacion(consulta):
+    """Genera listas de filas de a EXPORTACION_LOTE, avisando al worker entre lotes."""
+    for lote in db.session.execute(consulta).partitions():
+        yield lote
+        if latido_worker is not None:
+            latido_worker()
+
+def _exportar_csv(consulta):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(COLUMNAS_EXPORTACION)
+    for lote in _lotes_exportacion(consulta):
+        escritor.writerows(lote)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def _exportar_ndjson(consulta):
+    for lote in _lotes_exportacion(consulta):
+        yield "".join(
+            json.dumps(dict(zip(COLUMNAS_EXPORTACION, fila)), default=str, ensure_ascii=False) + "\n"
+            for fila in lote
+        )
+
+FORMATOS_EXPORTACION = {
+    'csv': (_exportar_csv, 'text/csv'),
+    'ndjson': (_exportar_ndjson, 'application/x-ndjson'),
+}
+
+@app.route("/admin/reservas/export.<formato>")
+@lectura_replica
+@admin_required
+def exportar_reservas(formato):
+    if formato not in FORMATOS_EXPORTACION:
+        abort(404)
+    generador, mimetype = FORMATOS_EXPORTACION[formato]
+    consulta = _consulta_exportacion(
+        viaje_id=_arg_int("viaje_id"),
+        usuario_id=_arg_int("usuario_id"),
+        desde=_fecha_form(request.args.get("desde")),
+        hasta=_fecha_form(request.args.get("hasta")),
+    )
+    nombre = f"reservas-{date.today().isoformat()}.{formato}"
+    respuesta = app.response_class(stream_with_context(generador(consulta)), mimetype=mimetype)
+    respuesta.headers["Content-Disposition"] = f'attachment; filename="{nombre}"'
+    respuesta.headers["Cache-Control"] = "no-store"
+    # Que un proxy (nginx) no acumule la respuesta entera antes de reenviarla
+    respuesta.headers["X-Accel-Buffering"] = "no"
+    return respuesta
 
 @app.route('/reservas/nueva', methods=['GET', 'POST'])
 @login_required
 def nueva_reserva():
     # solo usuario autenticado
-    LIMITE_RESERVAS_POR_USUARIO = 7
-
-    # Chequeo de límite antes de mostrar el formulario
-    total_usuario = Reserva.query.filter_by(usuario_id=current_user.id).count()
-    if total_usuario >= LIMITE_RESERVAS_POR_USUARIO:
-        flash(f"Has alcanzado el límite de {LIMITE_RESERVAS_POR_USUARIO} reservas. Cancela alguna para crear una nueva.")
-        return redirect(url_for("listar_reservas"))
-
-    viajes = Viaje.query.all()
     if request.method == "POST":
-        # Revalidar por seguridad antes de insertar
-        total_usuario = Reserva.query.filter_by(usuario_id=current_user.id).count()
-        if total_usuario >= LIMITE_RESERVAS_POR_USUARIO:
-            flash(f"Has alcanzado el límite de {LIMITE_RESERVAS_POR_USUARIO} reservas. Cancela alguna para crear una nueva.")
-            return redirect(url_for("listar_reservas"))
-
         nombre = request.form["nombre"]
         email = request.form["email"]
         viaje_id = int(request.form["viaje_id"])  # asegurar tipo entero para comparar
-        fecha = request.form["fecha"]
+        fecha = _fecha_form(request.form["fecha"])
         mensaje = request.form.get("mensaje")
-
-        # Validación: el usuario no puede tener 2 reservas en la misma fecha
-        duplicada = Reserva.query.filter_by(usuario_id=current_user.id, fecha=fecha).first()
-        if duplicada:
-            flash("Ya tienes una reserva para esa fecha. Elige otra fecha o edita la existente.")
-            return redirect(url_for("listar_reservas"))
-
-        # Validación adicional: mismo viaje en la misma fecha
-        mismo_viaje_misma_fecha = Reserva.query.filter_by(
-            usuario_id=current_user.id, viaje_id=viaje_id, fecha=fecha
-        ).first()
-        if mismo_viaje_misma_fecha:
-            flash("Ya tienes una reserva para ese mismo viaje en esa fecha.")
-            return redirect(url_for("listar_reservas"))
-        reserva = Reserva(
-            nombre=nombre,
-            email=email,
-            fecha=fecha,
-            mensaje=mensaje,
-            viaje_id=viaje_id,
-            usuario_id=current_user.id
-        )
-        db.session.add(reserva)
+        if fecha is None:
+            flash("La fecha no es válida.")
+            return redirect(url_for("nueva_reserva"))
+        try:
+            reserva = crear_reserva(current_user.id, viaje_id, fecha, nombre, email, mensaje)
+        except ReservaRechazada as e:
+            db.session.rollback()
+            flash(str(e))
+            # Límite y fecha repetida se resuelven desde el listado; el cupo eligiendo otra fecha
+            if e.codigo in ('limite', 'fecha_ocupada'):
+                return redirect(url_for("listar_reservas"))
+            return redirect(url_for("nueva_reserva"))
+        viaje = catalogo.obtener(viaje_id)
+        send_booking_email(reserva, viaje.nombre if viaje else "tu viaje")
         db.session.commit()
         flash("Reserva creada exitosamente.")
         return redirect(url_for("listar_reservas"))
-    return render_template("reservas/nueva.html", viajes=viajes)
+
+    # Chequeo de cuota antes de mostrar el formulario
+    total_usuario, limite = uso_de_cuota(current_user.id)
+    if total_usuario >= limite:
+        flash(MENSAJES_RESERVA['limite'].format(limite=limite))
+        return redirect(url_for("listar_reservas"))
+    return render_template("reservas/nueva.html", viajes=catalogo.todos())
 
 @app.route("/reservas/<int:id>/editar", methods=["GET", "POST"])
 @login_required
@@ -412,44 +3711,29 @@ def editar_reserva(id):
     reserva = Reserva.query.get_or_404(id)
     if reserva.usuario_id != current_user.id and current_user.rol != 'admin':
         abort(403)
-    viajes = Viaje.query.all()
+    if reserva.grupo_id is not None:
+        flash("Los pasajeros de un grupo se editan desde el grupo.")
+        return redirect(url_for("editar_grupo", id=reserva.grupo_id))
     if request.method == "POST":
-        nuevo_nombre = request.form["nombre"]
-        nuevo_email = request.form["email"]
         nuevo_viaje_id = int(request.form["viaje_id"])  # asegurar entero
-        nueva_fecha = request.form["fecha"]
-        nuevo_mensaje = request.form.get("mensaje")
-
-        # Validación: evitar duplicar fecha con otra reserva del mismo usuario
-        conflicto = (Reserva.query
-                     .filter(Reserva.usuario_id == reserva.usuario_id,
-                             Reserva.fecha == nueva_fecha,
-                             Reserva.id != reserva.id)
-                     .first())
-        if conflicto:
-            flash("Ya existe otra reserva tuya para esa fecha. Usa una fecha distinta.")
+        nueva_fecha = _fecha_form(request.form["fecha"])
+        if nueva_fecha is None:
+            flash("La fecha no es válida.")
             return redirect(url_for("editar_reserva", id=reserva.id))
-
-        # Validación adicional: mismo viaje + misma fecha en otra reserva
-        conflicto_viaje_fecha = (Reserva.query
-                                 .filter(Reserva.usuario_id == reserva.usuario_id,
-                                         Reserva.viaje_id == nuevo_viaje_id,
-                                         Reserva.fecha == nueva_fecha,
-                                         Reserva.id != reserva.id)
-                                 .first())
-        if conflicto_viaje_fecha:
-            flash("Ya tienes otra reserva para ese mismo viaje en esa fecha.")
+        try:
+            modificar_reserva(reserva, nuevo_viaje_id, nueva_fecha, request.form["nombre"],
+                              request.form["email"], request.form.get("mensaje"))
+        except ReservaRechazada as e:
+            db.session.rollback()
+            if e.codigo == 'fecha_ocupada':
+                flash("Ya existe otra reserva tuya para esa fecha. Usa una fecha distinta.")
+            else:
+                flash(str(e))
             return redirect(url_for("editar_reserva", id=reserva.id))
-
-        reserva.nombre = nuevo_nombre
-        reserva.email = nuevo_email
-        reserva.viaje_id = nuevo_viaje_id
-        reserva.fecha = nueva_fecha
-        reserva.mensaje = nuevo_mensaje
         db.session.commit()
         flash("Reserva actualizada.")
         return redirect(url_for("listar_reservas"))
-    return render_template("reservas/editar.html", reserva=reserva, viajes=viajes)
+    return render_template("reservas/editar.html", reserva=reserva, viajes=catalogo.todos())
 
 @app.route("/reservas/<int:id>/eliminar", methods=["POST"])
 @login_required
@@ -457,25 +3741,615 @@ def eliminar_reserva(id):
     reserva = Reserva.query.get_or_404(id)
     if reserva.usuario_id != current_user.id and current_user.rol != 'admin':
         abort(403)
+    liberar_cupo(reserva.viaje_id, reserva.fecha)
     db.session.delete(reserva)
     db.session.commit()
     flash("Reserva eliminada.")
     return redirect(url_for("listar_reservas"))
 
+def calendario_viaje(viaje, mes, usuario_id=None):
+    """Cupos restantes por día de 'mes' para el viaje y fechas ya reservadas por el usuario."""
+    import calendar
+    dias_mes = calendar.monthrange(mes.year, mes.month)[1]
+    restantes = None
+    if viaje.cupos is not None:
+        # Sin fila de inventario la salida no tiene reservas: quedan todos los cupos
+        restantes = [viaje.cupos] * dias_mes
+        for fecha, capacidad, reservados in db.session.execute(
+            db.select(Disponibilidad.fecha, Disponibilidad.capacidad, Disponibilidad.reservados)
+            .where(Disponibilidad.viaje_id == viaje.id,
+                   Disponibilidad.fecha >= mes,
+                   Disponibilidad.fecha <= mes.replace(day=dias_mes))
+        ):
+            restantes[fecha.day - 1] = max(0, capacidad - reservados)
+    bits = dias_reservados(usuario_id, mes) if usuario_id is not None else 0
+    return {
+        "viaje_id": viaje.id,
+        "mes": mes.strftime("%Y-%m"),
+        "cupos": viaje.cupos,
+        "restantes": restantes,
+        "mis_fechas": [mes.replace(day=d + 1).isoformat() for d in range(dias_mes) if bits >> d & 1],
+    }
+
+@app.route("/api/viajes/<int:id>/disponibilidad")
+@lectura_replica
+def disponibilidad_viaje(id):
+    viaje = catalogo.obtener_or_404(id)
+    mes = _fecha_form((request.args.get("mes") or "") + "-01") or date.today().replace(day=1)
+    usuario_id = current_user.id if current_user.is_authenticated else None
+    respuesta = jsonify(calendario_viaje(viaje, mes, usuario_id))
+    respuesta.headers["Cache-Control"] = "private, no-cache"
+    return respuesta
+
+# --- Reservas grupales ---------------------------------------------------------
+GRUPOS_POR_PAGINA = 20
+
+def _pasajeros_form(texto, email_contacto):
+    """Un pasajero por línea: 'Nombre' o 'Nombre, email' (sin email se usa el del grupo)."""
+    pasajeros = []
+    for linea in (texto or '').splitlines():
+        linea = linea.strip()
+        if not linea:
+            continue
+        nombre, _, email = linea.rpartition(',') if '@' in linea.rpartition(',')[2] else (linea, '', '')
+        pasajeros.append((nombre.strip()[:100], (email.strip() or email_contacto)[:120]))
+    return pasajeros
+
+def _grupo_propio_or_404(id):
+    grupo = GrupoReserva.query.get_or_404(id)
+    if grupo.usuario_id != current_user.id and current_user.rol != 'admin':
+        abort(403)
+    return grupo
+
+@app.route("/grupos")
+@lectura_replica
+@agente_required
+def listar_grupos():
+    cursor = _arg_int("antes")
+    pasajeros = (db.select(db.func.count()).select_from(Reserva)
+                 .where(Reserva.grupo_id == GrupoReserva.id).scalar_subquery())
+    consulta = db.select(GrupoReserva, pasajeros).options(joinedload(GrupoReserva.viaje))
+    if current_user.rol != 'admin':
+        consulta = consulta.where(GrupoReserva.usuario_id == current_user.id)
+    if cursor:
+        consulta = consulta.where(GrupoReserva.id < cursor)
+    grupos = db.session.execute(consulta.order_by(GrupoReserva.id.desc()).limit(GRUPOS_POR_PAGINA + 1)).all()
+    siguiente = None
+    if len(grupos) > GRUPOS_POR_PAGINA:
+        grupos = grupos[:GRUPOS_POR_PAGINA]
+        siguiente = grupos[-1][0].id
+    return render_template("grupos/listar.html", grupos=grupos, siguiente=siguiente,
+                           es_primera=cursor is None)
+
+@app.route("/grupos/nuevo", methods=["GET", "POST"])
+@agente_required
+def nuevo_grupo():
+    if request.method == "POST":
+        nombre = request.form["nombre"].strip()[:100]
+        email = request.form["email"].strip()[:120]
+        viaje_id = int(request.form["viaje_id"])
+        fecha = _fecha_form(request.form["fecha"])
+        pasajeros = _pasajeros_form(request.form.get("pasajeros"), email)
+        if fecha is None:
+            flash("La fecha no es válida.")
+            return render_template("grupos/nuevo.html", viajes=catalogo.todos(), form=request.form)
+        try:
+            grupo = crear_grupo(current_user.id, viaje_id, fecha, nombre, email, pasajeros,
+                                request.form.get("mensaje"))
+        except ReservaRechazada as e:
+            db.session.rollback()
+            flash(str(e))
+            return render_template("grupos/nuevo.html", viajes=catalogo.todos(), form=request.form)
+        viaje = catalogo.obtener(viaje_id)
+        send_group_email(grupo, viaje.nombre if viaje else "tu viaje", len(pasajeros))
+        db.session.commit()
+        flash(f"Grupo creado con {len(pasajeros)} pasajeros.")
+        return redirect(url_for("listar_grupos"))
+    return render_template("grupos/nuevo.html", viajes=catalogo.todos(), form={})
+
+@app.route("/grupos/<int:id>/editar", methods=["GET", "POST"])
+@agente_required
+def editar_grupo(id):
+    grupo = _grupo_propio_or_404(id)
+    if request.method == "POST":
+        email = request.form["email"].strip()[:120]
+        fecha = _fecha_form(request.form["fecha"])
+        if fecha is None:
+            flash("La fecha no es válida.")
+            return redirect(url_for("editar_grupo", id=grupo.id))
+        pasajeros = _pasajeros_form(request.form.get("pasajeros"), email)
+        try:
+            modificar_grupo(grupo, int(request.form["viaje_id"]), fecha, request.form["nombre"].strip()[:100],
+                            email, pasajeros, request.form.get("mensaje"))
+        except ReservaRechazada as e:
+            db.session.rollback()
+            flash(str(e))
+            return redirect(url_for("editar_grupo", id=grupo.id))
+        db.session.commit()
+        flash(f"Grupo actualizado: {len(pasajeros)} pasajeros.")
+        return redirect(url_for("listar_grupos"))
+    pasajeros = (Reserva.query.filter_by(grupo_id=grupo.id)
+                 .with_entities(Reserva.nombre, Reserva.email).order_by(Reserva.id).all())
+    texto = "\n".join(nombre if email == grupo.email else f"{nombre}, {email}" for nombre, email in pasajeros)
+    return render_template("grupos/editar.html", grupo=grupo, pasajeros=texto, viajes=catalogo.todos())
+
+@app.route("/grupos/<int:id>/eliminar", methods=["POST"])
+@agente_required
+def eliminar_grupo(id):
+    grupo = _grupo_propio_or_404(id)
+    cancelar_grupo(grupo)
+    db.session.commit()
+    flash("Grupo cancelado.")
+    return redirect(url_for("listar_grupos"))
+
+
+# --- Importación masiva (CSV / JSON lines) ---------------------------------
+# Los archivos se leen como flujo y se procesan en lotes de IMPORTACION_LOTE
+# filas: cada lote se valida con pocas consultas agrupadas, se carga con COPY
+# en una tabla temporal (Postgres) y se fusiona con un INSERT ... SELECT. La
+# memoria usada depende del tamaño del lote, no del archivo.
+IMPORTACION_LOTE = int(os.environ.get("IMPORTACION_LOTE", "2000"))
+IMPORTACION_ERRORES_MAX = 200  # errores que se guardan para mostrar en la vista
+
+class ResultadoImportacion:
+    """Totales de una importación y errores por fila (línea del archivo)."""
+
+    def __init__(self, al_error=None):
+        self.leidas = 0
+        self.importadas = 0
+        self.total_errores = 0
+        self.errores = []
+        self.al_error = al_error
+
+    def error(self, linea, mensaje):
+        self.total_errores += 1
+        if len(self.errores) < IMPORTACION_ERRORES_MAX:
+            self.errores.append((linea, mensaje))
+        if self.al_error:
+            self.al_error(linea, mensaje)
+
+def formato_importacion(nombre_archivo):
+    """'jsonl' para .jsonl/.ndjson/.json, 'csv' para el resto."""
+    ext = os.path.splitext(nombre_archivo or "")[1].lower()
+    return 'jsonl' if ext in ('.jsonl', '.ndjson', '.json') else 'csv'
+
+def leer_filas(flujo, formato):
+    """Genera (linea, fila, error) desde un flujo de texto sin cargarlo entero."""
+    if formato == 'csv':
+        lector = csv.DictReader(flujo)
+        for fila in lector:
+            yield lector.line_num, {
+                k.strip(): v.strip() if isinstance(v, str) else v
+                for k, v in fila.items() if k
+            }, None
+        return
+    for linea, texto in enumerate(flujo, 1):
+        if not texto.strip():
+            continue
+        try:
+            fila = json.loads(texto)
+        except ValueError as e:
+            yield linea, None, f"JSON inválido: {e}"
+            continue
+        if not isinstance(fila, dict):
+            yield linea, None, "Se esperaba un objeto JSON por línea."
+            continue
+        yield linea, {k: v.strip() if isinstance(v, str) else v for k, v in fila.items()}, None
+
+def _en_lotes(iterable, tamano):
+    iterador = iter(iterable)
+    while lote := list(itertools.islice(iterador, tamano)):
+        yield lote
+
+def _texto(fila, campo):
+    valor = fila.get(campo)
+    if valor is None:
+        return None
+    valor = str(valor).strip()
+    return valor or None
+
+def _entero(fila, campo):
+    try:
+        return int(fila.get(campo))
+    except (TypeError, ValueError):
+        return None
+
+def _copy_disponible(conexion):
+    """COPY sólo con psycopg2 y fuera del modo green (gunicorn gevent), que no lo admite."""
+    if conexion.dialect.name != 'postgresql' or conexion.dialect.driver != 'psycopg2':
+        return False
+    from psycopg2 import extensions
+    return extensions.get_wait_callback() is None
+
+def _insertar_por_staging(tabla, columnas, filas):
+    """Inserta tuplas en 'tabla' dentro de la transacción actual.
+
+    Con Postgres + psycopg2 las filas se cargan con COPY (copy_expert) en una
+    tabla temporal que se descarta al commit y se fusionan con un único
+    INSERT ... SELECT. En otros motores (SQLite en desarrollo) o bajo gevent
+    se usa executemany.
+    """
+    if not filas:
+        return
+    columnas_sql = ", ".join(columnas)
+    conexion = db.session.connection()
+    if not _copy_disponible(conexion):
+        marcadores = ", ".join(f":{c}" for c in columnas)
+        conexion.execute(db.text(f"INSERT INTO {tabla} ({columnas_sql}) VALUES ({marcadores})"),
+                         [dict(zip(columnas, fila)) for fila in filas])
+        return
+    staging = f"importacion_{tabla}"
+    conexion.execute(db.text(
+        f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+        f"SELECT {columnas_sql} FROM {tabla} WITH NO DATA"
+    ))
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(filas)
+    buffer.seek(0)
+    cursor = conexion.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {staging} ({columnas_sql}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+    conexion.execute(db.text(
+        f"INSERT INTO {tabla} ({columnas_sql}) SELECT {columnas_sql} FROM {staging}"
+    ))
+
+COLUMNAS_IMPORTACION_VIAJES = ('nombre', 'descripcion', 'fecha', 'precio', 'cupos', 'imagen')
+
+def _importar_lote_viajes(lote, resultado):
+    validas = []
+    for linea, fila, error in lote:
+        resultado.leidas += 1
+        if error:
+            resultado.error(linea, error)
+            continue
+        nombre = _texto(fila, 'nombre')
+        descripcion = _texto(fila, 'descripcion')
+        if not nombre or not descripcion:
+            resultado.error(linea, "Faltan 'nombre' o 'descripcion'.")
+            continue
+        fecha = None
+        if _texto(fila, 'fecha'):
+            fecha = _fecha_form(_texto(fila, 'fecha'))
+            if fecha is None:
+                resultado.error(linea, "La fecha no es válida.")
+                continue
+        precio = _texto(fila, 'precio')
+        if precio is not None:
+            try:
+                precio = round(float(precio), 2)
+            except ValueError:
+                resultado.error(linea, "El precio no es válido.")
+                continue
+        cupos = None
+        if _texto(fila, 'cupos'):
+            cupos = _cupos_form(_texto(fila, 'cupos'))
+            if cupos is None:
+                resultado.error(linea, "Los cupos no son válidos.")
+                continue
+        imagen = _texto(fila, 'imagen')
+        validas.append((nombre[:100], descripcion, fecha, precio, cupos,
+                        secure_filename(imagen) if imagen else None))
+    if not validas:
+        return
+    _insertar_por_staging('viaje', COLUMNAS_IMPORTACION_VIAJES, validas)
+    _sumar_contador(db.session.connection(), 'viajes', len(validas))
+    invalidar_catalogo()
+    db.session.commit()
+    resultado.importadas += len(validas)
+
+def importar_viajes(filas, resultado=None):
+    """Importa viajes desde filas de leer_filas(). Devuelve el ResultadoImportacion."""
+    resultado = resultado or ResultadoImportacion()
+    for lote in _en_lotes(filas, IMPORTACION_LOTE):
+        _importar_lote_viajes(lote, resultado)
+    return resultado
+
+COLUMNAS_IMPORTACION_RESERVAS = ('nombre', 'email', 'fecha', 'mensaje', 'viaje_id', 'usuario_id')
+
+def _importar_lote_reservas(lote, resultado):
+    # 1) Validación de campos, sin tocar la base
+    candidatas = []
+    for linea, fila, error in lote:
+        resultado.leidas += 1
+        if error:
+            resultado.error(linea, error)
+            continue
+        nombre = _texto(fila, 'nombre')
+        email = _texto(fila, 'email')
+        if not nombre or not email:
+            resultado.error(linea, "Faltan 'nombre' o 'email'.")
+            continue
+        fecha = _fecha_form(_texto(fila, 'fecha'))
+        if fecha is None:
+            resultado.error(linea, "La fecha no es válida.")
+            continue
+        viaje = catalogo.obtener(_entero(fila, 'viaje_id'))
+        if viaje is None:
+            resultado.error(linea, "El viaje no existe.")
+            continue
+        usuario = _entero(fila, 'usuario_id') or _texto(fila, 'usuario')
+        if usuario is None:
+            resultado.error(linea, "Falta 'usuario_id' o 'usuario'.")
+            continue
+        candidatas.append((linea, nombre[:100], email[:120], fecha,
+                           _texto(fila, 'mensaje'), viaje, usuario))
+    if not candidatas:
+        return
+
+    # 2) Resolver usuarios por username y bloquearlos (en orden de id, como
+    #    nueva_reserva) para que las validaciones no compitan con reservas web
+    nombres = {c[6] for c in candidatas if isinstance(c[6], str)}
+    por_nombre = dict(db.session.execute(
+        db.select(Usuario.username, Usuario.id).where(Usuario.username.in_(nombres))
+    ).all()) if nombres else {}
+    ids = {por_nombre.get(c[6], 0) if isinstance(c[6], str) else c[6] for c in candidatas}
+    limites = dict(db.session.execute(
+        db.select(Usuario.id, _limite_usuario()).where(Usuario.id.in_(ids)).order_by(Usuario.id).with_for_update()
+    ).all())
+    existentes = set(limites)
+
+    # 3) Estado actual de esos usuarios en dos consultas agrupadas
+    totales = dict(db.session.execute(
+        db.select(Reserva.usuario_id, db.func.count())
+        .where(Reserva.usuario_id.in_(existentes))
+        .group_by(Reserva.usuario_id)
+    ).all()) if existentes else {}
+    ocupadas = {}
+    if existentes:
+        for usuario_id, viaje_id, fecha in db.session.execute(
+            db.select(Reserva.usuario_id, Reserva.viaje_id, Reserva.fecha)
+            .where(Reserva.usuario_id.in_(existentes), Reserva.grupo_id.is_(None))
+        ):
+            ocupadas.setdefault((usuario_id, fecha), set()).add(viaje_id)
+
+    # 4) Inventario de las salidas con cupos, bloqueado en orden
+    salidas = sorted({(c[5].id, c[3]) for c in candidatas if c[5].cupos is not None})
+    for viaje_id, fecha in salidas:
+        asegurar_disponibilidad(viaje_id, fecha, catalogo.obtener(viaje_id).cupos)
+    libres = {}
+    if salidas:
+        libres = {
+            (viaje_id, fecha): capacidad - reservados
+            for viaje_id, fecha, capacidad, reservados in db.session.execute(
+                db.select(Disponibilidad.viaje_id, Disponibilidad.fecha,
+                          Disponibilidad.capacidad, Disponibilidad.reservados)
+                .where(db.tuple_(Disponibilidad.viaje_id, Disponibilidad.fecha).in_(salidas))
+                .order_by(Disponibilidad.viaje_id, Disponibilidad.fecha)
+                .with_for_update()
+            )
+        }
+
+    # 5) Reglas de nueva_reserva fila por fila, acumulando lo ya aceptado
+    validas = []
+    ocupados_por_salida = {}
+    for linea, nombre, email, fecha, mensaje, viaje, usuario in candidatas:
+        usuario_id = por_nombre.get(usuario) if isinstance(usuario, str) else usuario
+        if usuario_id not in existentes:
+            resultado.error(linea, "El usuario no existe.")
+            continue
+        if totales.get(usuario_id, 0) >= limites[usuario_id]:
+            resultado.error(linea, f"El usuario alcanzó el límite de {limites[usuario_id]} reservas.")
+            continue
+        viajes_en_fecha = ocupadas.get((usuario_id, fecha), set())
+        if viaje.id in viajes_en_fecha:
+            resultado.error(linea, "El usuario ya tiene una reserva para ese mismo viaje en esa fecha.")
+            continue
+        if viajes_en_fecha:
+            resultado.error(linea, "El usuario ya tiene una reserva para esa fecha.")
+            continue
+        salida = (viaje.id, fecha)
+        if salida in libres:
+            if libres[salida] <= 0:
+                resultado.error(linea, "No quedan cupos para ese viaje en esa fecha.")
+                continue
+            libres[salida] -= 1
+        totales[usuario_id] = totales.get(usuario_id, 0) + 1
+        ocupadas.setdefault((usuario_id, fecha), set()).add(viaje.id)
+        ocupados_por_salida[salida] = ocupados_por_salida.get(salida, 0) + 1
+        validas.append((nombre, email, fecha, mensaje, viaje.id, usuario_id))
+    if not validas:
+        db.session.rollback()
+        return
+
+    # 6) Carga, inventario y estadísticas en la misma transacción
+    _insertar_por_staging('reserva', COLUMNAS_IMPORTACION_RESERVAS, validas)
+    conexion = db.session.connection()
+    dias_por_mes = {}
+    for _, _, fecha, _, _, usuario_id in validas:
+        clave = (usuario_id, fecha.replace(day=1))
+        dias_por_mes[clave] = dias_por_mes.get(clave, 0) | _bit_dia(fecha)
+    for (usuario_id, mes), bits in sorted(dias_por_mes.items()):
+        _marcar_dias_usuario(conexion, usuario_id, mes, bits)
+    for (viaje_id, fecha), cantidad in sorted(ocupados_por_salida.items()):
+        if (viaje_id, fecha) in libres:
+            db.session.execute(
+                db.update(Disponibilidad)
+                .where(Disponibilidad.viaje_id == viaje_id, Disponibilidad.fecha == fecha)
+                .values(reservados=Disponibilidad.reservados + cantidad)
+            )
+        _sumar_viaje_dia(conexion, viaje_id, fecha, cantidad)
+    _sumar_contador(conexion, 'reservas', len(validas))
+    db.session.commit()
+    resultado.importadas += len(validas)
+
+def importar_reservas(filas, resultado=None):
+    """Importa reservas desde filas de leer_filas() con las reglas de nueva_reserva.
+
+    Cada fila necesita nombre, email, fecha (YYYY-MM-DD), viaje_id y
+    usuario_id o usuario (username); mensaje es opcional. Cada lote se
+    confirma por separado. No se envían correos de confirmación.
+    """
+    resultado = resultado or ResultadoImportacion()
+    for lote in _en_lotes(filas, IMPORTACION_LOTE):
+        _importar_lote_reservas(lote, resultado)
+    return resultado
+
+IMPORTADORES = {'viajes': importar_viajes, 'reservas': importar_reservas}
+
+@app.cli.command("importar")
+@click.argument("tipo", type=click.Choice(sorted(IMPORTADORES)))
+@click.argument("archivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--formato", type=click.Choice(["csv", "jsonl"]), help="Por defecto según la extensión del archivo.")
+@click.option("--errores", type=click.Path(dir_okay=False, writable=True), help="Escribir los errores por fila en este CSV.")
+def importar_command(tipo, archivo, formato, errores):
+    """Importa viajes o reservas desde un CSV o JSON lines."""
+    formato = formato or formato_importacion(archivo)
+    salida_errores = open(errores, "w", newline="", encoding="utf-8") if errores else None
+    try:
+        if salida_errores:
+            escritor = csv.writer(salida_errores)
+            escritor.writerow(["linea", "error"])
+            resultado = ResultadoImportacion(al_error=lambda linea, mensaje: escritor.writerow([linea, mensaje]))
+        else:
+            resultado = ResultadoImportacion(al_error=lambda linea, mensaje: click.echo(f"línea {linea}: {mensaje}", err=True))
+        with open(archivo, newline="", encoding="utf-8-sig") as flujo:
+            IMPORTADORES[tipo](leer_filas(flujo, formato), resultado)
+    finally:
+        if salida_errores:
+            salida_errores.close()
+    click.echo(f"Leídas: {resultado.leidas}, importadas: {resultado.importadas}, "
+               f"con error: {resultado.total_errores}.")
+
+@app.route('/admin/importar', methods=['GET', 'POST'])
+@admin_required
+def importar():
+    resultado = None
+    tipo = request.form.get("tipo", "reservas")
+    if request.method == "POST":
+        archivo = request.files.get("archivo")
+        if tipo not in IMPORTADORES or not archivo or not archivo.filename:
+            flash("Elige qué importar y un archivo CSV o JSON lines.")
+            return redirect(url_for("importar"))
+        # El stream del upload ya está en disco (o en memoria si es chico);
+        # se decodifica de a poco, sin leerlo completo
+        flujo = io.TextIOWrapper(archivo.stream, encoding="utf-8-sig", newline="")
+        resultado = IMPORTADORES[tipo](leer_filas(flujo, formato_importacion(archivo.filename)))
+    return render_template("admin/importar.html", resultado=resultado, tipo=tipo)
+
 @app.route("/viajes/<int:id>")
+@lectura_replica
+@pagina_cacheada
 def detalle_viaje(id):
-    viaje = Viaje.query.get_or_404(id)
+    viaje = catalogo.obtener_or_404(id)
     return render_template("viajes/detalle.html", viaje=viaje)
 
 @app.route("/prueba")
 def prueba():
     return render_template("prueba.html")
 
+# Límite de intentos (token bucket) para login, registro y recuperación de
+# contraseña: por IP y por username. Se cobra antes de tocar la base o calcular
+# un hash, así una ráfaga de credenciales robadas no consume CPU de hashing.
+# 'memoria' es por worker; 'db' comparte los cubos entre workers e instancias.
+LIMITE_BACKEND = os.environ.get("LIMITE_BACKEND", "memoria")  # memoria/db/off
+LIMITE_POR_IP = os.environ.get("LIMITE_POR_IP", "20/60")  # intentos/segundos
+LIMITE_POR_USUARIO = os.environ.get("LIMITE_POR_USUARIO", "5/300")
+
+def _parsear_limite(valor):
+    intentos, segundos = valor.split('/')
+    return int(intentos), float(segundos)
+
+def _recargar_cubo(fichas, actualizado, ahora, capacidad, periodo):
+    """Devuelve (fichas restantes, segundos de espera). Espera 0 = intento permitido."""
+    fichas = min(capacidad, fichas + (ahora - actualizado) * capacidad / periodo)
+    if fichas >= 1:
+        return fichas - 1, 0.0
+    return fichas, (1 - fichas) * periodo / capacidad
+
+class LimitadorMemoria:
+    """Cubos en memoria del worker (LRU acotado)."""
+
+    def __init__(self, max_claves=10000):
+        self.max_claves = max_claves
+        self._cubos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consumir(self, clave, capacidad, periodo):
+        ahora = time.monotonic()
+        with self._lock:
+            fichas, actualizado = self._cubos.get(clave, (capacidad, ahora))
+            fichas, espera = _recargar_cubo(fichas, actualizado, ahora, capacidad, periodo)
+            self._cubos[clave] = (fichas, ahora)
+            self._cubos.move_to_end(clave)
+            while len(self._cubos) > self.max_claves:
+                self._cubos.popitem(last=False)
+        return espera
+
+class LimiteIntento(db.Model):
+    __tablename__ = 'limite_intento'
+    clave = db.Column(db.String(120), primary_key=True)
+    fichas = db.Column(db.Float, nullable=False)
+    actualizado = db.Column(db.Float, nullable=False)  # epoch en segundos
+
+class LimitadorBaseDatos:
+    """Cubos en la tabla limite_intento, en una transacción propia por intento."""
+
+    def consumir(self, clave, capacidad, periodo):
+        ahora = time.time()
+        with db.engine.begin() as conexion:
+            conexion.execute(db.text(
+                "INSERT INTO limite_intento (clave, fichas, actualizado) VALUES (:clave, :fichas, :ahora) "
+                "ON CONFLICT (clave) DO NOTHING"
+            ), {"clave": clave, "fichas": capacidad, "ahora": ahora})
+            fichas, actualizado = conexion.execute(
+                db.select(LimiteIntento.fichas, LimiteIntento.actualizado)
+                .where(LimiteIntento.clave == clave)
+                .with_for_update()
+            ).one()
+            fichas, espera = _recargar_cubo(fichas, actualizado, ahora, capacidad, periodo)
+            conexion.execute(
+                db.update(LimiteIntento).where(LimiteIntento.clave == clave)
+                .values(fichas=fichas, actualizado=ahora)
+            )
+            # Limpieza ocasional de cubos que ya estarían llenos
+            if random.random() < 0.01:
+                conexion.execute(db.delete(LimiteIntento).where(LimiteIntento.actualizado < ahora - 86400))
+        return espera
+
+limitador = {'memoria': LimitadorMemoria, 'db': LimitadorBaseDatos}.get(LIMITE_BACKEND, lambda: None)()
+
+def limitar_intentos(plantilla, campo_usuario=None):
+    """Aplica los límites por IP y por username (campo del formulario) a los POST.
+
+    Si se superan responde 429 con Retry-After renderizando 'plantilla'.
+    """
+    import math
+    limite_ip = _parsear_limite(LIMITE_POR_IP)
+    limite_usuario = _parsear_limite(LIMITE_POR_USUARIO)
+
+    def decorador(vista):
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            if request.method == 'POST' and limitador is not None:
+                espera = limitador.consumir(f"{request.endpoint}:ip:{request.remote_addr}", *limite_ip)
+                valor = (request.form.get(campo_usuario) or '').strip().lower() if campo_usuario else ''
+                if not espera and valor:
+                    huella = hashlib.sha256(valor.encode('utf-8')).hexdigest()[:32]
+                    espera = limitador.consumir(f"{request.endpoint}:usuario:{huella}", *limite_usuario)
+                if espera:
+                    app.logger.warning("Intentos limitados en %s desde %s", request.endpoint, request.remote_addr)
+                    flash('Demasiados intentos. Espera unos minutos antes de volver a intentarlo.')
+                    respuesta = make_response(render_template(plantilla), 429)
+                    respuesta.headers['Retry-After'] = str(math.ceil(espera))
+                    return respuesta
+            return vista(*args, **kwargs)
+        return envoltura
+    return decorador
+
 @app.route('/login', methods=['GET', 'POST'])
+@limitar_intentos('login.html', 'username')
 def login():
     if request.method == 'POST':
+        password = request.form['password']
         usuario = Usuario.query.filter_by(username=request.form['username']).first()
-        if usuario and usuario.check_password(request.form['password']):
+        if usuario is None:
+            politica_hash.verificar_ficticio(password)
+        elif usuario.check_password(password):
+            if usuario.hash_desactualizado():
+                usuario.set_password(password)
+                db.session.commit()
             login_user(usuario)
             flash('Bienvenido, {}'.format(usuario.username))
             return redirect(url_for('dashboard' if usuario.rol == 'admin' else 'index'))
@@ -490,19 +4364,21 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/dashboard')
+@lectura_replica
 @admin_required
 def dashboard():
-    total_viajes = Viaje.query.count()
-    total_reservas = Reserva.query.count()
-    total_usuarios = Usuario.query.count()
-    ultimas_reservas = Reserva.query.order_by(Reserva.id.desc()).limit(5).all()
+    estadisticas = estadisticas_dashboard()
+    ultimas_reservas = (Reserva.query
+                        .options(joinedload(Reserva.viaje))
+                        .order_by(Reserva.id.desc())
+                        .limit(5)
+                        .all())
     return render_template('admin/dashboard.html',
-                           total_viajes=total_viajes,
-                           total_reservas=total_reservas,
-                           total_usuarios=total_usuarios,
-                           ultimas_reservas=ultimas_reservas)
+                           ultimas_reservas=ultimas_reservas,
+                           **estadisticas)
 
 @app.route('/register', methods=['GET', 'POST'])
+@limitar_intentos('register.html', 'username')
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -532,6 +4408,7 @@ def register():
     return render_template('register.html')
 
 @app.route('/forgot-password', methods=['GET', 'POST'])
+@limitar_intentos('forgot_password.html', 'email')
 def forgot_password():
     if request.method == 'POST':
         email = request.form['email'].strip().lower()
@@ -541,7 +4418,8 @@ def forgot_password():
             s = _get_serializer()
             token = s.dumps({"uid": usuario.id}, salt=RESET_TOKEN_SALT)
             reset_url = url_for('reset_password', token=token, _external=True)
-            send_reset_email(usuario, reset_url)
+            if send_reset_email(usuario, reset_url):
+                db.session.commit()
     # Mensaje flash neutro para no revelar si el correo existe o no
     flash('Si tu correo está registrado, te enviamos un enlace para restablecer tu contraseña.')
     # Mensaje/página genérica para no revelar existencia del correo
@@ -551,6 +4429,7 @@ def forgot_password():
 
 @app.route('/reset-password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
+    from itsdangerous import BadSignature, SignatureExpired
     s = _get_serializer()
     try:
         data = s.loads(token, max_age=3600, salt=RESET_TOKEN_SALT)  # 1 hora
@@ -573,6 +4452,7 @@ def reset_password(token):
             flash('La contraseña debe tener al menos 6 caracteres.')
             return render_template('reset_password.html')
         usuario.set_password(password)
+        usuarios_cache.invalidar(usuario.id)
         db.session.commit()
         flash('Tu contraseña ha sido restablecida. Ahora puedes iniciar sesión.')
         return redirect(url_for('login'))
@@ -584,22 +4464,164 @@ def forgot_password_sent():
     return render_template('forgot_password_sent.html')
 
 @app.route('/usuarios')
+@lectura_replica
 @admin_required
 def listar_usuarios():
     usuarios = Usuario.query.all()
-    return render_template('admin/usuarios.html', usuarios=usuarios)
+    return render_template('admin/usuarios.html', usuarios=usuarios,
+                           limite_por_defecto=LIMITE_RESERVAS_POR_USUARIO)
+
+@app.route('/usuarios/<int:id>/rol', methods=['POST'])
+@admin_required
+def cambiar_rol(id):
+    usuario = Usuario.query.get_or_404(id)
+    rol = request.form.get('rol')
+    if rol not in ('usuario', 'agente', 'admin'):
+        abort(400)
+    if usuario.id == current_user.id:
+        flash('No puedes cambiar tu propio rol.')
+        return redirect(url_for('listar_usuarios'))
+    usuario.rol = rol
+    usuarios_cache.invalidar(usuario.id)
+    db.session.commit()
+    flash(f'Rol de {usuario.username} actualizado.')
+    return redirect(url_for('listar_usuarios'))
+
+@app.route('/usuarios/<int:id>/cuota', methods=['POST'])
+@admin_required
+def cambiar_cuota(id):
+    usuario = Usuario.query.get_or_404(id)
+    valor = (request.form.get('limite_reservas') or '').strip()
+    if valor and (not valor.isdigit() or int(valor) < 1):
+        flash('La cuota debe ser un entero positivo o quedar vacía.')
+        return redirect(url_for('listar_usuarios'))
+    usuario.limite_reservas = int(valor) if valor else None
+    db.session.commit()
+    flash(f'Cuota de {usuario.username} actualizada.')
+    return redirect(url_for('listar_usuarios'))
 
 @app.route('/admin/viajes/<int:id>')
+@lectura_replica
 @admin_required
 def admin_detalle_viaje(id):
     viaje = Viaje.query.get_or_404(id)
     return render_template('admin/viajes/detalle.html', viaje=viaje)
 
-# Only create DB tables automatically in development or when explicitly requested.
-# Production should rely on Alembic migrations (flask db upgrade).
-if os.environ.get("FLASK_ENV", "production") == "development" or os.environ.get("FLASK_RUN_CREATE_ALL", "0") == "1":
+def _inicializar_migraciones():
+    """Registra Flask-Migrate (importa alembic, ~100 ms) sólo cuando hace falta."""
+    if 'migrate' not in app.extensions:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
+
+def configurar_app():
+    """Configura la app única del módulo (secreto, base, extensiones).
+
+    No es una fábrica: corre una sola vez, al importar este módulo. Para
+    gunicorn: 'app:app'. Con preload_app el maestro importa el módulo y los
+    workers heredan la app ya configurada.
+    """
+    if 'sqlalchemy' in app.extensions:
+        return app
+    inicio = time.perf_counter()
+    tiempos_arranque['import'] = inicio - _INICIO_ARRANQUE
+    _configurar_secreto(app)
+    _configurar_base_de_datos(app)
+    db.init_app(app)
+    login_manager.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            vigilar_engine(engine)
+        replicas.configurar({clave: engine for clave, engine in db.engines.items()
+                             if clave and clave.startswith('replica')})
+    # Bajo el CLI de flask (hay un contexto de click activo) se registra
+    # 'flask db'; gunicorn no lo necesita y se ahorra importar alembic
+    if click.get_current_context(silent=True) is not None:
+        _inicializar_migraciones()
+    # Only create DB tables automatically in development or when explicitly requested.
+    # Production should rely on Alembic migrations (flask db upgrade).
+    if os.environ.get("FLASK_ENV", "production") == "development" or os.environ.get("FLASK_RUN_CREATE_ALL", "0") == "1":
+        with app.app_context():
+            db.create_all()
+    tiempos_arranque['configuracion'] = time.perf_counter() - inicio
+    return app
+
+
+def esperar_base_de_datos(intentos=60, pausa=1.0):
+    """Readiness: reintenta un SELECT 1 hasta que la base responda."""
+    for i in range(intentos):
+        error = sondear_base()
+        if error is None:
+            return True
+        print(f"Intento {i + 1}/{intentos}: DB no lista aún: {error.orig}")
+        time.sleep(pausa)
+    return False
+
+
+def _fase(nombre, funcion, *args):
+    inicio = time.perf_counter()
+    try:
+        return funcion(*args)
+    finally:
+        tiempos_arranque[nombre] = time.perf_counter() - inicio
+
+
+def preparar_arranque():
+    """Espera la base, aplica migraciones y prepara estáticos y variantes en un
+    solo proceso (el maestro de gunicorn o `flask preparar`).
+
+    La espera de la base y las migraciones son fatales: no se sirve con un
+    esquema viejo. Estáticos y variantes sólo se registran si fallan (la app
+    funciona sin ellos).
+    """
     with app.app_context():
-        db.create_all()
+        if not _fase('espera_db', esperar_base_de_datos):
+            raise RuntimeError("Timeout esperando la base de datos")
+
+        def migrar():
+            from flask_migrate import upgrade
+            _inicializar_migraciones()
+            upgrade()
+
+        try:
+            _fase('migraciones', migrar)
+        except (Exception, SystemExit) as e:
+            # Flask-Migrate convierte los errores de Alembic en sys.exit(1)
+            raise RuntimeError(f"Arranque: fallaron las migraciones: {e}") from e
+        for fase, funcion in (('estaticos', construir_estaticos),
+                              ('variantes', _generar_variantes_faltantes)):
+            try:
+                _fase(fase, funcion)
+            except Exception as e:
+                app.logger.error("Arranque: falló la fase %s: %s", fase, e)
+        # Las conexiones abiertas aquí no deben heredarlas los workers
+        descartar_conexiones()
+    print(reporte_arranque())
+
+
+def descartar_conexiones(cerrar=True):
+    """Descarta los pools de todos los engines: la primaria y las réplicas.
+
+    Con cerrar=False (después de un fork) no cierra los sockets, que siguen
+    siendo del proceso padre; sólo los olvida.
+    """
+    for engine in db.engines.values():
+        engine.dispose(close=cerrar)
+
+
+def reporte_arranque():
+    total = time.perf_counter() - _INICIO_ARRANQUE
+    fases = " ".join(f"{fase}={segundos * 1000:.0f}ms" for fase, segundos in tiempos_arranque.items())
+    return f"Arranque: {fases} total={total * 1000:.0f}ms"
+
+
+@app.cli.command("preparar")
+def preparar_command():
+    """Espera la base, migra y construye estáticos y variantes (lo que hace gunicorn al arrancar)."""
+    preparar_arranque()
+
+
+configurar_app()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
@@ -5,43 +5,21 @@ set -e
 echo "DEBUG: DATABASE_URL='${DATABASE_URL}'" || true
 echo "DEBUG: POSTGRES_USER='${POSTGRES_USER}' POSTGRES_PW='${POSTGRES_PW}' POSTGRES_DB='${POSTGRES_DB}' POSTGRES_HOST='${POSTGRES_HOST}' POSTGRES_PORT='${POSTGRES_PORT}'" || true
 
-# Esperar a Postgres usando psycopg2
-echo "Esperando a Postgres..."
-python - <<'PY'
-import os, time, sys
-import psycopg2
-
-url = os.environ.get('DATABASE_URL')
-if not url:
-    user = os.environ.get('POSTGRES_USER', 'postgres')
-    pw = os.environ.get('POSTGRES_PW', '12345')
-    host = os.environ.get('POSTGRES_HOST', 'localhost')
-    port = os.environ.get('POSTGRES_PORT', '5432')
-    db = os.environ.get('POSTGRES_DB', 'reservasdb')
-    url = f'postgresql://{user}:{pw}@{host}:{port}/{db}'
-
-for i in range(60):
-    try:
-        conn = psycopg2.connect(url)
-        conn.close()
-        print('Postgres disponible')
-        sys.exit(0)
-    except Exception as e:
-        print(f'Intento {i+1}/60: DB no lista aún: {e}')
-        time.sleep(1)
-
-print('Timeout esperando la base de datos')
-sys.exit(1)
-PY
-
-# Aplicar migraciones (no fatales: si fallan, continuamos y dejamos que la app arranque)
-echo "Aplicando migraciones Alembic..."
-if flask db upgrade; then
-    echo "Migraciones aplicadas"
-else
-    echo "Fallo al aplicar migraciones; continuando arranque (temporal)"
+# La espera de Postgres, las migraciones Alembic, los estáticos con huella y las
+# variantes de imágenes los hace el maestro de gunicorn en su propio proceso
+# (on_starting -> app.preparar_arranque, ver gunicorn.conf.py). Sin preload el
+# maestro no importa la app: se hacen aquí, y si fallan no se arranca. Para
+# correrlos a mano: flask preparar
+if [ "${GUNICORN_PRELOAD:-1}" != "1" ]; then
+  flask --app app preparar
 fi
 
-# Iniciar Gunicorn
+# Métricas: los workers de gunicorn vuelcan sus histogramas en un directorio
+# común para que /metrics muestre el total; se vacía en cada arranque.
+export METRICAS_DIR="${METRICAS_DIR:-/tmp/viajes-metricas}"
+rm -rf "$METRICAS_DIR"
+
+# Iniciar Gunicorn: modo (GUNICORN_MODO), workers, hilos, timeouts y pool de
+# conexiones se calculan en gunicorn.conf.py según CPU y memoria disponibles
 echo "Iniciando Gunicorn..."
-exec gunicorn -w ${GUNICORN_WORKERS:-3} -b 0.0.0.0:${PORT:-5000} app:app
+exec gunicorn -c gunicorn.conf.py -b 0.0.0.0:${PORT:-5000} app:app
@@ -0,0 +1,173 @@
+# Configuración de gunicorn. Los valores de la línea de comandos (entrypoint.sh)
+# tienen prioridad sobre los de este archivo.
+#
+# GUNICORN_MODO elige el modelo de concurrencia:
+#   sync    - un request por worker; una consulta lenta a Neon o un SMTP lento
+#             bloquea el worker entero.
+#   gthread - (por defecto) GUNICORN_THREADS hilos por worker; psycopg2 y
+#             smtplib liberan el GIL mientras esperan la red.
+#   gevent  - greenlets cooperativos (GUNICORN_CONEXIONES por worker); psycopg2
+#             se vuelve "green" con un wait callback (ver post_fork).
+#
+# Workers, hilos, timeouts y el pool de SQLAlchemy se derivan de los límites de
+# CPU y memoria del contenedor (cgroups) y se pueden forzar por variable de
+# entorno. El pool se exporta como SQLALCHEMY_POOL_SIZE/MAX_OVERFLOW antes de
+# que los workers importen la app.
+#
+# Con GUNICORN_PRELOAD=1 (por defecto) el maestro importa la app, espera la base,
+# aplica migraciones y prepara estáticos y variantes (app.preparar_arranque) una
+# sola vez; los workers nacen por fork ya calientes. Con GUNICORN_PRELOAD=0 eso
+# lo hace entrypoint.sh con `flask preparar` y cada worker importa la app.
+import math
+import os
+
+modo = os.environ.get("GUNICORN_MODO", "gthread")
+if modo not in ("sync", "gthread", "gevent"):
+    raise RuntimeError(f"GUNICORN_MODO desconocido: {modo!r} (sync/gthread/gevent)")
+
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+if modo == "gevent" and preload_app:
+    # Con preload la app se importa en el maestro, antes de que el worker gevent
+    # parchee: hay que parchear aquí para que threading/socket ya sean cooperativos.
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def _leer(ruta):
+    try:
+        with open(ruta, encoding="ascii") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cpus_disponibles():
+    """CPUs efectivas: afinidad del proceso acotada por la cuota de cgroups (v2 o v1)."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    cuota = _leer("/sys/fs/cgroup/cpu.max")
+    if cuota:
+        limite, periodo = (cuota.split() + ["100000"])[:2]
+        if limite != "max":
+            cpus = min(cpus, int(limite) / int(periodo))
+    else:
+        limite, periodo = _leer("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"), _leer("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+        if limite and periodo and int(limite) > 0:
+            cpus = min(cpus, int(limite) / int(periodo))
+    return max(1, math.ceil(cpus))
+
+
+def memoria_disponible_mb():
+    """Límite de memoria del contenedor en MB, o None si no hay."""
+    for ruta in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        valor = _leer(ruta)
+        if valor and valor != "max" and int(valor) < 1 << 60:
+            return int(valor) // (1024 * 1024)
+    return None
+
+
+def _entero(nombre, defecto):
+    valor = os.environ.get(nombre)
+    return int(valor) if valor else defecto
+
+
+cpus = cpus_disponibles()
+memoria_mb = memoria_disponible_mb()
+memoria_por_worker_mb = _entero("GUNICORN_MEMORIA_POR_WORKER_MB", 150)
+
+# sync necesita un proceso por request simultáneo (2*CPU+1); con hilos o
+# greenlets la concurrencia viene de adentro del worker y basta ~1 por CPU + 1.
+workers_cpu = 2 * cpus + 1 if modo == "sync" else cpus + 1
+workers_memoria = max(1, memoria_mb // memoria_por_worker_mb) if memoria_mb else workers_cpu
+workers = _entero("GUNICORN_WORKERS", max(1, min(workers_cpu, workers_memoria)))
+
+if modo == "gthread":
+    worker_class = "gthread"
+    threads = _entero("GUNICORN_THREADS", 4)
+    concurrencia_por_worker = threads
+elif modo == "gevent":
+    worker_class = "gevent"
+    worker_connections = _entero("GUNICORN_CONEXIONES", 100)
+    concurrencia_por_worker = worker_connections
+else:
+    worker_class = "sync"
+    concurrencia_por_worker = 1
+
+# Un worker sync no puede avisar al arbiter mientras atiende: timeout corto para
+# reciclar los colgados. Con hilos/greenlets el latido corre aparte y el timeout
+# sólo protege de un worker bloqueado por completo.
+timeout = _entero("GUNICORN_TIMEOUT", 30 if modo == "sync" else 60)
+graceful_timeout = _entero("GUNICORN_GRACEFUL_TIMEOUT", 30)
+keepalive = _entero("GUNICORN_KEEPALIVE", 2 if modo == "sync" else 5)
+
+# Pool de SQLAlchemy por worker: tantas conexiones como requests simultáneos
+# pueda atender (con gevent, acotado: la mayoría espera red, no la base), sin
+# superar el total que admite la base (DB_MAX_CONEXIONES, repartido entre workers).
+db_max_conexiones = _entero("DB_MAX_CONEXIONES", 90)
+tope_por_worker = max(2, db_max_conexiones // workers)
+pool_size = min(concurrencia_por_worker if modo != "gevent" else 10, tope_por_worker)
+max_overflow = max(0, min(pool_size, tope_por_worker - pool_size))
+os.environ.setdefault("SQLALCHEMY_POOL_SIZE", str(pool_size))
+os.environ.setdefault("SQLALCHEMY_MAX_OVERFLOW", str(max_overflow))
+# Con gevent una espera por conexión libre no debe colgar el greenlet para siempre
+os.environ.setdefault("SQLALCHEMY_POOL_TIMEOUT", "10" if modo == "gevent" else "30")
+# Cada worker despacha correos con su propio limitador: CORREO_MAX_POR_MINUTO
+# se reparte entre todos
+os.environ.setdefault("CORREO_PROCESOS", str(workers))
+
+
+def on_starting(server):
+    # Sin preload el maestro no importa la app: la preparación la hace
+    # entrypoint.sh con `flask preparar` antes de lanzar gunicorn. Si falla
+    # (p. ej. una migración) el maestro termina y no se sirve nada.
+    if preload_app:
+        import app
+        app.preparar_arranque()
+    server.log.info(
+        "gunicorn: modo=%s workers=%s concurrencia/worker=%s cpus=%s memoria=%s pool=%s+%s timeout=%ss",
+        modo, workers, concurrencia_por_worker, cpus, f"{memoria_mb}MB" if memoria_mb else "sin límite",
+        os.environ["SQLALCHEMY_POOL_SIZE"], os.environ["SQLALCHEMY_MAX_OVERFLOW"], timeout,
+    )
+
+
+def _espera_gevent(conexion, timeout=None):
+    """Wait callback de psycopg2 que cede a otros greenlets mientras espera el socket."""
+    import psycopg2
+    from psycopg2 import extensions
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        estado = conexion.poll()
+        if estado == extensions.POLL_OK:
+            break
+        elif estado == extensions.POLL_READ:
+            wait_read(conexion.fileno(), timeout=timeout)
+        elif estado == extensions.POLL_WRITE:
+            wait_write(conexion.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Estado de poll inesperado: {estado!r}")
+
+
+def post_fork(server, worker):
+    # El worker gevent ya aplicó monkey.patch_all (sockets, ssl, threading,
+    # time): smtplib y el hilo de correos cooperan solos. psycopg2 es C y
+    # necesita el wait callback para no bloquear el loop.
+    if modo == "gevent":
+        from psycopg2 import extensions
+        extensions.set_wait_callback(_espera_gevent)
+    # Con preload los engines (primaria y réplicas) vienen del maestro:
+    # descartar sus pools sin cerrar sockets que no son de este proceso. Sin
+    # preload el worker todavía no importó la app y no hay nada heredado.
+    if preload_app:
+        import app
+        with app.app.app_context():
+            app.descartar_conexiones(cerrar=False)
+
+
+def pre_request(worker, req):
+    # Las respuestas en streaming (exportación de reservas) llaman a este latido
+    # entre lotes para que el arbiter no mate a un worker sync ocupado.
+    import app
+    app.registrar_latido_worker(worker.notify)
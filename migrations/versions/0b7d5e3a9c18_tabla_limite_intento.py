@@ -0,0 +1,41 @@
+"""Tabla limite_intento para el límite de intentos compartido
+
+Revision ID: 0b7d5e3a9c18
+Revises: f6c2a8d4e913
+Create Date: 2026-10-18 18:40:21.774306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b7d5e3a9c18'
+down_revision = 'f6c2a8d4e913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Crea la tabla de cubos (token bucket) que usa LIMITE_BACKEND=db para
+    limitar login, registro y recuperación de contraseña (idempotente).
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+
+    if 'limite_intento' not in insp.get_table_names():
+        op.create_table(
+            'limite_intento',
+            sa.Column('clave', sa.String(length=120), nullable=False),
+            sa.Column('fichas', sa.Float(), nullable=False),
+            sa.Column('actualizado', sa.Float(), nullable=False),
+            sa.PrimaryKeyConstraint('clave'),
+        )
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if 'limite_intento' in insp.get_table_names():
+        op.drop_table('limite_intento')
@@ -0,0 +1,44 @@
+"""Tabla catalogo_version para invalidar la caché del catálogo
+
+Revision ID: 3f1a9b2c7d10
+Revises: c4d6c815d5f2
+Create Date: 2026-10-18 10:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1a9b2c7d10'
+down_revision = 'c4d6c815d5f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Crea la tabla de una sola fila con la versión del catálogo de viajes
+    (idempotente) y siembra la fila inicial.
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+
+    if 'catalogo_version' not in insp.get_table_names():
+        op.create_table(
+            'catalogo_version',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('version', sa.BigInteger(), nullable=False, server_default='0'),
+            sa.PrimaryKeyConstraint('id'),
+        )
+
+    existe = bind.execute(sa.text("SELECT 1 FROM catalogo_version WHERE id = 1")).first()
+    if not existe:
+        op.execute("INSERT INTO catalogo_version (id, version) VALUES (1, 0)")
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if 'catalogo_version' in insp.get_table_names():
+        op.drop_table('catalogo_version')
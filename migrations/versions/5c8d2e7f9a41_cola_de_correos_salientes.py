@@ -0,0 +1,51 @@
+"""Cola de correos salientes (outbox)
+
+Revision ID: 5c8d2e7f9a41
+Revises: d5a7c9e1f248
+Create Date: 2026-10-18 14:22:37.904512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c8d2e7f9a41'
+down_revision = 'd5a7c9e1f248'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Crea la tabla correo_saliente (idempotente) con el índice que usa el
+    despachador para tomar los pendientes en orden.
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+
+    if 'correo_saliente' not in insp.get_table_names():
+        op.create_table(
+            'correo_saliente',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('destinatario', sa.String(length=120), nullable=False),
+            sa.Column('asunto', sa.String(length=200), nullable=False),
+            sa.Column('texto', sa.Text(), nullable=False),
+            sa.Column('html', sa.Text(), nullable=True),
+            sa.Column('estado', sa.String(length=20), nullable=False, server_default='pendiente'),
+            sa.Column('intentos', sa.Integer(), nullable=False, server_default='0'),
+            sa.Column('proximo_intento', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+            sa.Column('ultimo_error', sa.Text(), nullable=True),
+            sa.Column('creado_en', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+            sa.Column('enviado_en', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+        )
+        op.create_index('ix_correo_saliente_pendientes', 'correo_saliente', ['estado', 'proximo_intento'])
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if 'correo_saliente' in insp.get_table_names():
+        op.drop_index('ix_correo_saliente_pendientes', table_name='correo_saliente')
+        op.drop_table('correo_saliente')
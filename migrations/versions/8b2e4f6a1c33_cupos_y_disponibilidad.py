@@ -0,0 +1,54 @@
+"""Cupos por viaje e inventario de disponibilidad por fecha
+
+Revision ID: 8b2e4f6a1c33
+Revises: 3f1a9b2c7d10
+Create Date: 2026-10-18 11:40:05.503117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4f6a1c33'
+down_revision = '3f1a9b2c7d10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Agrega viaje.cupos (NULL = sin límite) y la tabla disponibilidad
+    (viaje_id, fecha) de forma idempotente. Las filas de inventario se crean
+    al reservar, a partir de las reservas existentes, así que no hay backfill.
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+
+    columnas = [c['name'] for c in insp.get_columns('viaje')]
+    if 'cupos' not in columnas:
+        op.add_column('viaje', sa.Column('cupos', sa.Integer(), nullable=True))
+
+    if 'disponibilidad' not in insp.get_table_names():
+        op.create_table(
+            'disponibilidad',
+            sa.Column('viaje_id', sa.Integer(), nullable=False),
+            sa.Column('fecha', sa.String(length=20), nullable=False),
+            sa.Column('capacidad', sa.Integer(), nullable=False),
+            sa.Column('reservados', sa.Integer(), nullable=False, server_default='0'),
+            sa.ForeignKeyConstraint(['viaje_id'], ['viaje.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('viaje_id', 'fecha'),
+            sa.CheckConstraint('reservados >= 0 AND reservados <= capacidad', name='ck_disponibilidad_cupos'),
+        )
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+
+    if 'disponibilidad' in insp.get_table_names():
+        op.drop_table('disponibilidad')
+
+    columnas = [c['name'] for c in insp.get_columns('viaje')]
+    if 'cupos' in columnas:
+        op.drop_column('viaje', 'cupos')
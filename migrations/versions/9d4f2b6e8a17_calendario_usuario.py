@@ -0,0 +1,56 @@
+"""Calendario de fechas reservadas por usuario (bits por día)
+
+Revision ID: 9d4f2b6e8a17
+Revises: 0b7d5e3a9c18
+Create Date: 2026-10-18 19:42:37.105562
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4f2b6e8a17'
+down_revision = '0b7d5e3a9c18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Crea calendario_usuario (idempotente) y la rellena con las fechas de las
+    reservas existentes: una fila por (usuario, mes) con el bit del día
+    (bit 0 = día 1) encendido.
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if 'calendario_usuario' in insp.get_table_names():
+        return
+
+    calendario = op.create_table(
+        'calendario_usuario',
+        sa.Column('usuario_id', sa.Integer(), nullable=False),
+        sa.Column('mes', sa.Date(), nullable=False),
+        sa.Column('dias', sa.Integer(), nullable=False, server_default='0'),
+        sa.ForeignKeyConstraint(['usuario_id'], ['usuario.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('usuario_id', 'mes'),
+    )
+
+    reserva = sa.table('reserva', sa.column('usuario_id', sa.Integer()), sa.column('fecha', sa.Date()))
+    bits = {}
+    for usuario_id, fecha in bind.execute(
+        sa.select(reserva.c.usuario_id, reserva.c.fecha).where(reserva.c.usuario_id.is_not(None)).distinct()
+    ):
+        clave = (usuario_id, fecha.replace(day=1))
+        bits[clave] = bits.get(clave, 0) | (1 << (fecha.day - 1))
+    if bits:
+        op.bulk_insert(calendario, [
+            {'usuario_id': usuario_id, 'mes': mes, 'dias': dias} for (usuario_id, mes), dias in bits.items()
+        ])
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if 'calendario_usuario' in insp.get_table_names():
+        op.drop_table('calendario_usuario')
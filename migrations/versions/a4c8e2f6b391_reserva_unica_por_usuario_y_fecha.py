@@ -0,0 +1,56 @@
+"""Índice único parcial de reservas por (usuario_id, fecha)
+
+Revision ID: a4c8e2f6b391
+Revises: 9d4f2b6e8a17
+Create Date: 2026-10-18 21:05:12.418337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c8e2f6b391'
+down_revision = '9d4f2b6e8a17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Reemplaza ix_reserva_usuario_fecha por ux_reserva_usuario_fecha (único,
+    sólo para reservas con usuario). Si ya hay fechas repetidas por usuario no
+    se crea: se avisa y se deja el índice común hasta que se corrijan los datos.
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    indices = {ix['name'] for ix in insp.get_indexes('reserva')}
+    if 'ux_reserva_usuario_fecha' in indices:
+        return
+
+    repetidas = bind.execute(sa.text(
+        "SELECT COUNT(*) FROM (SELECT usuario_id, fecha FROM reserva WHERE usuario_id IS NOT NULL "
+        "GROUP BY usuario_id, fecha HAVING COUNT(*) > 1) AS r"
+    )).scalar()
+    if repetidas:
+        print(f"AVISO: {repetidas} combinaciones (usuario, fecha) repetidas en reserva; "
+              "no se crea ux_reserva_usuario_fecha.")
+        return
+
+    if 'ix_reserva_usuario_fecha' in indices:
+        op.drop_index('ix_reserva_usuario_fecha', table_name='reserva')
+    op.create_index(
+        'ux_reserva_usuario_fecha', 'reserva', ['usuario_id', 'fecha'], unique=True,
+        postgresql_where=sa.text('usuario_id IS NOT NULL'),
+        sqlite_where=sa.text('usuario_id IS NOT NULL'),
+    )
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    indices = {ix['name'] for ix in insp.get_indexes('reserva')}
+    if 'ux_reserva_usuario_fecha' in indices:
+        op.drop_index('ux_reserva_usuario_fecha', table_name='reserva')
+    if 'ix_reserva_usuario_fecha' not in indices:
+        op.create_index('ix_reserva_usuario_fecha', 'reserva', ['usuario_id', 'fecha'])
@@ -0,0 +1,64 @@
+"""Tablas de estadísticas precalculadas del dashboard
+
+Revision ID: a71c3e5b9d02
+Revises: 5c8d2e7f9a41
+Create Date: 2026-10-18 16:05:12.418230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a71c3e5b9d02'
+down_revision = '5c8d2e7f9a41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Crea estadistica_contador y estadistica_viaje_dia (idempotente) y las
+    rellena a partir de los datos existentes.
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    tablas = insp.get_table_names()
+
+    if 'estadistica_contador' not in tablas:
+        op.create_table(
+            'estadistica_contador',
+            sa.Column('clave', sa.String(length=40), nullable=False),
+            sa.Column('fragmento', sa.SmallInteger(), nullable=False),
+            sa.Column('valor', sa.BigInteger(), nullable=False, server_default='0'),
+            sa.PrimaryKeyConstraint('clave', 'fragmento'),
+        )
+        for clave, tabla in (('viajes', 'viaje'), ('reservas', 'reserva'), ('usuarios', 'usuario')):
+            op.execute(
+                f"INSERT INTO estadistica_contador (clave, fragmento, valor) "
+                f"SELECT '{clave}', 0, COUNT(*) FROM {tabla}"
+            )
+
+    if 'estadistica_viaje_dia' not in tablas:
+        op.create_table(
+            'estadistica_viaje_dia',
+            sa.Column('viaje_id', sa.Integer(), nullable=False),
+            sa.Column('fecha', sa.Date(), nullable=False),
+            sa.Column('reservas', sa.Integer(), nullable=False, server_default='0'),
+            sa.ForeignKeyConstraint(['viaje_id'], ['viaje.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('viaje_id', 'fecha'),
+        )
+        op.execute(
+            "INSERT INTO estadistica_viaje_dia (viaje_id, fecha, reservas) "
+            "SELECT viaje_id, fecha, COUNT(*) FROM reserva GROUP BY viaje_id, fecha"
+        )
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    tablas = insp.get_table_names()
+    if 'estadistica_viaje_dia' in tablas:
+        op.drop_table('estadistica_viaje_dia')
+    if 'estadistica_contador' in tablas:
+        op.drop_table('estadistica_contador')
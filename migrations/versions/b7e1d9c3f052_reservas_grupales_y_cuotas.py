@@ -0,0 +1,106 @@
+"""Reservas grupales (grupo_reserva, reserva.grupo_id) y cuota por usuario
+
+Revision ID: b7e1d9c3f052
+Revises: a4c8e2f6b391
+Create Date: 2026-10-18 22:31:48.260914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e1d9c3f052'
+down_revision = 'a4c8e2f6b391'
+branch_labels = None
+depends_on = None
+
+
+def _indices(insp):
+    return {ix['name'] for ix in insp.get_indexes('reserva')}
+
+
+def upgrade():
+    """
+    Crea grupo_reserva, agrega reserva.grupo_id y usuario.limite_reservas
+    (NULL = cuota por defecto) y deja a los pasajeros de grupos fuera del
+    índice único por (usuario_id, fecha). Idempotente.
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+
+    if 'grupo_reserva' not in insp.get_table_names():
+        op.create_table(
+            'grupo_reserva',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('nombre', sa.String(length=100), nullable=False),
+            sa.Column('email', sa.String(length=120), nullable=False),
+            sa.Column('fecha', sa.Date(), nullable=False),
+            sa.Column('mensaje', sa.Text(), nullable=True),
+            sa.Column('viaje_id', sa.Integer(), nullable=False),
+            sa.Column('usuario_id', sa.Integer(), nullable=False),
+            sa.Column('creado_en', sa.DateTime(), nullable=False),
+            sa.ForeignKeyConstraint(['viaje_id'], ['viaje.id']),
+            sa.ForeignKeyConstraint(['usuario_id'], ['usuario.id']),
+            sa.PrimaryKeyConstraint('id'),
+        )
+        op.create_index('ix_grupo_reserva_usuario', 'grupo_reserva', ['usuario_id', 'id'])
+
+    columnas = [c['name'] for c in insp.get_columns('usuario')]
+    if 'limite_reservas' not in columnas:
+        op.add_column('usuario', sa.Column('limite_reservas', sa.Integer(), nullable=True))
+
+    columnas = [c['name'] for c in insp.get_columns('reserva')]
+    if 'grupo_id' not in columnas:
+        with op.batch_alter_table('reserva') as batch_op:
+            batch_op.add_column(sa.Column('grupo_id', sa.Integer(), nullable=True))
+            batch_op.create_foreign_key('fk_reserva_grupo_id', 'grupo_reserva', ['grupo_id'], ['id'],
+                                        ondelete='CASCADE')
+    insp = sa.inspect(bind)
+    indices = _indices(insp)
+    if 'ix_reserva_grupo' not in indices:
+        op.create_index('ix_reserva_grupo', 'reserva', ['grupo_id'])
+
+    # El índice único de a4c8e2f6b391 no excluía a los grupos: recrearlo
+    if 'ux_reserva_usuario_fecha' in indices:
+        op.drop_index('ux_reserva_usuario_fecha', table_name='reserva')
+        op.create_index(
+            'ux_reserva_usuario_fecha', 'reserva', ['usuario_id', 'fecha'], unique=True,
+            postgresql_where=sa.text('usuario_id IS NOT NULL AND grupo_id IS NULL'),
+            sqlite_where=sa.text('usuario_id IS NOT NULL AND grupo_id IS NULL'),
+        )
+
+
+def downgrade():
+    """
+    Borra los grupos y sus pasajeros antes de quitar las columnas; después
+    conviene correr 'flask recalcular-estadisticas'.
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+
+    columnas = [c['name'] for c in insp.get_columns('reserva')]
+    if 'grupo_id' in columnas:
+        op.execute("DELETE FROM reserva WHERE grupo_id IS NOT NULL")
+        indices = _indices(insp)
+        if 'ux_reserva_usuario_fecha' in indices:
+            op.drop_index('ux_reserva_usuario_fecha', table_name='reserva')
+        if 'ix_reserva_grupo' in indices:
+            op.drop_index('ix_reserva_grupo', table_name='reserva')
+        with op.batch_alter_table('reserva') as batch_op:
+            if any(fk.get('name') == 'fk_reserva_grupo_id' for fk in insp.get_foreign_keys('reserva')):
+                batch_op.drop_constraint('fk_reserva_grupo_id', type_='foreignkey')
+            batch_op.drop_column('grupo_id')
+        if 'ux_reserva_usuario_fecha' in indices:
+            op.create_index(
+                'ux_reserva_usuario_fecha', 'reserva', ['usuario_id', 'fecha'], unique=True,
+                postgresql_where=sa.text('usuario_id IS NOT NULL'),
+                sqlite_where=sa.text('usuario_id IS NOT NULL'),
+            )
+
+    columnas = [c['name'] for c in insp.get_columns('usuario')]
+    if 'limite_reservas' in columnas:
+        op.drop_column('usuario', 'limite_reservas')
+
+    if 'grupo_reserva' in insp.get_table_names():
+        op.drop_table('grupo_reserva')
@@ -0,0 +1,45 @@
+"""Tabla sesion para las sesiones del lado del servidor
+
+Revision ID: c2f8a6d4e193
+Revises: b7e1d9c3f052
+Create Date: 2026-10-18 23:48:05.917264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2f8a6d4e193'
+down_revision = 'b7e1d9c3f052'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Crea sesion (idempotente). En Postgres es UNLOGGED: las escrituras no pasan
+    por el WAL ni llegan a las réplicas, y tras una caída la tabla queda vacía
+    (los usuarios vuelven a iniciar sesión).
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if 'sesion' in insp.get_table_names():
+        return
+
+    op.create_table(
+        'sesion',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('datos', sa.LargeBinary(), nullable=False),
+        sa.Column('expira', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        prefixes=['UNLOGGED'] if bind.dialect.name == 'postgresql' else [],
+    )
+    op.create_index('ix_sesion_expira', 'sesion', ['expira'])
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if 'sesion' in insp.get_table_names():
+        op.drop_table('sesion')
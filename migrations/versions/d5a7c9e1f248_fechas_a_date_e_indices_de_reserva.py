@@ -0,0 +1,139 @@
+"""Convierte reserva.fecha y viaje.fecha a DATE y agrega índices de reserva
+
+Revision ID: d5a7c9e1f248
+Revises: 8b2e4f6a1c33
+Create Date: 2026-10-18 13:05:51.271946
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5a7c9e1f248'
+down_revision = '8b2e4f6a1c33'
+branch_labels = None
+depends_on = None
+
+# Formatos vistos en datos cargados a mano además del ISO de <input type=date>
+FORMATOS_FECHA = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y/%m/%d', '%d/%m/%y')
+LOTE = 1000
+
+
+def _parse_fecha(valor):
+    if valor is None:
+        return None
+    texto = str(valor).strip()
+    if not texto:
+        return None
+    # Valores como '2025-08-21 10:00' o '2025-08-21T10:00:00'
+    candidatos = (texto, texto[:10])
+    for candidato in candidatos:
+        for formato in FORMATOS_FECHA:
+            try:
+                return datetime.strptime(candidato, formato).date()
+            except ValueError:
+                continue
+    return None
+
+
+def _convertir_columna(bind, tabla, obligatoria):
+    """Copia tabla.fecha (texto) a una columna DATE nueva, por lotes de id."""
+    insp = sa.inspect(bind)
+    columnas = {c['name']: c for c in insp.get_columns(tabla)}
+    if isinstance(columnas['fecha']['type'], sa.Date):
+        return  # ya convertida
+
+    if 'fecha_date' not in columnas:
+        op.add_column(tabla, sa.Column('fecha_date', sa.Date(), nullable=True))
+
+    t = sa.table(tabla, sa.column('id', sa.Integer), sa.column('fecha', sa.String),
+                 sa.column('fecha_date', sa.Date))
+    invalidas = []
+    ultimo_id = 0
+    while True:
+        filas = bind.execute(
+            sa.select(t.c.id, t.c.fecha).where(t.c.id > ultimo_id).order_by(t.c.id).limit(LOTE)
+        ).fetchall()
+        if not filas:
+            break
+        valores = []
+        for fila_id, texto in filas:
+            convertida = _parse_fecha(texto)
+            if convertida is None and texto not in (None, ''):
+                invalidas.append((fila_id, texto))
+            valores.append({'b_id': fila_id, 'b_fecha': convertida})
+        bind.execute(
+            t.update().where(t.c.id == sa.bindparam('b_id')).values(fecha_date=sa.bindparam('b_fecha')),
+            valores,
+        )
+        ultimo_id = filas[-1][0]
+
+    if invalidas and obligatoria:
+        # No inventamos fechas para reservas: abortar para que se corrijan a mano
+        muestra = ', '.join(f"id={i} '{v}'" for i, v in invalidas[:20])
+        raise RuntimeError(f"{tabla}.fecha tiene {len(invalidas)} valores no convertibles a DATE: {muestra}")
+    if invalidas:
+        print(f"{tabla}.fecha: {len(invalidas)} valores no convertibles quedan en NULL")
+
+    with op.batch_alter_table(tabla) as batch_op:
+        batch_op.drop_column('fecha')
+        batch_op.alter_column('fecha_date', new_column_name='fecha',
+                              existing_type=sa.Date(), nullable=not obligatoria)
+
+
+def upgrade():
+    """
+    Conversión segura en tres pasos por tabla: columna DATE auxiliar,
+    backfill parseando los textos existentes y reemplazo de la columna.
+    El inventario de disponibilidad se recrea vacío con fecha DATE: sus filas
+    se reconstruyen solas desde las reservas la próxima vez que se reserva.
+    """
+    bind = op.get_bind()
+
+    _convertir_columna(bind, 'viaje', obligatoria=False)
+    _convertir_columna(bind, 'reserva', obligatoria=True)
+
+    insp = sa.inspect(bind)
+    if 'disponibilidad' in insp.get_table_names():
+        op.drop_table('disponibilidad')
+    op.create_table(
+        'disponibilidad',
+        sa.Column('viaje_id', sa.Integer(), nullable=False),
+        sa.Column('fecha', sa.Date(), nullable=False),
+        sa.Column('capacidad', sa.Integer(), nullable=False),
+        sa.Column('reservados', sa.Integer(), nullable=False, server_default='0'),
+        sa.ForeignKeyConstraint(['viaje_id'], ['viaje.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('viaje_id', 'fecha'),
+        sa.CheckConstraint('reservados >= 0 AND reservados <= capacidad', name='ck_disponibilidad_cupos'),
+    )
+
+    indices = {i['name'] for i in sa.inspect(bind).get_indexes('reserva')}
+    if 'ix_reserva_usuario_fecha' not in indices:
+        op.create_index('ix_reserva_usuario_fecha', 'reserva', ['usuario_id', 'fecha'])
+    if 'ix_reserva_viaje_fecha' not in indices:
+        op.create_index('ix_reserva_viaje_fecha', 'reserva', ['viaje_id', 'fecha'])
+    if 'ix_reserva_id_desc' not in indices:
+        op.create_index('ix_reserva_id_desc', 'reserva', [sa.text('id DESC')])
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+
+    indices = {i['name'] for i in insp.get_indexes('reserva')}
+    for nombre in ('ix_reserva_id_desc', 'ix_reserva_viaje_fecha', 'ix_reserva_usuario_fecha'):
+        if nombre in indices:
+            op.drop_index(nombre, table_name='reserva')
+
+    with op.batch_alter_table('disponibilidad') as batch_op:
+        batch_op.alter_column('fecha', existing_type=sa.Date(), type_=sa.String(length=20),
+                              postgresql_using="to_char(fecha, 'YYYY-MM-DD')")
+    with op.batch_alter_table('reserva') as batch_op:
+        batch_op.alter_column('fecha', existing_type=sa.Date(), type_=sa.String(length=20),
+                              existing_nullable=False, postgresql_using="to_char(fecha, 'YYYY-MM-DD')")
+    with op.batch_alter_table('viaje') as batch_op:
+        batch_op.alter_column('fecha', existing_type=sa.Date(), type_=sa.String(length=20),
+                              existing_nullable=True, postgresql_using="to_char(fecha, 'YYYY-MM-DD')")
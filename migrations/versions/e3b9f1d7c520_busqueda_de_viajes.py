@@ -0,0 +1,68 @@
+"""Búsqueda de texto completo en viajes (tsvector + GIN)
+
+Revision ID: e3b9f1d7c520
+Revises: a71c3e5b9d02
+Create Date: 2026-10-18 17:31:48.205117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3b9f1d7c520'
+down_revision = 'a71c3e5b9d02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    En Postgres: extensión unaccent, función inmutable f_unaccent (necesaria
+    para usarla en una columna generada), columna viaje.busqueda con nombre
+    (peso A) y descripción (peso B) en configuración 'spanish' e índice GIN.
+    En cualquier motor: índices para las facetas de precio y fecha.
+    Idempotente.
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    columnas = {c['name'] for c in insp.get_columns('viaje')}
+    indices = {i['name'] for i in insp.get_indexes('viaje')}
+
+    if bind.dialect.name == 'postgresql':
+        op.execute("CREATE EXTENSION IF NOT EXISTS unaccent")
+        op.execute(
+            "CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS "
+            "$$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$ "
+            "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT"
+        )
+        if 'busqueda' not in columnas:
+            op.execute(
+                "ALTER TABLE viaje ADD COLUMN busqueda tsvector GENERATED ALWAYS AS ("
+                "setweight(to_tsvector('spanish', f_unaccent(coalesce(nombre, ''))), 'A') || "
+                "setweight(to_tsvector('spanish', f_unaccent(coalesce(descripcion, ''))), 'B')"
+                ") STORED"
+            )
+        if 'ix_viaje_busqueda' not in indices:
+            op.execute("CREATE INDEX ix_viaje_busqueda ON viaje USING GIN (busqueda)")
+
+    if 'ix_viaje_precio' not in indices:
+        op.create_index('ix_viaje_precio', 'viaje', ['precio'])
+    if 'ix_viaje_fecha' not in indices:
+        op.create_index('ix_viaje_fecha', 'viaje', ['fecha'])
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    columnas = {c['name'] for c in insp.get_columns('viaje')}
+    indices = {i['name'] for i in insp.get_indexes('viaje')}
+    if 'ix_viaje_fecha' in indices:
+        op.drop_index('ix_viaje_fecha', table_name='viaje')
+    if 'ix_viaje_precio' in indices:
+        op.drop_index('ix_viaje_precio', table_name='viaje')
+    if bind.dialect.name == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_viaje_busqueda")
+        if 'busqueda' in columnas:
+            op.execute("ALTER TABLE viaje DROP COLUMN busqueda")
+        op.execute("DROP FUNCTION IF EXISTS f_unaccent(text)")
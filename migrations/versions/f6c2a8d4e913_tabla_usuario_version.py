@@ -0,0 +1,44 @@
+"""Tabla usuario_version para invalidar la caché de usuarios
+
+Revision ID: f6c2a8d4e913
+Revises: e3b9f1d7c520
+Create Date: 2026-10-18 18:02:55.630841
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6c2a8d4e913'
+down_revision = 'e3b9f1d7c520'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Crea la tabla de una sola fila con la versión de los usuarios cacheados
+    por load_user (idempotente) y siembra la fila inicial.
+    """
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+
+    if 'usuario_version' not in insp.get_table_names():
+        op.create_table(
+            'usuario_version',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('version', sa.BigInteger(), nullable=False, server_default='0'),
+            sa.PrimaryKeyConstraint('id'),
+        )
+
+    existe = bind.execute(sa.text("SELECT 1 FROM usuario_version WHERE id = 1")).first()
+    if not existe:
+        op.execute("INSERT INTO usuario_version (id, version) VALUES (1, 0)")
+
+
+def downgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if 'usuario_version' in insp.get_table_names():
+        op.drop_table('usuario_version')
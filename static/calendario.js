@@ -0,0 +1,134 @@
+// Calendario de disponibilidad para los formularios de reserva.
+// Pide /api/viajes/<id>/disponibilidad?mes=YYYY-MM y deshabilita los días
+// pasados, sin cupos o en los que el usuario ya tiene otra reserva. El input
+// type=date sigue siendo el campo real: el calendario sólo lo completa, y el
+// servidor vuelve a validar al enviar.
+(function(){
+  var MESES = ['Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio',
+               'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'];
+  var DIAS = ['Lu', 'Ma', 'Mi', 'Ju', 'Vi', 'Sá', 'Do'];
+
+  function pad(n){ return (n < 10 ? '0' : '') + n; }
+  function claveMes(anio, mes){ return anio + '-' + pad(mes + 1); }
+  function hoyISO(){
+    var d = new Date();
+    return d.getFullYear() + '-' + pad(d.getMonth() + 1) + '-' + pad(d.getDate());
+  }
+
+  function Calendario(form){
+    this.form = form;
+    this.select = form.querySelector('select[name="viaje_id"]');
+    this.input = form.querySelector('input[name="fecha"]');
+    this.api = form.getAttribute('data-calendario');
+    // Al editar, la fecha y el viaje actuales de la reserva siguen siendo válidos
+    this.fechaActual = form.getAttribute('data-fecha-actual') || '';
+    this.viajeActual = form.getAttribute('data-viaje-actual') || '';
+    this.cache = {};
+
+    var base = this.input.value || hoyISO();
+    this.anio = parseInt(base.slice(0, 4), 10);
+    this.mes = parseInt(base.slice(5, 7), 10) - 1;
+
+    this.caja = document.createElement('div');
+    this.caja.className = 'calendario';
+    this.input.insertAdjacentElement('afterend', this.caja);
+
+    var self = this;
+    this.select.addEventListener('change', function(){ self.cargar(); });
+    this.input.addEventListener('change', function(){
+      if (/^\d{4}-\d{2}-\d{2}$/.test(self.input.value)) {
+        self.anio = parseInt(self.input.value.slice(0, 4), 10);
+        self.mes = parseInt(self.input.value.slice(5, 7), 10) - 1;
+      }
+      self.cargar();
+    });
+    this.cargar();
+  }
+
+  Calendario.prototype.mover = function(delta){
+    this.mes += delta;
+    if (this.mes < 0) { this.mes = 11; this.anio -= 1; }
+    if (this.mes > 11) { this.mes = 0; this.anio += 1; }
+    this.cargar();
+  };
+
+  Calendario.prototype.cargar = function(){
+    var viaje = this.select.value;
+    if (!viaje) {
+      this.caja.innerHTML = '<p class="calendario-aviso">Elige un viaje para ver las fechas disponibles.</p>';
+      return;
+    }
+    var clave = viaje + '|' + claveMes(this.anio, this.mes);
+    var self = this;
+    if (this.cache[clave]) {
+      this.pintar(this.cache[clave]);
+      return;
+    }
+    var url = this.api.replace('/0/', '/' + encodeURIComponent(viaje) + '/') + '?mes=' + claveMes(this.anio, this.mes);
+    fetch(url, { credentials: 'same-origin', headers: { 'Accept': 'application/json' } })
+      .then(function(r){ if (!r.ok) { throw new Error(r.status); } return r.json(); })
+      .then(function(datos){ self.cache[clave] = datos; self.pintar(datos); })
+      .catch(function(){
+        self.caja.innerHTML = '<p class="calendario-aviso">No se pudo cargar la disponibilidad.</p>';
+      });
+  };
+
+  Calendario.prototype.pintar = function(datos){
+    var self = this;
+    var mias = {};
+    datos.mis_fechas.forEach(function(f){ mias[f] = true; });
+    var hoy = hoyISO();
+    var propia = String(datos.viaje_id) === this.viajeActual;
+    var primero = new Date(this.anio, this.mes, 1).getDay();  // 0 = domingo
+    var totalDias = new Date(this.anio, this.mes + 1, 0).getDate();
+
+    var html = '<div class="calendario-cabecera">' +
+      '<button type="button" class="calendario-nav" data-delta="-1" aria-label="Mes anterior">&lsaquo;</button>' +
+      '<span>' + MESES[this.mes] + ' ' + this.anio + '</span>' +
+      '<button type="button" class="calendario-nav" data-delta="1" aria-label="Mes siguiente">&rsaquo;</button>' +
+      '</div><div class="calendario-grilla">';
+    DIAS.forEach(function(d){ html += '<span class="calendario-dia-semana">' + d + '</span>'; });
+    for (var i = 0; i < (primero + 6) % 7; i++) { html += '<span></span>'; }
+    for (var dia = 1; dia <= totalDias; dia++) {
+      var fecha = claveMes(this.anio, this.mes) + '-' + pad(dia);
+      var actual = fecha === this.fechaActual;
+      var restantes = datos.restantes ? datos.restantes[dia - 1] : null;
+      var motivo = '';
+      if (fecha < hoy) {
+        motivo = 'Fecha pasada';
+      } else if (mias[fecha] && !actual) {
+        motivo = 'Ya tienes una reserva ese día';
+      } else if (restantes === 0 && !(actual && propia)) {
+        motivo = 'Sin cupos';
+      }
+      var clases = 'calendario-dia' + (fecha === this.input.value ? ' seleccionado' : '') +
+                   (motivo ? ' no-disponible' : '') + (mias[fecha] ? ' reservado' : '');
+      var titulo = motivo || (restantes === null ? 'Disponible' : restantes + ' cupos');
+      html += '<button type="button" class="' + clases + '" data-fecha="' + fecha + '" title="' + titulo + '"' +
+              (motivo ? ' disabled' : '') + '>' + dia + '</button>';
+    }
+    html += '</div>';
+    this.caja.innerHTML = html;
+
+    this.caja.querySelectorAll('.calendario-nav').forEach(function(btn){
+      btn.addEventListener('click', function(){ self.mover(parseInt(btn.getAttribute('data-delta'), 10)); });
+    });
+    this.caja.querySelectorAll('.calendario-dia:not([disabled])').forEach(function(btn){
+      btn.addEventListener('click', function(){
+        self.input.value = btn.getAttribute('data-fecha');
+        self.pintar(datos);
+      });
+    });
+  };
+
+  function init(){
+    if (!window.fetch) { return; }
+    document.querySelectorAll('form[data-calendario]').forEach(function(form){ new Calendario(form); });
+  }
+
+  if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', init);
+  } else {
+    init();
+  }
+})();